@@ -3,7 +3,7 @@
 
 '''LOAD MODULES'''
 # Core libraries:
-from psychopy import visual, core, event, clock, data, gui, monitors, parallel
+from psychopy import visual, core, event, clock, data, gui, monitors
 import random, time, numpy
 # For controlling eye tracker and eye-tracking SDK:
 import tobii_research
@@ -15,12 +15,34 @@ from psychopy import prefs
 prefs.hardware['audioLib'] = ['PTB'] #PTB described as highest accuracy sound class
 from psychopy import sound
 import psychtoolbox as ptb #sound processing via ptb
+# Trigger backends (parallel port, recorder, loopback):
+from trigger_backends import open_trigger_port, compile_trigger_table, compile_condition_triggers, TriggerSender
+# In-process gaze acquisition (Tobii SDK callback or simulated eye tracker):
+from gaze_acquisition import open_gaze_stream
+# Eye sample arrays and the gaze quality ring buffer:
+from gaze_samples import gaze_samples_to_array, GazeBuffer
+# Gaze polling thread:
+from gaze_polling import GazePoller, GazeState
 # For managing paths:
 from pathlib import Path
 # For logging data in a .log file:
 import logging
+# Log file and console output are written by a listener thread:
+from task_logging import setup_task_logging
+# Structured event log (JSON lines):
+from event_log import open_event_log, log_event
+# Crash-safe trial data (JSON lines):
+from trial_writer import open_trial_writer
+# Online pupil responses:
+from pupil_responses import PupilResponseEngine
+# Flip deadlines of timed events:
+from deadline_scheduler import DeadlineScheduler
+# Repetitions of trials that failed the data quality gate:
+from trial_repetitions import TrialRepetitions
 from datetime import datetime
 import os # 
+# The iohub connection is shared with the gaze polling thread:
+import threading
 # Miscellaneous: Hide messages in console from pygame:
 from os import environ
 environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
@@ -32,10 +54,10 @@ formatted_datetime = str(current_datetime.strftime("%Y-%m-%d %H-%M-%S"))
 logging_path = Path("Desktop", "tasks", "data", "auditory_oddball", "logging_data").resolve()
 filename_auditory_oddball = os.path.join(logging_path, formatted_datetime)
 
-logging.basicConfig(
-    level = logging.DEBUG,
-    filename = filename_auditory_oddball,
-    filemode = 'w', # w = write, for each subject an separate log file.
+# Log records and print() output are queued and written by a listener thread, see task_logging.py.
+# For each subject a separate log file is written.
+task_log = setup_task_logging(
+    filename_auditory_oddball,
     format = '%(asctime)s:%(levelname)s:%(name)s:%(message)s')
 
 print('THIS IS AUDITORY ODDBALL.')
@@ -86,6 +108,66 @@ relax_ball_color = (50, 25, 0) # yellow
 baseline_calibration_repetition = 1 
 # After 500 ms the no_data detection warning should be displayed on the screen.
 no_data_warning_cutoff = 0.5
+# Frame timing recorder (optional): flip timestamps of each trial are stored to detect dropped frames.
+record_frame_timing = False
+# Preallocated number of flip timestamps per trial, 36000 frames = 10 minutes at 60 Hz.
+max_frames_per_trial = 36000
+# Deadline scheduling (optional): events end on absolute flip deadlines planned from session start,
+# FALSE = durations are translated to a number of frames.
+deadline_scheduling = False
+# After untimed phases (e.g. instructions, dialogs) longer than this cutoff, the schedule restarts at the next flip.
+schedule_resync_cutoff = 0.5
+# Flip-locked triggers (optional): condition triggers are sent on the flip that starts the stimulus,
+# FALSE = condition triggers are sent before the first flip.
+flip_locked_triggers = False
+# Batched gaze samples (optional): gaze contingent checks use all eye samples since the last flip (300 Hz),
+# FALSE = only the latest gaze position of each flip is checked.
+batched_gaze_samples = False
+# Gaze offset is detected if at least this number of samples of one flip exceed gaze_offset_cutoff:
+gaze_offset_min_samples = 2
+# Samples older than this (in seconds) are not checked, e.g. samples recorded during the stimulus:
+gaze_sample_max_age = 0.05
+# Gaze quality (optional): eye samples of each fixation cross are stored to compute gaze and pupil metrics per trial.
+# Adds one tracker call per flip, unless batched_gaze_samples = True.
+record_gaze_quality = False
+# Preallocated number of samples, 8192 samples = 27 seconds at 300 Hz.
+gaze_buffer_size = 8192
+# Gaze acquisition for the gaze contingent checks: 'iohub' (default), 'tobii' = in-process gaze data
+# subscription of the Tobii SDK without iohub IPC, 'replay' = simulated eye tracker replaying gaze_replay_file.
+# iohub keeps recording in both cases.
+gaze_acquisition = 'iohub'
+# HDF5 file of a previous session (<fileName>_gaze.hdf5), None = simulated central fixation with blinks.
+gaze_replay_file = None
+# Gaze polling thread (optional): gaze data is read continuously by a worker thread,
+# the frame loop only reads the latest gaze state and never waits for the eye tracker.
+gaze_polling_thread = False
+# Time between two polls of the worker thread, in seconds:
+gaze_polling_interval = 0.002
+# Online pupil responses (optional): pre-stimulus baseline and peak dilation of every stimulus,
+# running mean and variance of the peak dilation per condition are shown at each baseline phase.
+online_pupil_responses = False
+# Baseline before and response window after stimulus onset, in seconds:
+pupil_baseline_duration = 0.5
+pupil_response_window = 1.5
+# Blinks and artifacts in baseline and response window are interpolated: 'linear', 'cubic' or None (only valid samples are used).
+pupil_interpolation = 'linear'
+# Data quality gate (optional): oddball block trials with too little gaze data or too much gaze offset
+# during the ISI are repeated at a random position of the remaining block, at most trial_repetition_budget times per block.
+repeat_failed_trials = False
+min_valid_fraction = 0.8
+max_offset_fraction = 0.2
+trial_repetition_budget = 10
+# Quiet mode: no console output during trial phases (log file is written as usual).
+quiet_console = False
+# Structured event log: trial starts, stimulus onsets, ISI results, pauses, no data, gaze offsets,
+# triggers and responses are written to <fileName>_events.jsonl in the trialdata folder.
+record_event_log = True
+# Crash-safe trial data: every row of exp.nextEntry() is written directly to <fileName>_trials.jsonl
+# (in addition to the files of the ExperimentHandler, which are written at exit).
+record_trial_rows = True
+# Typed trial table: the rows are additionally saved as <fileName>_trials.parquet at the end,
+# with native columns and list columns for responses (requires record_trial_rows and pyarrow).
+record_trial_table = False
 # Settings are stored automatically for each trial.
 settings = {}
 
@@ -94,6 +176,16 @@ pulse_duration = 0.01
 
 # Parallel port:
 parallel_port_adress = 0x03FF8
+# Asynchronous trigger pulses: pins are reset by a timer thread, FALSE = send_trigger() waits for pulse duration.
+async_trigger_pulses = True
+# Minimum time all pins stay low between two consecutive triggers, so that triggers never merge:
+trigger_min_gap = 0.01
+# Trigger backend: 'parallel' = parallel port, 'recorder' = triggers are saved to file, 'loopback' = local socket.
+trigger_backend = 'parallel'
+# Trigger log: every sent trigger is saved with experiment, epoch and eye-tracker time in a binary file.
+record_trigger_log = True
+# Preallocated number of trigger log entries, buffer is written to file between blocks:
+trigger_log_size = 4096
 
 # Presenting a dialog box. Infos are added to settings.
 settings['id'] = 123 #default testing value
@@ -119,6 +211,10 @@ exp = data.ExperimentHandler(
     dataFileName = str(trials_data_folder / fileName),
     )
 
+# Structured event log, written by the logging listener thread:
+if record_event_log:
+    task_log.add_handler('events', open_event_log(str(trials_data_folder / (fileName + '_events.jsonl')), clock = core.getTime))
+
 # Two different sound frequencies (conditions) are balanced across groups and
 # saved in the settings dictionary:
 random_number = random.random()
@@ -163,12 +259,21 @@ mywin = visual.Window(
 refresh_rate = mywin.monitorFramePeriod #get monitor refresh rate in seconds
 print('monitor refresh rate: ' + str(round(refresh_rate, 3)) + ' seconds')
 
+# Crash-safe trial data, the write cost of each row is compared with one frame:
+trial_writer = None
+if record_trial_rows:
+    trial_table_filename = str(trials_data_folder / (fileName + '_trials.parquet')) if record_trial_table else None
+    trial_writer = open_trial_writer(str(trials_data_folder / (fileName + '_trials.jsonl')), frame_duration = refresh_rate,
+        table_filename = trial_table_filename)
+
 # SETUP EYETRACKING:
 # Output gazeposition is alwys centered, i.e. screen center = [0,0].
 if testmode:
     logging.info(' TESTMODE = TRUE')
     print('mouse is used to mimick eyetracker...')
     iohub_config = {'eyetracker.hw.mouse.EyeTracker': {'name': 'tracker'}}
+    # Seconds per unit of tracker.trackerTime(), the mouse eye tracker returns seconds:
+    tracker_time_unit = 1
 if not testmode:
     logging.info('TESTMODE = FALSE')
     # Search for eye tracker:
@@ -185,6 +290,8 @@ if not testmode:
     # Define a config that allow iohub to connect to the eye-tracker:
     iohub_config = {'eyetracker.hw.tobii.EyeTracker':
         {'name': 'tracker', 'runtime_settings': {'sampling_rate': 300, }}}
+    # Seconds per unit of tracker.trackerTime(), the Tobii eye tracker returns its system time in microseconds:
+    tracker_time_unit = 0.000001
 # IOHUB creates a different instance that records eye tracking data in hdf5 file saved in datastore_name:
 io = launchHubServer(**iohub_config,
                         experiment_code = str(eyetracking_data_folder),
@@ -196,6 +303,17 @@ io = launchHubServer(**iohub_config,
 tracker = io.devices.tracker
 tracker.setRecordingState(True)
 
+# In-process gaze acquisition (optional), samples are streamed to <fileName>_gaze.hdf5:
+gaze_stream = None
+if gaze_acquisition != 'iohub':
+    gaze_stream = open_gaze_stream(
+        gaze_acquisition,
+        window_size = mywin.size,
+        clock = core.getTime,
+        eyetracker = None if testmode else my_eyetracker,
+        replay_file = gaze_replay_file,
+        filename = str(eyetracking_data_folder / (fileName + '_gaze.hdf5')))
+
 # SETUP PARALLEL PORT TRIGGER
 # List position defines triger value that is sent, see function send_triger(),
 # i. e. list position 2 will send a trigger with value "S2". 
@@ -227,16 +345,97 @@ trigger_name_list = ['PLACEHOLDER', #0
 
 print(trigger_name_list)
 
-# Find a parallel port:
+# Trigger table is compiled once: trigger name -> trigger value (S0-S255), see trigger_backends.py.
+trigger_table = compile_trigger_table(trigger_name_list)
+
+# Condition encoder: trigger values of the sound conditions are composed of bit fields,
+# S2 + 4 (reversed block) + 2 (standard) + 1 (500 Hz).
+# The condition table is compiled once for the balanced sounds: trial -> [trigger name, sound, pitch],
+# thus present_stimulus() needs a single lookup per trial. Every derived value has to be unique,
+# fit into 8 bits and match the position of its trigger name in trigger_name_list.
+condition_trigger_base = 2
+condition_bit_fields = {
+    'trial': {'oddball': 0, 'standard': 2, 'oddball_rev': 4, 'standard_rev': 6},
+    'pitch': {sound_two_in_Hz: 0, sound_one_in_Hz: 1}}
+# Sound of each trial type, reversed blocks play the other sound:
+condition_sounds = {
+    'oddball': [oddball_sound, sound_oddball],
+    'standard': [standard_sound, sound_standard],
+    'oddball_rev': [standard_sound, sound_standard],
+    'standard_rev': [oddball_sound, sound_oddball]}
+
+def condition_trigger_name(trial, pitch):
+    return trial + '_' + str(pitch) + 'Hz'
+
+# Trigger values are checked in compile_condition_triggers(), see trigger_backends.py:
+condition_table = dict()
+for [(trial, pitch), trigger_name] in compile_condition_triggers(
+        trigger_table, condition_trigger_base, condition_bit_fields, condition_trigger_name).items():
+    # Only the pitch that is played in this session is used:
+    [stimulus_sound, stimulus_pitch] = condition_sounds[trial]
+    if pitch == stimulus_pitch:
+        condition_table[trial] = [trigger_name, stimulus_sound, stimulus_pitch]
+
+# Find a parallel port or open another trigger backend, all pins are set to low:
+port = None
 if not testmode:
-    port = parallel.ParallelPort(parallel_port_adress)
-    # Set all pins to low, otherwise no triggers will be sent.
-    port.setData(0) 
+    port = open_trigger_port(
+        trigger_backend,
+        parallel_port_adress = parallel_port_adress,
+        filename = str(trials_data_folder / (fileName + '_triggers')))
+# Trigger pulses and trigger log (trigger_backends.TriggerSender, also used by trigger_benchmark.py):
+trigger_sender = TriggerSender(
+    port,
+    clock = core.getTime,
+    pulse_duration = pulse_duration,
+    trigger_min_gap = trigger_min_gap,
+    async_pulses = async_trigger_pulses,
+    log_filename = str(trials_data_folder / (fileName + '_trigger_log.bin')) if record_trigger_log else None,
+    log_size = trigger_log_size)
 
 # SETUP KEYBORD
 kb = keyboard.Keyboard()
 
 '''FUNCTIONS'''
+def start_trigger_pulse_thread():
+    if trigger_sender.async_pulses:
+        trigger_sender.start()
+        logging.info(' ASYNCHRONOUS TRIGGER PULSES STARTED.')
+
+# Wait until all triggers are sent and pins are low, e.g. before closing the experiment:
+def wait_for_trigger_pulses():
+    trigger_sender.wait()
+
+# Wait until pulse and minimum gap of the previous trigger have elapsed, called before the stimulus,
+# so that the condition trigger is not queued behind the trial trigger. The schedule is shifted by the waiting time:
+def wait_for_trigger_port():
+    port_wait = trigger_sender.wait_for_port()
+    extend_event(port_wait)
+    return port_wait
+
+# Next row of the experiment handler, the complete row (incl. loop data and settings) is written directly:
+def next_entry():
+    exp.nextEntry()
+    if trial_writer is not None:
+        trial_writer.write(exp.entries[-1])
+
+# Offset of the eye tracker clock to core.getTime() in seconds, the tracker time is taken between two core.getTime() calls
+# and converted to seconds (see tracker_time_unit):
+def sample_tracker_offset():
+    time_before = core.getTime()
+    tracker_time = get_tracker_time() * tracker_time_unit
+    time_after = core.getTime()
+    return tracker_time - (time_before + time_after) / 2
+
+# Append buffered entries to trigger log file (append-only), called outside the frame loops.
+# Tracker times of the entries are computed from the tracker clock offsets of this and the last flush (interpolated),
+# send_trigger() makes no iohub call:
+def flush_trigger_log():
+    trigger_sender.set_tracker_offset(sample_tracker_offset())
+    number_of_entries = trigger_sender.flush_log()
+    if number_of_entries > 0:
+        logging.info(' TRIGGER LOG: ' f'{number_of_entries}' ' ENTRIES WRITTEN.')
+
 # Send a trigger to eeg recording PC via parallel port:
 def send_trigger(trigger_name):
 
@@ -251,178 +450,203 @@ def send_trigger(trigger_name):
     ## pin 8 - S64
     ## pin 9 - S128
 
-    trigger_name_found = False
-    for i in trigger_name_list:
-        if i == trigger_name:
-            trigger_value = trigger_name_list.index(trigger_name)
-            # Translates trigger integer value to byte value (binary of length 8 = able to represent values 1-256)
-            # e.g. list position 3 -> trigger value "3" -> trigger_byte "00000011":
-            trigger_byte = f'{trigger_value:08b}'
-
-            #set pins according to trigger byte
-            if not testmode:
-                port.setPin(2, int(trigger_byte[7]))
-                port.setPin(3, int(trigger_byte[6]))
-                port.setPin(4, int(trigger_byte[5]))
-                port.setPin(5, int(trigger_byte[4]))
-                port.setPin(6, int(trigger_byte[3]))
-                port.setPin(7, int(trigger_byte[2]))
-                port.setPin(8, int(trigger_byte[1]))
-                port.setPin(9, int(trigger_byte[0]))
-
-                # Wait for pulse duration:
-                time.sleep(pulse_duration)
-                # Set all pins back to zero:
-                port.setData(0)
-
-            if testmode:
-                print('sent DUMMY trigger S' + str(trigger_value))
-                logging.info(' DUMMY TRIGGER WAS SENT: S' f'{trigger_value}')
-            trigger_name_found = True
-    if not trigger_name_found:
+    trigger_value = trigger_table.get(trigger_name)
+    if trigger_value is None:
         print('trigger name is not defined: ' + trigger_name)
         logging.info(' TRIGGER NAME IS NOT DEFINED: ' f'{trigger_name}')
+        return
+    # Set all pins according to trigger value with a single write,
+    # e.g. list position 3 -> trigger value "3" -> pins 2 and 3 are high.
+    # Pins are set back to zero after pulse duration, the trigger log is written after the port:
+    [trigger_time_exp, trigger_queued] = trigger_sender.send(trigger_value, trigger_name)
+
+    if testmode:
+        print('sent DUMMY trigger S' + str(trigger_value))
+        logging.info(' DUMMY TRIGGER WAS SENT: S' f'{trigger_value}')
+    # A queued trigger waits for pulse and minimum gap of the previous trigger, its port write is in the trigger log:
+    log_event('trigger', time = trigger_time_exp, trigger_value = trigger_value, trigger_name = trigger_name, queued = trigger_queued)
+    return [trigger_time_exp, trigger_queued]
+
+# Stimulus cache:
+# PsychoPy objects are built once per key and afterwards only drawn inside the frame loops.
+# Each entry holds a list of stimuli which are drawn in list order.
+stimulus_cache = {}
+
+# Build all stimuli that belong to a cache key:
+def build_stimuli(key):
+    stimulus_type = key[0]
+
+    if stimulus_type == 'background':
+        (stimulus_type, background_color) = key
+        background_rect = visual.Rect(
+            win = mywin,
+            size = mywin.size,
+            fillColor = background_color)
+        return [background_rect]
+
+    if stimulus_type == 'instruction':
+        (stimulus_type, text, size) = key
+        instruction_slide = visual.TextStim(
+            win = mywin,
+            text = text,
+            color = 'black',
+            units = 'pix',
+            wrapWidth = 900,
+            height = size)
+        return [instruction_slide]
+
+    if stimulus_type == 'fixcross':
+        (stimulus_type, cross_color, size) = key
+        line1 = visual.Line(win = mywin, units = 'pix', lineColor = cross_color) 
+        line1.start = [-(size/2), 0]
+        line1.end = [+(size/2), 0]
+        line2 = visual.Line(win = mywin, units = 'pix', lineColor = cross_color) 
+        line2.start = [0, -(size/2)]
+        line2.end = [0, +(size/2)]
+        return [line1, line2]
+
+    if stimulus_type == 'gazedirect':
+        (stimulus_type, background_color, size) = key
+        # Parameters:
+        function_color = 'red'
+        arrow_size_pix = size
+        arrow_pos_offset = 5
+        width = 3
+
+        rect1 = visual.Rect(
+            win = mywin,
+            units = 'pix',
+            lineColor = function_color,
+            fillColor = background_color,
+            lineWidth = width,
+            size = size*6)
+
+        # Arrow left:
+        al_line1 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        al_line1.start = [-(arrow_size_pix*arrow_pos_offset), 0]
+        al_line1.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+        al_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        al_line2.start = [-(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), -arrow_size_pix/2]
+        al_line2.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+        al_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        al_line3.start = [-(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), +arrow_size_pix/2]
+        al_line3.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+
+        # Arrow right:
+        ar_line1 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ar_line1.start = [+(arrow_size_pix*arrow_pos_offset), 0]
+        ar_line1.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+        ar_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ar_line2.start = [+(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), -arrow_size_pix/2]
+        ar_line2.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+        ar_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ar_line3.start = [+(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), +arrow_size_pix/2]
+        ar_line3.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+
+        # Arrow top:
+        at_line1 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        at_line1.start = [0, +(arrow_size_pix*arrow_pos_offset)]
+        at_line1.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+        at_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        at_line2.start = [-arrow_size_pix/2, +(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
+        at_line2.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+        at_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        at_line3.start = [+arrow_size_pix/2, +(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
+        at_line3.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+
+        # Arrow bottom:
+        ab_line1 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ab_line1.start = [0, -(arrow_size_pix*arrow_pos_offset)]
+        ab_line1.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+        ab_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ab_line2.start = [+arrow_size_pix/2, -(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
+        ab_line2.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+        ab_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ab_line3.start = [-arrow_size_pix/2, -(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
+        ab_line3.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+
+        # Draw order: arrows first, then the frame around the fixation area.
+        return [al_line1, al_line2, al_line3,
+                ar_line1, ar_line2, ar_line3,
+                at_line1, at_line2, at_line3,
+                ab_line1, ab_line2, ab_line3,
+                rect1]
+
+    if stimulus_type == 'nodata':
+        (stimulus_type, text, size) = key
+        no_data_warning = visual.TextStim(
+            win = mywin,
+            text = text,
+            color = 'red',
+            units = 'pix',
+            height = size)
+        return [no_data_warning]
+
+    if stimulus_type == 'ball':
+        (stimulus_type, ball_color, size) = key
+        circle1 = visual.Circle(
+            win = mywin,
+            radius = size,
+            units = 'pix',
+            fillColor = ball_color,
+            interpolate = True)
+        return [circle1]
+
+# Draw cached stimuli. Stimuli are only built, if key was not requested before:
+def draw_cached(key):
+    if key not in stimulus_cache:
+        stimulus_cache[key] = build_stimuli(key)
+    for stimulus in stimulus_cache[key]:
+        stimulus.draw()
+
+# Build all stimuli of the frame loops before the experiment starts:
+def warm_up_stimulus_cache():
+    timestamp = core.getTime()
+    for background_color in [background_color_rgb, white_slide, black_slide]:
+        draw_cached(('background', background_color))
+        draw_cached(('gazedirect', background_color, size_fixation_cross_in_pixels))
+    for cross_color in ['black', 'grey']:
+        draw_cached(('fixcross', cross_color, size_fixation_cross_in_pixels))
+    draw_cached(('nodata', 'AUGEN NICHT ERKANNT!', size_fixation_cross_in_pixels))
+    for ball_color in [squeeze_ball_color, relax_ball_color]:
+        draw_cached(('ball', ball_color, size_fixation_cross_in_pixels))
+    # Warm-up stimuli are drawn once, but never shown on screen:
+    mywin.clearBuffer()
+    warm_up_duration = round(core.getTime()-timestamp,3)
+    number_of_objects = sum(len(stimuli) for stimuli in stimulus_cache.values())
+    print('stimulus cache: ' + str(number_of_objects) + ' objects, warm-up duration: ' + str(warm_up_duration))
+    logging.info(' STIMULUS CACHE: ' f'{number_of_objects}' ' OBJECTS, WARM-UP DURATION: ' f'{warm_up_duration}')
+    return [number_of_objects, warm_up_duration]
 
 # Draw instruction slides:
 def draw_instruction(text, background_color = background_color_rgb):
     if background_color is not background_color_rgb:
-        background_rect = visual.Rect(win=mywin, size=mywin.size, fillColor= background_color)
-        background_rect.draw()
-
-    instruction_slide = visual.TextStim(
-        win = mywin,
-        text = text,
-        color = 'black',
-        units = 'pix',
-        wrapWidth = 900,
-        height = size_fixation_cross_in_pixels)
-    instruction_slide.draw()
+        draw_cached(('background', background_color))
+    draw_cached(('instruction', text, size_fixation_cross_in_pixels))
 
 # Draw a fixation cross from lines:
 def draw_fixcross(background_color=background_color_rgb, cross_color = 'black'):
     if background_color is not background_color_rgb:
-        background_rect = visual.Rect(win=mywin, size=mywin.size, fillColor= background_color)
-        background_rect.draw()
-    line1 = visual.Line(win=mywin, units='pix', lineColor = cross_color) #define line object
-    line1.start = [-(size_fixation_cross_in_pixels/2), 0]
-    line1.end = [+(size_fixation_cross_in_pixels/2), 0]
-    line2 = visual.Line(win=mywin, units='pix', lineColor = cross_color) #define line object
-    line2.start = [0, -(size_fixation_cross_in_pixels/2)]
-    line2.end = [0, +(size_fixation_cross_in_pixels/2)]
-    line1.draw()
-    line2.draw()
+        draw_cached(('background', background_color))
+    draw_cached(('fixcross', cross_color, size_fixation_cross_in_pixels))
 
 # Draw figure when gaze is offset for gaze contigency:
 def draw_gazedirect(background_color=background_color_rgb):
     # Adapt background according to provided "background_color"
     if background_color is not background_color_rgb:
-        background_rect = visual.Rect(
-            win = mywin,
-            size = mywin.size,
-            fillColor = background_color)
-        background_rect.draw()
-    function_color = 'red'
-    arrow_size_pix = size_fixation_cross_in_pixels
-    arrow_pos_offset = 5
-    width = 3
-
-    rect1 = visual.Rect(
-        win = mywin,
-        units = 'pix',
-        lineColor = function_color,
-        fillColor = background_color,
-        lineWidth = width,
-        size = size_fixation_cross_in_pixels*6)
-
-    # Arrow left:
-    al_line1 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    al_line1.start = [-(arrow_size_pix*arrow_pos_offset), 0]
-    al_line1.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-    al_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    al_line2.start = [-(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), -arrow_size_pix/2]
-    al_line2.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-    al_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    al_line3.start = [-(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), +arrow_size_pix/2]
-    al_line3.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-
-    # Arrow right:
-    ar_line1 = visual.Line(win = mywin, units='pix', lineColor = function_color, lineWidth = width)
-    ar_line1.start = [+(arrow_size_pix*arrow_pos_offset), 0]
-    ar_line1.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-    ar_line2 = visual.Line(win = mywin, units='pix', lineColor = function_color, lineWidth = width)
-    ar_line2.start = [+(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), -arrow_size_pix/2]
-    ar_line2.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-    ar_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    ar_line3.start = [+(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), +arrow_size_pix/2]
-    ar_line3.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-
-    # Arrow top:
-    at_line1 = visual.Line(win = mywin, units='pix', lineColor = function_color, lineWidth = width)
-    at_line1.start = [0, +(arrow_size_pix*arrow_pos_offset)]
-    at_line1.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-    at_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    at_line2.start = [-arrow_size_pix/2, +(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
-    at_line2.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-    at_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    at_line3.start = [+arrow_size_pix/2, +(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
-    at_line3.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-
-    # Arrow bottom:
-    ab_line1 = visual.Line(win = mywin, units='pix', lineColor = function_color, lineWidth = width)
-    ab_line1.start = [0, -(arrow_size_pix*arrow_pos_offset)]
-    ab_line1.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-    ab_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    ab_line2.start = [+arrow_size_pix/2, -(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
-    ab_line2.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-    ab_line3 = visual.Line(win = mywin, units='pix', lineColor = function_color, lineWidth = width)
-    ab_line3.start = [-arrow_size_pix/2, -(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
-    ab_line3.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-
-    #draw all
-    al_line1.draw()
-    al_line2.draw()
-    al_line3.draw()
-
-    ar_line1.draw()
-    ar_line2.draw()
-    ar_line3.draw()
-
-    at_line1.draw()
-    at_line2.draw()
-    at_line3.draw()
-
-    ab_line1.draw()
-    ab_line2.draw()
-    ab_line3.draw()
-
-    rect1.draw()
+        draw_cached(('background', background_color))
+    draw_cached(('gazedirect', background_color, size_fixation_cross_in_pixels))
 
 # Feedback indicating that no eyes are currently detected thus eye tracking data is NA:
 def draw_nodata_info(background_color=background_color_rgb):
     # Adapt background according to provided "background_color":
     if background_color is not background_color_rgb:
-        background_rect = visual.Rect(
-            win = mywin,
-            size = mywin.size,
-            fillColor = background_color)
-        background_rect.draw()
-    no_data_warning = visual.TextStim(
-        win = mywin,
-        text = 'AUGEN NICHT ERKANNT!',
-        color = 'red',
-        units = 'pix',
-        height = size_fixation_cross_in_pixels)
-    no_data_warning.draw()
+        draw_cached(('background', background_color))
+    draw_cached(('nodata', 'AUGEN NICHT ERKANNT!', size_fixation_cross_in_pixels))
 
 # Stimulus for manipulation:
 def draw_ball(ball_color):
-    circle1 = visual.Circle(
-        win = mywin,
-        radius = size_fixation_cross_in_pixels,
-        units = 'pix',
-        fillColor = ball_color,
-        interpolate = True)
-    circle1.draw()
+    draw_cached(('ball', ball_color, size_fixation_cross_in_pixels))
 
 # Check for keypresses, used to pause and quit experiment:
 def check_keypress():
@@ -436,12 +660,22 @@ def check_keypress():
         ok_data = dlg.show()  # show dialog and wait for OK or Cancel
         if dlg.OK:  # or if ok_data is not None
             send_trigger('experiment_aborted')
+            wait_for_trigger_pulses()
+            flush_trigger_log()
+            stop_gaze_polling_thread()
+            if gaze_stream is not None:
+                gaze_stream.close()
+            if trial_writer is not None:
+                trial_writer.close()
             print('EXPERIMENT ABORTED!')
+            # Write all queued log records:
+            task_log.stop()
             core.quit()
         else:
             send_trigger('pause_ended')
             print('Experiment continues...')
         pause_time = clock.getTime() - timestamp_keypress
+        log_event('pause', key = 'escape', pause_duration = round(pause_time,3))
     elif 'p' in keys:
         send_trigger('pause_initiated')
         dlg = gui.Dlg(title='Pause', labelButtonOK='Continue')
@@ -449,12 +683,22 @@ def check_keypress():
         ok_data = dlg.show()  # show dialog and wait for OK
         pause_time = clock.getTime() - timestamp_keypress
         send_trigger('pause_ended')
+        log_event('pause', key = 'p', pause_duration = round(pause_time,3))
     else:
         pause_time = 0
     pause_time = round(pause_time,3)
+    # The next flip interval contains the pause, see get_frame_timing():
+    if pause_time > 0:
+        mark_frame_pause()
     return pause_time
 
 def check_nodata(gaze_position):
+    # Gaze state of the polling thread:
+    if isinstance(gaze_position, GazeState):
+        return gaze_position.nodata
+    # Batch of samples: no data if none of the samples since the last flip contains gaze data.
+    if isinstance(gaze_position, numpy.ndarray):
+        return not numpy.any(~numpy.isnan(gaze_position[:,0]))
     if gaze_position == None:
         nodata_boolean = True
     else:
@@ -465,6 +709,16 @@ def check_nodata(gaze_position):
 # Get gaze position and offset cutoff.
 # Then check for the offset of gaze from the center screen.
 def check_gaze_offset(gaze_position):
+    # Gaze state of the polling thread:
+    if isinstance(gaze_position, GazeState):
+        return gaze_position.offset
+    # Batch of samples: offset if enough samples since the last flip exceed the cutoff.
+    if isinstance(gaze_position, numpy.ndarray):
+        gaze_center_offsets = numpy.hypot(gaze_position[:,0], gaze_position[:,1])
+        number_of_valid_samples = numpy.count_nonzero(~numpy.isnan(gaze_center_offsets))
+        number_of_offset_samples = numpy.count_nonzero(gaze_center_offsets >= gaze_offset_cutoff)
+        # Short batches (e.g. a single sample) need fewer offset samples:
+        return number_of_offset_samples > 0 and number_of_offset_samples >= min(gaze_offset_min_samples, number_of_valid_samples)
     gaze_center_offset = numpy.sqrt((gaze_position[0])**2 + (gaze_position[1])**2) #pythagoras theorem
     if gaze_center_offset >= gaze_offset_cutoff:
         offset_boolean = True
@@ -472,50 +726,408 @@ def check_gaze_offset(gaze_position):
         offset_boolean = False
     return offset_boolean
 
+# Gaze snapshot: every tracker call is an IPC round-trip to the iohub server process.
+# The gaze position is requested at most once per flip and shared by check_nodata(),
+# check_gaze_offset() and the loggers. Number and latency of tracker calls are counted per trial.
+flip_counter = 0 # flips since start, see flip_window()
+gaze_snapshot = {'flip': -1, 'position': None}
+tracker_call_counter = 0
+tracker_call_duration = 0
+tracker_call_max = 0
+# Time the main thread waited for the tracker lock (held by the gaze polling thread):
+tracker_lock_wait_duration = 0
+tracker_lock_wait_max = 0
+
+# The iohub connection is shared with the gaze polling thread, one request at a time:
+tracker_lock = threading.Lock()
+
+def call_tracker(tracker_method):
+    global tracker_call_counter, tracker_call_duration, tracker_call_max, tracker_lock_wait_duration, tracker_lock_wait_max
+    call_start = core.getTime()
+    with tracker_lock:
+        lock_wait = core.getTime() - call_start
+        result = tracker_method()
+    call_duration = core.getTime() - call_start
+    tracker_call_counter += 1
+    tracker_call_duration += call_duration
+    tracker_call_max = max(tracker_call_max, call_duration)
+    tracker_lock_wait_duration += lock_wait
+    tracker_lock_wait_max = max(tracker_lock_wait_max, lock_wait)
+    return result
+
+def read_gaze_position():
+    if gaze_stream is not None:
+        return gaze_stream.get_latest_position()
+    return tracker.getPosition()
+
+# Gaze position of the current flip, None if no eyes are detected:
+def get_gaze_position():
+    if gaze_polling_thread:
+        return gaze_poller.state.position
+    if gaze_snapshot['flip'] != flip_counter:
+        gaze_snapshot['position'] = call_tracker(read_gaze_position)
+        gaze_snapshot['flip'] = flip_counter
+    return gaze_snapshot['position']
+
+# Tracker time (unit of tracker.trackerTime(), see tracker_time_unit): with the gaze polling thread, it is converted
+# from core.getTime() with the clock pair published by the worker, so the main thread never waits for the tracker lock:
+def get_tracker_time():
+    if gaze_polling_thread:
+        tracker_time = gaze_poller.get_tracker_time(tracker_time_unit)
+        if tracker_time is not None:
+            return tracker_time
+    return call_tracker(tracker.trackerTime)
+
+# Batched gaze samples: all eye sample events since the last flip are drained with one tracker call.
+# Each row holds the gaze position [x, y] of one sample, NaN if no eye was detected.
+# recent holds the rows (all columns) of the last batch that was not empty.
+gaze_batch = {'flip': -1, 'samples': numpy.zeros((0, 2)), 'recent': numpy.zeros((0, 6))}
+
+def read_gaze_samples():
+    if gaze_stream is not None:
+        samples = gaze_stream.get_new_samples()
+    else:
+        samples = gaze_samples_to_array(tracker.getEvents())
+    if record_gaze_quality:
+        gaze_buffer.store(samples)
+    if online_pupil_responses:
+        pupil_engine.feed(samples)
+    return samples
+
+# Gaze samples of the current flip.
+# An empty batch (no new samples yet, iohub delivers samples in bursts) holds no new information:
+# the samples of the last batch are used again, as long as they are not older than gaze_sample_max_age.
+def get_gaze_samples():
+    if gaze_batch['flip'] != flip_counter:
+        samples = call_tracker(read_gaze_samples)
+        if len(samples) > 0:
+            gaze_batch['recent'] = samples
+        recent_samples = gaze_batch['recent'][gaze_batch['recent'][:,0] >= core.getTime() - gaze_sample_max_age]
+        gaze_batch['samples'] = recent_samples[:, 1:3]
+        gaze_batch['flip'] = flip_counter
+    return gaze_batch['samples']
+
+# Gaze data for check_nodata() and check_gaze_offset():
+def get_gaze_data():
+    if gaze_polling_thread:
+        return gaze_poller.state
+    if batched_gaze_samples:
+        return get_gaze_samples()
+    if record_gaze_quality or online_pupil_responses:
+        get_gaze_samples()
+    return get_gaze_position()
+
+# Gaze polling thread, see gaze_polling.py. With batched samples, the samples of the last frame are checked:
+gaze_poller = GazePoller(read_gaze_samples, read_gaze_position, check_nodata, check_gaze_offset, tracker_lock,
+    tracker.trackerTime, core.getTime, batched = batched_gaze_samples, read_samples = record_gaze_quality or online_pupil_responses,
+    sample_window = min(refresh_rate, gaze_sample_max_age), interval = gaze_polling_interval)
+
+def start_gaze_polling_thread():
+    if gaze_polling_thread:
+        gaze_poller.start()
+
+# Stop the worker and save its latency histogram as <fileName>_gaze_polling.csv:
+def stop_gaze_polling_thread():
+    if gaze_polling_thread and gaze_poller.running:
+        gaze_poller.close()
+        [number_of_polls, slowest_poll] = gaze_poller.save_histogram(trials_data_folder / (fileName + '_gaze_polling.csv'))
+        print('gaze polling: ' + str(number_of_polls) + ' polls, slowest poll < ' + str(round(slowest_poll * 1000, 1)) + ' ms')
+        logging.info(' GAZE POLLING: ' f'{number_of_polls}' ' POLLS, SLOWEST POLL < ' f'{round(slowest_poll * 1000, 1)}' ' MS')
+
+# Duration without gaze data: timed by the polling thread, otherwise counted in frames:
+def get_nodata_duration(gaze_position, counted_duration):
+    if isinstance(gaze_position, GazeState):
+        return gaze_position.nodata_duration
+    return counted_duration
+
+# Gaze quality of the fixation crosses, see gaze_samples.py:
+gaze_buffer = GazeBuffer(gaze_buffer_size)
+gaze_quality = dict()
+
+# Valid sample ratio, mean gaze offset from center, fixation dispersion and mean pupil size since start_time:
+def compute_gaze_quality(start_time):
+    gaze_quality.clear()
+    gaze_quality.update(gaze_buffer.compute_quality(start_time))
+    return gaze_quality
+
+# Add gaze quality of the last fixation cross to trial handler:
+def add_gaze_quality_data(handler):
+    for column, value in gaze_quality.items():
+        handler.addData(column, value)
+    gaze_quality.clear()
+
+# Online pupil responses, see pupil_responses.py:
+pupil_engine = PupilResponseEngine(pupil_baseline_duration, pupil_response_window, pupil_interpolation)
+pupil_stimulus_to_save = None # stimulus of the current trial, see add_pupil_response_data()
+
+def register_pupil_trial(onset_time, condition, factors):
+    global pupil_stimulus_to_save
+    if online_pupil_responses:
+        pupil_stimulus_to_save = pupil_engine.register_trial(onset_time, condition, factors)
+
+# Add baseline and peak dilation of the stimulus of the current trial to trial handler.
+# Nothing is added to phases without stimulus, results of earlier stimuli that were not saved in time are dropped:
+def add_pupil_response_data(handler):
+    global pupil_stimulus_to_save
+    if pupil_stimulus_to_save is None:
+        return
+    pupil_response = pupil_engine.pop_result(pupil_stimulus_to_save)
+    handler.addData('pupil_stimulus', pupil_stimulus_to_save)
+    for column, value in pupil_response.items():
+        handler.addData(column, value)
+    pupil_stimulus_to_save = None
+
+# Live summary: number, mean and standard deviation of peak dilations per condition and factor level:
+def print_pupil_summary():
+    if not online_pupil_responses:
+        return
+    print('pupil responses (peak dilation):')
+    logging.info(' PUPIL RESPONSES (PEAK DILATION):')
+    for [key, count, mean, standard_deviation] in pupil_engine.get_summary():
+        summary = str(key) + ': n = ' + str(count) + ', mean = ' + str(round(mean,3)) + ', sd = ' + str(round(standard_deviation,3))
+        print('    ' + summary)
+        logging.info(' ' + summary)
+
+def reset_tracker_calls():
+    global tracker_call_counter, tracker_call_duration, tracker_call_max, tracker_lock_wait_duration, tracker_lock_wait_max
+    tracker_call_counter = 0
+    tracker_call_duration = 0
+    tracker_call_max = 0
+    tracker_lock_wait_duration = 0
+    tracker_lock_wait_max = 0
+
+# Add number and latency of tracker calls and the wait for the tracker lock since the last trial to trial handler:
+def add_tracker_call_data(handler):
+    handler.addData('tracker_calls', tracker_call_counter)
+    if tracker_call_counter > 0:
+        handler.addData('tracker_call_latency_mean', round(tracker_call_duration/tracker_call_counter,5))
+        handler.addData('tracker_call_latency_max', round(tracker_call_max,5))
+        handler.addData('tracker_lock_wait_total', round(tracker_lock_wait_duration,5))
+        handler.addData('tracker_lock_wait_max', round(tracker_lock_wait_max,5))
+    reset_tracker_calls()
+
+# Frame timing recorder:
+# Flip timestamps of the current trial are written into a preallocated array.
+# Flip intervals that contain a pause (dialog of check_keypress()) are marked and not counted as dropped frames.
+frame_timestamps = numpy.zeros(max_frames_per_trial)
+frame_after_pause = numpy.zeros(max_frames_per_trial, dtype = bool)
+frame_counter = 0
+frame_pause_pending = False
+# Time of the last flip and flip-to-flip time of the last frame (one refresh period after a pause):
+last_flip_time = None
+last_frame_duration = refresh_rate
+
+# Start recording flip timestamps of a new trial:
+def reset_frame_timing():
+    global frame_counter, frame_pause_pending
+    frame_counter = 0
+    frame_pause_pending = False
+
+def mark_frame_pause():
+    global frame_pause_pending
+    frame_pause_pending = True
+
+# Flip window and store the flip timestamp, used in all frame loops:
+def flip_window():
+    global frame_counter, flip_counter, frame_pause_pending, last_flip_time, last_frame_duration
+    flip_time = mywin.flip()
+    flip_counter += 1
+    flip_after_pause = frame_pause_pending
+    frame_pause_pending = False
+    if last_flip_time is not None and not flip_after_pause:
+        last_frame_duration = flip_time - last_flip_time
+    else:
+        last_frame_duration = refresh_rate
+    last_flip_time = flip_time
+    if record_frame_timing and frame_counter < max_frames_per_trial:
+        frame_timestamps[frame_counter] = flip_time
+        frame_after_pause[frame_counter] = flip_after_pause
+        frame_counter += 1
+    if event_scheduler.pending_event is not None:
+        register_event_onset(flip_time)
+    if pending_flip_trigger is not None:
+        register_trigger_flip(flip_time)
+    return flip_time
+
+# Duration of the last frame of the gaze contingent loops: in deadline mode the measured flip-to-flip time,
+# so dropped frames count with their real duration, otherwise one refresh period (frame counting):
+def get_frame_duration():
+    if deadline_scheduling:
+        return last_frame_duration
+    return refresh_rate
+
+# Dropped frames, maximum inter-flip interval and jitter of the current trial:
+def get_frame_timing():
+    flip_intervals = numpy.diff(frame_timestamps[:frame_counter])[~frame_after_pause[1:frame_counter]]
+    if len(flip_intervals) == 0:
+        return [0, 0, 0]
+    # A flip interval of n refresh periods means that n-1 frames were dropped:
+    missed_refreshes = numpy.round(flip_intervals/refresh_rate) - 1
+    dropped_frames = int(numpy.sum(missed_refreshes[missed_refreshes > 0]))
+    max_frame_interval = round(float(numpy.max(flip_intervals)),4)
+    frame_jitter = round(float(numpy.std(flip_intervals)),4)
+    if dropped_frames > 0:
+        print('warning: dropped frames: ' + str(dropped_frames))
+        logging.warning(' DROPPED FRAMES: ' f'{dropped_frames}' ' MAX FRAME INTERVAL: ' f'{max_frame_interval}')
+    return [dropped_frames, max_frame_interval, frame_jitter]
+
+# Add frame timing of the current trial to trial handler:
+def add_frame_timing_data(handler):
+    if record_frame_timing:
+        [dropped_frames, max_frame_interval, frame_jitter] = get_frame_timing()
+        handler.addData('dropped_frames', dropped_frames)
+        handler.addData('max_frame_interval', max_frame_interval)
+        handler.addData('frame_jitter', frame_jitter)
+
+# Deadline scheduler, see deadline_scheduler.py:
+event_scheduler = DeadlineScheduler(mywin, refresh_rate, schedule_resync_cutoff)
+
+# Define session start time at the next flip:
+def start_session_schedule():
+    session_start_time = event_scheduler.start()
+    if deadline_scheduling:
+        print('session start time: ' + str(round(session_start_time,4)))
+        logging.info(' SESSION START TIME: ' f'{round(session_start_time,4)}')
+
+# Plan onset of an event, returns the flip deadline at which the event ends:
+def schedule_event(event_name, duration):
+    if not deadline_scheduling:
+        return None
+    # The achieved onset is the timestamp of the next flip, see flip_window():
+    return event_scheduler.schedule(event_name, duration)
+
+# Shift end of the current event, e.g. by pauses and gaze contingent phases:
+def extend_event(duration):
+    if deadline_scheduling:
+        event_scheduler.extend(duration)
+
+# Store achieved onset of the event that was scheduled last:
+def register_event_onset(flip_time):
+    [event_name, planned_onset, achieved_onset] = event_scheduler.register_onset(flip_time)
+    logging.info(' EVENT ONSET: ' f'{event_name}' ' PLANNED: ' f'{round(planned_onset,4)}' ' ACHIEVED: ' f'{round(achieved_onset,4)}' ' DELAY: ' f'{round(achieved_onset - planned_onset,4)}')
+
+# Check if a frame loop continues, either by number of frames or by flip deadline:
+# In deadline mode the deadline is shifted by delay (e.g. gaze contingent delays and pauses):
+def continue_frame_loop(frameN, number_of_frames, frame_deadline, delay = 0):
+    if not deadline_scheduling:
+        return frameN < number_of_frames
+    return event_scheduler.continue_loop(frameN, frame_deadline, delay)
+
+# Add planned and achieved onsets (relative to session start) to trial handler:
+def add_schedule_data(handler):
+    if deadline_scheduling:
+        for event_name, [planned_onset, achieved_onset] in event_scheduler.pop_onsets().items():
+            handler.addData(event_name + '_onset_planned', round(planned_onset,4))
+            if achieved_onset is not None:
+                handler.addData(event_name + '_onset_achieved', round(achieved_onset,4))
+
+# Flip-locked triggers:
+# Condition triggers are queued with callOnFlip and sent directly after the flip that starts the stimulus.
+pending_flip_trigger = None
+# Flip timestamp, port write time and queue state of the last flip-locked trigger since the last saved trial:
+trigger_flip_timing = dict()
+
+# Send condition trigger, either immediately or on next flip:
+def send_trigger_on_flip(trigger_name):
+    global pending_flip_trigger
+    if flip_locked_triggers:
+        mywin.callOnFlip(send_flip_locked_trigger, trigger_name)
+        pending_flip_trigger = trigger_name
+    else:
+        send_trigger(trigger_name)
+
+# Called by window directly after the flip. The port is free (see wait_for_trigger_port()), thus the trigger time
+# is the port write. A queued trigger is flagged, then the trigger time is the call and its port write is in the trigger log:
+def send_flip_locked_trigger(trigger_name):
+    [trigger_time_exp, trigger_queued] = send_trigger(trigger_name)
+    trigger_flip_timing['trigger_sent_time'] = trigger_time_exp
+    trigger_flip_timing['trigger_queued'] = trigger_queued
+
+# Store flip timestamp of a flip-locked trigger, called by flip_window():
+def register_trigger_flip(flip_time):
+    global pending_flip_trigger
+    trigger_flip_timing['trigger_name'] = pending_flip_trigger
+    trigger_flip_timing['trigger_flip_time'] = flip_time
+    pending_flip_trigger = None
+
+# Add flip timestamp and remaining offset between flip and port write of the trigger to trial handler:
+def add_trigger_flip_data(handler):
+    if flip_locked_triggers and 'trigger_flip_time' in trigger_flip_timing:
+        trigger_flip_time = trigger_flip_timing['trigger_flip_time']
+        handler.addData('trigger_flip_time', round(trigger_flip_time,4))
+        handler.addData('trigger_flip_offset', round(trigger_flip_timing['trigger_sent_time'] - trigger_flip_time,4))
+        handler.addData('trigger_queued', trigger_flip_timing['trigger_queued'])
+        trigger_flip_timing.clear()
+
 # Fixation cross: Check for data availability and screen center gaze.
 def fixcross_gazecontingent(duration_in_seconds, background_color = background_color_rgb, cross_color = 'black'):
     # Translate duration to number of frames:
     number_of_frames = round(duration_in_seconds/refresh_rate)
+    # Alternatively, flip deadline at which the fixation cross ends:
+    frame_deadline = schedule_event('fixcross', duration_in_seconds)
     timestamp = core.getTime()
+    # The polling thread writes samples continuously, older samples are excluded by time:
+    if not gaze_polling_thread:
+        gaze_buffer.reset()
     gaze_offset_duration = 0
     pause_duration = 0
     nodata_duration = 0
+    # Time spent in gaze contingent loops, extends the deadline:
+    contingency_delay = 0
     # Cross presentation for number of frames:
-    for frameN in range(number_of_frames):
+    frameN = 0
+    while continue_frame_loop(frameN, number_of_frames, frame_deadline, delay = contingency_delay + pause_duration):
         # Check for keypress:
         pause_duration += check_keypress()
         # Check for eye tracking data, only call once per flip:
-        gaze_position = tracker.getPosition()
+        gaze_position = get_gaze_data()
         # Check for eye tracking data:
         if check_nodata(gaze_position):
             print('warning: no eyes detected')
             logging.warning(' NO EYES DETECTED')
-            frameN = 1 # reset duration of for loop - resart ISI
+            delay_start = core.getTime()
             nodata_current_duration = 0
 
             while check_nodata(gaze_position):
-                if nodata_current_duration > no_data_warning_cutoff: #ensure that warning is not presented after every eye blink
+                if get_nodata_duration(gaze_position, nodata_current_duration) > no_data_warning_cutoff: #ensure that warning is not presented after every eye blink
                     draw_nodata_info(background_color)
-                mywin.flip() #wait for monitor refresh time
-                nodata_duration += refresh_rate
-                nodata_current_duration += refresh_rate
-                gaze_position = tracker.getPosition() #get new gaze data
+                flip_window() #wait for monitor refresh time
+                frame_duration = get_frame_duration()
+                nodata_duration += frame_duration
+                nodata_current_duration += frame_duration
+                gaze_position = get_gaze_data() #get new gaze data
+            contingency_delay += core.getTime() - delay_start
+            log_event('nodata', time = delay_start, duration = round(core.getTime() - delay_start,3))
         # Check for gaze:
         elif check_gaze_offset(gaze_position):
             print('warning: gaze offset')
-            frameN = 1 #reset duration of for loop - resart ISI
+            delay_start = core.getTime()
+            pause_before_offset = pause_duration
 
             while not check_nodata(gaze_position) and check_gaze_offset(gaze_position):
                 # Listen for keypress:
                 pause_duration += check_keypress()
                 draw_gazedirect(background_color) #redirect attention to fixation cross area
-                mywin.flip() #wait for monitor refresh time
-                gaze_offset_duration += refresh_rate
-                gaze_position = tracker.getPosition() #get new gaze data
+                flip_window() #wait for monitor refresh time
+                gaze_offset_duration += get_frame_duration()
+                gaze_position = get_gaze_data() #get new gaze data
+            # Pauses during gaze offset are already included in pause duration:
+            contingency_delay += core.getTime() - delay_start - (pause_duration - pause_before_offset)
+            log_event('gaze_offset', time = delay_start, duration = round(core.getTime() - delay_start,3))
         # Draw fixation cross:
         draw_fixcross(background_color, cross_color)
-        mywin.flip()
-
+        flip_window()
+        frameN += 1
+
+    # Next event is planned after the extended deadline:
+    extend_event(contingency_delay + pause_duration)
+    # Gaze quality and pupil responses, including samples of the last frame:
+    if (record_gaze_quality or online_pupil_responses) and not gaze_polling_thread:
+        get_gaze_samples()
+    if record_gaze_quality:
+        compute_gaze_quality(timestamp)
+        print('gaze quality: ' + str(gaze_quality))
+        logging.info(' GAZE QUALITY: ' f'{gaze_quality}')
     # Generate output info:
     actual_fixcross_duration = round(core.getTime()-timestamp,3)
     gaze_offset_duration = round(gaze_offset_duration,3)
@@ -532,54 +1144,37 @@ def fixcross_gazecontingent(duration_in_seconds, background_color = background_c
     print('actual fixcross duration: ' + str(actual_fixcross_duration))
     logging.info(' ACTUAL FIXCROSS DURAION: ' f'{actual_fixcross_duration}')
 
+    log_event('isi_result', ISI_expected = duration_in_seconds, ISI_duration = actual_fixcross_duration, number_of_frames = number_of_frames,
+        gaze_offset_duration = gaze_offset_duration, nodata_duration = nodata_duration, pause_duration = pause_duration)
+
     return [actual_fixcross_duration, gaze_offset_duration, pause_duration, nodata_duration]
 
 # Auditory oddball stimulus:
 def present_stimulus(duration_in_seconds, trial):
+    # Condition trigger is written to the port without delay:
+    wait_for_trigger_port()
+    # Alternatively, flip deadline at which the stimulus ends:
+    frame_deadline = schedule_event('stimulus', duration_in_seconds)
+    # Trigger name, sound and pitch of the condition, see condition encoder in SETUP:
+    [trigger_name, stimulus_sound, pitch] = condition_table[trial]
     nextFlip = mywin.getFutureFlipTime(clock='ptb') # sync sound start with next screen refresh
-    if trial == 'oddball':
-        if sound_oddball == sound_one_in_Hz:
-            send_trigger('oddball_500Hz')
-        if sound_oddball == sound_two_in_Hz:
-            send_trigger('oddball_750Hz')
-        logging.info(' ODDBALL WAS PLAYED IN: ' f'{sound_oddball}' 'Hz')
-        oddball_sound.play(when=nextFlip)
-    if trial == 'standard':
-        if sound_standard == sound_one_in_Hz:
-            send_trigger('standard_500Hz')
-        if sound_standard == sound_two_in_Hz:
-            send_trigger('standard_750Hz')
-        logging.info(' STANDARD WAS PLAYED IN: ' f'{sound_standard}' 'Hz')
-        standard_sound.play(when=nextFlip)
-    if trial == 'oddball_rev':
-        if sound_oddball == sound_two_in_Hz:
-            send_trigger('oddball_rev_500Hz')
-        if sound_oddball == sound_one_in_Hz:
-            send_trigger('oddball_rev_750Hz')
-        logging.info(' ODDBALL_REV WAS PLAYED IN: ' f'{sound_standard}' 'Hz')
-        standard_sound.play(when=nextFlip)
-    if trial == 'standard_rev':
-        if sound_standard == sound_two_in_Hz:
-            send_trigger('standard_rev_500Hz')
-        if sound_standard == sound_one_in_Hz:
-            send_trigger('standard_rev_750Hz')
-        logging.info(' STANDARD_REV WAS PLAYED IN: ' f'{sound_oddball}' 'Hz')
-        oddball_sound.play(when=nextFlip)
+    send_trigger_on_flip(trigger_name)
+    logging.info(' ' + trial.upper() + ' WAS PLAYED IN: ' f'{pitch}' 'Hz')
+    stimulus_sound.play(when=nextFlip)
     number_of_frames = round(duration_in_seconds/refresh_rate) 
     # Present cross for number of frames:
     timestamp = clock.getTime()
-    for frameN in range(number_of_frames):
+    frameN = 0
+    while continue_frame_loop(frameN, number_of_frames, frame_deadline):
         draw_fixcross()
-        mywin.flip()
+        flip_time = flip_window()
+        # Sound onset of the online pupil response:
+        if frameN == 0:
+            register_pupil_trial(flip_time, trigger_name, {'trial': trial.replace('_rev', ''), 'reversal': trial.endswith('_rev'), 'pitch': pitch})
+            log_event('stimulus_onset', time = flip_time, trial = trial, condition = trigger_name)
+        frameN += 1
     # Stop replay:
-    if trial == 'oddball':
-        oddball_sound.stop()
-    if trial == 'standard':
-        standard_sound.stop()
-    if trial == 'oddball_rev':
-        standard_sound.stop()
-    if trial == 'standard_rev':
-        oddball_sound.stop()
+    stimulus_sound.stop()
     # Function output
     actual_stimulus_duration = round(clock.getTime()-timestamp,3)
     print(trial + " duration:",actual_stimulus_duration)
@@ -596,24 +1191,77 @@ def define_ISI_interval():
 def present_ball(which_phase):
     if which_phase == 'squeeze':
         number_of_frames = round(squeeze_phase_duration/refresh_rate)
-        for frameN in range(number_of_frames):
-            if frameN == 1:
-                timestamp = clock.getTime()
+        frame_deadline = schedule_event('manipulation', squeeze_phase_duration)
+        frameN = 0
+        while continue_frame_loop(frameN, number_of_frames, frame_deadline):
             draw_ball(squeeze_ball_color)
-            mywin.flip()
+            flip_window()
+            # Start of the manipulation phase is the first flip:
+            if frameN == 0:
+                timestamp = clock.getTime()
+            frameN += 1
     if which_phase == 'relax':
         number_of_frames = round(relax_phase_duration/refresh_rate)
-        for frameN in range(number_of_frames):
-            if frameN == 1:
-                timestamp = clock.getTime()
+        frame_deadline = schedule_event('manipulation', relax_phase_duration)
+        frameN = 0
+        while continue_frame_loop(frameN, number_of_frames, frame_deadline):
             draw_ball(relax_ball_color)
-            mywin.flip()
+            flip_window()
+            # Start of the manipulation phase is the first flip:
+            if frameN == 0:
+                timestamp = clock.getTime()
+            frameN += 1
 
     actual_manipulation_duration = round(clock.getTime()-timestamp,3)
     print(which_phase + " duration: ", actual_manipulation_duration)
     logging.info(' ' f'{which_phase}' ' DURATION: ' f'{actual_manipulation_duration}')
     return actual_manipulation_duration
 
+# Data quality gate: each trial is scored from the fractions of its ISI with gaze data and with gaze offset.
+# Without repeat_failed_trials no trial is scored, the trial data has no quality columns.
+trial_gate = {'passed': True, 'repetition': False}
+
+def score_trial_quality(handler, fixcross_duration, offset_duration, nodata_duration):
+    if not repeat_failed_trials:
+        return
+    valid_fraction = 1 - nodata_duration/fixcross_duration if fixcross_duration > 0 else 0
+    offset_fraction = offset_duration/fixcross_duration if fixcross_duration > 0 else 0
+    trial_gate['passed'] = bool(valid_fraction >= min_valid_fraction and offset_fraction <= max_offset_fraction)
+    handler.addData('trial_valid_fraction', round(valid_fraction,3))
+    handler.addData('trial_offset_fraction', round(offset_fraction,3))
+    handler.addData('trial_quality_passed', trial_gate['passed'])
+    handler.addData('trial_repetition', trial_gate['repetition'])
+    if not trial_gate['passed']:
+        print('warning: trial failed data quality gate')
+        logging.warning(' TRIAL FAILED DATA QUALITY GATE: VALID ' f'{round(valid_fraction,3)}' ' OFFSET ' f'{round(offset_fraction,3)}')
+
+# Iterate over a trial handler. A failed trial is inserted again at a random position of the remaining trials,
+# thus every condition of the block gets its number of clean trials and the stimulus ratio is kept.
+# Yields the condition and the handler for its data: the trial handler for regular trials, the experiment handler
+# for repetitions (they run between two iterations, trial handler data would overwrite the cell of the last trial).
+# The loop columns of a repetition row (e.g. trials.thisN) still belong to the last regular trial,
+# thus repetitions get the number and condition of the failed trial as repetition_of and repetition_condition:
+def gated_trials(handler):
+    trial_repetitions = TrialRepetitions(trial_repetition_budget)
+    for condition in handler:
+        trial_number = handler.thisN
+        trial_gate['repetition'] = False
+        trial_gate['passed'] = True
+        yield condition, handler
+        while True:
+            if repeat_failed_trials and not trial_gate['passed'] and trial_repetitions.schedule(condition, trial_number, handler.nRemaining):
+                print('trial is repeated later: ' + str(condition) + ', repetitions left: ' + str(trial_repetitions.repetitions_left))
+                logging.info(' TRIAL IS REPEATED LATER: ' f'{condition}' ', REPETITIONS LEFT: ' f'{trial_repetitions.repetitions_left}')
+            due_repetition = trial_repetitions.pop_due(handler.nRemaining)
+            if due_repetition is None:
+                break
+            [condition, trial_number] = due_repetition
+            trial_gate['repetition'] = True
+            trial_gate['passed'] = True
+            exp.addData('repetition_of', trial_number)
+            exp.addData('repetition_condition', condition)
+            yield condition, exp
+
 '''EXPERIMENTAL DESIGN'''
 # The trial handler calls the sequence and displays it randomized.
 # Loop of block is added to experiment handler.
@@ -645,11 +1293,30 @@ baseline_trial_counter = 1
 oddball_trial_counter = 1 # trials in oddball_blocks
 standard_trial_counter = 1 #trials in oddball_blocks
 
+# Build stimuli before the first frame loop:
+warm_up_stimulus_cache()
+
+# Session start time for deadline scheduling:
+start_session_schedule()
+# Tracker calls are counted from here on:
+reset_tracker_calls()
+
+# Timer thread for asynchronous trigger pulses:
+start_trigger_pulse_thread()
+start_gaze_polling_thread()
+
 # Send trigger:
 send_trigger('experiment_start')
 
 for phase in phase_handler:
+    # Write trigger log of last block:
+    flush_trigger_log()
+    # Trial data of last block to disk:
+    if trial_writer is not None:
+        trial_writer.sync()
     block_counter += 1
+    # Console output is turned off except for instructions in quiet mode:
+    task_log.set_quiet(quiet_console and not phase.startswith('instruction'))
 
     if phase == 'instruction1':
         text_1 = "Das Experiment beginnt jetzt.\nBitte bleibe still sitzen und\nschaue auf das Kreuz in der Mitte.\n\n Weiter mit der Leertaste."
@@ -658,7 +1325,7 @@ for phase in phase_handler:
         draw_instruction(text = text_1)
         mywin.flip()
         keys = event.waitKeys(keyList = ["space"])
-        exp.nextEntry()
+        next_entry()
 
     if phase == 'instruction2':
         text_2 = "Beim blauen Kreis drücke bitte das\nKraftmessgerät so fest du kannst.\nWährend des gelben Kreises\nkannst deine Hand entspanen.\n\nMit der Leertaste geht es weiter."
@@ -699,16 +1366,19 @@ for phase in phase_handler:
         for standard in standards:
             send_trigger('trial')
             ISI = define_ISI_interval()
+            log_event('trial_start', phase = phase, trial = standard, ISI = ISI)
             timestamp = time.time()
             timestamp_exp = core.getTime()
-            timestamp_tracker = tracker.trackerTime()
+            timestamp_tracker = get_tracker_time()
             print('NEW TRIAL')
             logging.info(' NEW TRIAL')
             print("ISI: ", ISI)
             logging.info(' ISI: ' f'{ISI}')
-            print("gaze position: ",tracker.getPosition())
-            logging.info(' GAZE POSITION: ' f'{tracker.getPosition()}')
+            gaze_position = get_gaze_position()
+            print("gaze position: ",gaze_position)
+            logging.info(' GAZE POSITION: ' f'{gaze_position}')
             # Stimulus presentation:
+            reset_frame_timing()
             actual_stimulus_duration = present_stimulus(stimulus_duration_in_seconds, trial = standard)
             send_trigger('ISI')
             [fixcross_duration, offset_duration, pause_duration, nodata_duration] = fixcross_gazecontingent(ISI)
@@ -723,6 +1393,12 @@ for phase in phase_handler:
             trials.addData('stimulus_duration', actual_stimulus_duration)
             trials.addData('ISI_expected', ISI)
             trials.addData('ISI_duration', fixcross_duration)
+            add_frame_timing_data(trials)
+            add_schedule_data(trials)
+            add_trigger_flip_data(trials)
+            add_tracker_call_data(trials)
+            add_gaze_quality_data(trials)
+            add_pupil_response_data(trials)
             trials.addData('gaze_offset_duration', offset_duration)
             trials.addData('trial_pause_duration', pause_duration)
             trials.addData('trial_nodata_duration', nodata_duration)
@@ -731,47 +1407,57 @@ for phase in phase_handler:
             trials.addData('timestamp_tracker', timestamp_tracker)
             
             standard_trial_counter += 1
-            exp.nextEntry()
+            next_entry()
 
         # Continuing counting after 3 standard trials...
         oddball_trial_counter = standard_trial_counter
 
-        for trial in trials:
+        for [trial, trial_data] in gated_trials(trials):
             send_trigger('trial')
             ISI = define_ISI_interval() 
+            log_event('trial_start', phase = phase, trial = trial, ISI = ISI)
             timestamp = time.time() 
             timestamp_exp = core.getTime() 
-            timestamp_tracker = tracker.trackerTime()
+            timestamp_tracker = get_tracker_time()
             print('NEW TRIAL')
             logging.info(' NEW TRIAL')
             print("ISI: ",ISI)
             logging.info(' ISI: ' f'{ISI}')
-            print("gaze position: ",tracker.getPosition())
-            logging.info(' GAZE POSITION: ' f'{tracker.getPosition()}')
+            gaze_position = get_gaze_position()
+            print("gaze position: ",gaze_position)
+            logging.info(' GAZE POSITION: ' f'{gaze_position}')
             # Stimulus presentation:
+            reset_frame_timing()
             actual_stimulus_duration = present_stimulus(stimulus_duration_in_seconds, trial)
             send_trigger('ISI')
             [fixcross_duration, offset_duration, pause_duration, nodata_duration] = fixcross_gazecontingent(ISI)
+            score_trial_quality(trial_data, fixcross_duration, offset_duration, nodata_duration)
 
             # Save data in .csv file:
             # Information about each phase:
             phase_handler.addData('phase', phase)
             phase_handler.addData('block_counter', block_counter)
             # Information about each trial:
-            trials.addData('oddball_trial_counter',oddball_trial_counter) 
-            trials.addData('trial', trial) 
-            trials.addData('timestamp', timestamp) #seconds since 01.01.1970 (epoch)
-            trials.addData('timestamp_exp', timestamp_exp) 
-            trials.addData('timestamp_tracker', timestamp_tracker) 
-            trials.addData('stimulus_duration', actual_stimulus_duration)
-            trials.addData('ISI_expected', ISI)
-            trials.addData('ISI_duration', fixcross_duration)
-            trials.addData('gaze_offset_duration', offset_duration)
-            trials.addData('trial_pause_duration', pause_duration)
-            trials.addData('trial_nodata_duration', nodata_duration)
+            trial_data.addData('oddball_trial_counter',oddball_trial_counter) 
+            trial_data.addData('trial', trial) 
+            trial_data.addData('timestamp', timestamp) #seconds since 01.01.1970 (epoch)
+            trial_data.addData('timestamp_exp', timestamp_exp) 
+            trial_data.addData('timestamp_tracker', timestamp_tracker) 
+            trial_data.addData('stimulus_duration', actual_stimulus_duration)
+            trial_data.addData('ISI_expected', ISI)
+            trial_data.addData('ISI_duration', fixcross_duration)
+            add_frame_timing_data(trial_data)
+            add_schedule_data(trial_data)
+            add_trigger_flip_data(trial_data)
+            add_tracker_call_data(trial_data)
+            add_gaze_quality_data(trial_data)
+            add_pupil_response_data(trial_data)
+            trial_data.addData('gaze_offset_duration', offset_duration)
+            trial_data.addData('trial_pause_duration', pause_duration)
+            trial_data.addData('trial_nodata_duration', nodata_duration)
 
             oddball_trial_counter += 1
-            exp.nextEntry()
+            next_entry()
 
     if phase == 'oddball_block_rev':
         # Sequence for trial handler with 1/5 chance for an oddball.
@@ -795,16 +1481,19 @@ for phase in phase_handler:
         for standard in standards:
             send_trigger('trial')
             ISI = define_ISI_interval()
+            log_event('trial_start', phase = phase, trial = standard, ISI = ISI)
             timestamp = time.time()
             timestamp_exp = core.getTime()
-            timestamp_tracker = tracker.trackerTime()
+            timestamp_tracker = get_tracker_time()
             print('NEW TRIAL')
             logging.info(' NEW TRIAL')
             print("ISI: ", ISI)
             logging.info(' ISI: ' f'{ISI}')
-            print("gaze position: ",tracker.getPosition())
-            logging.info(' GAZE POSITION: ' f'{tracker.getPosition()}')
+            gaze_position = get_gaze_position()
+            print("gaze position: ",gaze_position)
+            logging.info(' GAZE POSITION: ' f'{gaze_position}')
             # Stimulus presentation:
+            reset_frame_timing()
             actual_stimulus_duration = present_stimulus(stimulus_duration_in_seconds, trial = standard)
             send_trigger('ISI')
             [fixcross_duration, offset_duration, pause_duration, nodata_duration] = fixcross_gazecontingent(ISI)
@@ -819,6 +1508,12 @@ for phase in phase_handler:
             trials.addData('stimulus_duration', actual_stimulus_duration)
             trials.addData('ISI_expected', ISI)
             trials.addData('ISI_duration', fixcross_duration)
+            add_frame_timing_data(trials)
+            add_schedule_data(trials)
+            add_trigger_flip_data(trials)
+            add_tracker_call_data(trials)
+            add_gaze_quality_data(trials)
+            add_pupil_response_data(trials)
             trials.addData('gaze_offset_duration', offset_duration)
             trials.addData('trial_pause_duration', pause_duration)
             trials.addData('trial_nodata_duration', nodata_duration)
@@ -827,46 +1522,56 @@ for phase in phase_handler:
             trials.addData('timestamp_tracker', timestamp_tracker)
 
             standard_trial_counter += 1
-            exp.nextEntry()
+            next_entry()
         
         # Continuing counting after last standard_block...
         oddball_trial_counter = standard_trial_counter
-        for trial in trials:
+        for [trial, trial_data] in gated_trials(trials):
             send_trigger('trial')
             ISI = define_ISI_interval() 
+            log_event('trial_start', phase = phase, trial = trial, ISI = ISI)
             timestamp = time.time() 
             timestamp_exp = core.getTime() 
-            timestamp_tracker = tracker.trackerTime()
+            timestamp_tracker = get_tracker_time()
             print('NEW TRIAL')
             logging.info(' NEW TRIAL')
             print("ISI: ",ISI)
             logging.info(' ISI: ' f'{ISI}')
-            print("gaze position: ",tracker.getPosition())
-            logging.info(' ISI: ' f'{tracker.getPosition()}')
+            gaze_position = get_gaze_position()
+            print("gaze position: ",gaze_position)
+            logging.info(' ISI: ' f'{gaze_position}')
             # Stimulus presentation:
+            reset_frame_timing()
             actual_stimulus_duration = present_stimulus(stimulus_duration_in_seconds,trial)
             send_trigger('ISI')
             [fixcross_duration, offset_duration, pause_duration, nodata_duration] = fixcross_gazecontingent(ISI)
+            score_trial_quality(trial_data, fixcross_duration, offset_duration, nodata_duration)
 
             # Save data in .csv file:
             # Information about each phase:
             phase_handler.addData('phase', phase)
             phase_handler.addData('block_counter', block_counter)
             # Infrmation about each trial:
-            trials.addData('oddball_trial_counter',oddball_trial_counter) 
-            trials.addData('trial', trial) 
-            trials.addData('timestamp', timestamp) 
-            trials.addData('timestamp_exp', timestamp_exp) 
-            trials.addData('timestamp_tracker', timestamp_tracker) 
-            trials.addData('stimulus_duration', actual_stimulus_duration)
-            trials.addData('ISI_expected', ISI)
-            trials.addData('ISI_duration', fixcross_duration)
-            trials.addData('gaze_offset_duration', offset_duration)
-            trials.addData('trial_pause_duration', pause_duration)
-            trials.addData('trial_nodata_duration', nodata_duration)
+            trial_data.addData('oddball_trial_counter',oddball_trial_counter) 
+            trial_data.addData('trial', trial) 
+            trial_data.addData('timestamp', timestamp) 
+            trial_data.addData('timestamp_exp', timestamp_exp) 
+            trial_data.addData('timestamp_tracker', timestamp_tracker) 
+            trial_data.addData('stimulus_duration', actual_stimulus_duration)
+            trial_data.addData('ISI_expected', ISI)
+            trial_data.addData('ISI_duration', fixcross_duration)
+            add_frame_timing_data(trial_data)
+            add_schedule_data(trial_data)
+            add_trigger_flip_data(trial_data)
+            add_tracker_call_data(trial_data)
+            add_gaze_quality_data(trial_data)
+            add_pupil_response_data(trial_data)
+            trial_data.addData('gaze_offset_duration', offset_duration)
+            trial_data.addData('trial_pause_duration', pause_duration)
+            trial_data.addData('trial_nodata_duration', nodata_duration)
 
             oddball_trial_counter += 1
-            exp.nextEntry() 
+            next_entry() 
 
     if phase == 'manipulation_block':
         # Setup experimental manipulation:
@@ -886,20 +1591,35 @@ for phase in phase_handler:
             # Baseline presentation: Fixation_cross for 10 seconds to determine tonic pupil size.
             if manipulation == 'baseline':
                 send_trigger('baseline')
+                reset_frame_timing()
                 [stimulus_duration, offset_duration, pause_duration, nodata_duration] = fixcross_gazecontingent(baseline_duration)
                 # Save data in .csv file:
                 exp_manipulations.addData('stimulus_duration', stimulus_duration)
+                add_frame_timing_data(exp_manipulations)
+                add_schedule_data(exp_manipulations)
+                add_trigger_flip_data(exp_manipulations)
+                add_tracker_call_data(exp_manipulations)
+                add_gaze_quality_data(exp_manipulations)
+                add_pupil_response_data(exp_manipulations)
                 exp_manipulations.addData('gaze_offset_duration', offset_duration)
                 exp_manipulations.addData('trial_pause_duration', pause_duration)
                 exp_manipulations.addData('trial_nodata_duration', nodata_duration)
             # Manipulation relax: Yellow ball.
             if manipulation == 'relax':
                 send_trigger('manipulation_relax')
+                reset_frame_timing()
                 actual_manipulation_duration = present_ball(manipulation)
                 exp_manipulations.addData('stimulus_duration', actual_manipulation_duration)
+                add_frame_timing_data(exp_manipulations)
+                add_schedule_data(exp_manipulations)
+                add_trigger_flip_data(exp_manipulations)
+                add_tracker_call_data(exp_manipulations)
+                add_gaze_quality_data(exp_manipulations)
+                add_pupil_response_data(exp_manipulations)
             # Manipulation squeeze: Blue ball.
             if manipulation == 'squeeze':
                 send_trigger('manipulation_squeeze')
+                reset_frame_timing()
                 actual_manipulation_duration = present_ball(manipulation)
                 text_strength = 'Gleich geht es weiter...'
                 draw_instruction(text = text_strength)
@@ -916,6 +1636,12 @@ for phase in phase_handler:
                 dlg.addText('Fast input! - do not delay experiment')
                 # Save data from manipulation phase in .csv file:
                 exp_manipulations.addData('stimulus_duration', actual_manipulation_duration)
+                add_frame_timing_data(exp_manipulations)
+                add_schedule_data(exp_manipulations)
+                add_trigger_flip_data(exp_manipulations)
+                add_tracker_call_data(exp_manipulations)
+                add_gaze_quality_data(exp_manipulations)
+                add_pupil_response_data(exp_manipulations)
                 exp_manipulations.addData('effort_rating', grip_info['effort_rating'])
                 exp_manipulations.addData('grip_strength', grip_info['grip_strength'])
 
@@ -930,14 +1656,16 @@ for phase in phase_handler:
             exp_manipulations.addData('timestamp_exp', timestamp_exp)
 
             manipulation_trial_counter += 1
-            exp.nextEntry()
+            next_entry()
 
     if phase == 'baseline':
         send_trigger('baseline')
+        print_pupil_summary()
         print('START OF BASELINE PHASE')
         logging.info(' START OF BASELINE PHASE')
         timestamp = time.time() 
         timestamp_exp = core.getTime() 
+        reset_frame_timing()
         [stimulus_duration, offset_duration, pause_duration, nodata_duration] = fixcross_gazecontingent(baseline_duration)
 
         # Save data in .csv file:
@@ -946,6 +1674,12 @@ for phase in phase_handler:
         phase_handler.addData('block_counter', block_counter)
         # Information about each trial:
         phase_handler.addData('stimulus_duration', stimulus_duration)
+        add_frame_timing_data(phase_handler)
+        add_schedule_data(phase_handler)
+        add_trigger_flip_data(phase_handler)
+        add_tracker_call_data(phase_handler)
+        add_gaze_quality_data(phase_handler)
+        add_pupil_response_data(phase_handler)
         phase_handler.addData('gaze_offset_duration', offset_duration)
         phase_handler.addData('trial_pause_duration', pause_duration)
         phase_handler.addData('trial_nodata_duration', nodata_duration)
@@ -955,7 +1689,7 @@ for phase in phase_handler:
         phase_handler.addData('timestamp_exp', timestamp_exp)
 
         baseline_trial_counter += 1
-        exp.nextEntry()
+        next_entry()
 
     # During calibration process, pupil dilation (black slide) and
     # pupil constriction (white slide) are assessed.
@@ -974,6 +1708,7 @@ for phase in phase_handler:
                 timestamp = time.time() 
                 timestamp_exp = core.getTime()
                 send_trigger('baseline')
+                reset_frame_timing()
                 [stimulus_duration, offset_duration, pause_duration, nodata_duration] = fixcross_gazecontingent(baseline_duration)
 
                 # Save data in .csv file:
@@ -982,6 +1717,12 @@ for phase in phase_handler:
                 phase_handler.addData('block_counter', block_counter)
                 # Information about each trial:
                 phase_handler.addData('stimulus_duration', stimulus_duration)
+                add_frame_timing_data(phase_handler)
+                add_schedule_data(phase_handler)
+                add_trigger_flip_data(phase_handler)
+                add_tracker_call_data(phase_handler)
+                add_gaze_quality_data(phase_handler)
+                add_pupil_response_data(phase_handler)
                 phase_handler.addData('gaze_offset_duration', offset_duration)
                 phase_handler.addData('trial_pause_duration', pause_duration)
                 phase_handler.addData('trial_nodata_duration', nodata_duration)
@@ -991,12 +1732,13 @@ for phase in phase_handler:
                 phase_handler.addData('timestamp_exp', timestamp_exp)
 
                 baseline_trial_counter += 1
-                exp.nextEntry()
+                next_entry()
             # Present baseline with white background:
             if baseline_trial == 'baseline_whiteslide':
                 timestamp = time.time() 
                 timestamp_exp = core.getTime()
                 send_trigger('baseline_whiteslide')
+                reset_frame_timing()
                 [stimulus_duration, offset_duration, pause_duration, nodata_duration] = fixcross_gazecontingent(baseline_duration, background_color = white_slide)
 
                 # Save data in .csv file:
@@ -1005,6 +1747,12 @@ for phase in phase_handler:
                 phase_handler.addData('block_counter', block_counter)
                 # Information about each trial:
                 phase_handler.addData('stimulus_duration', stimulus_duration)
+                add_frame_timing_data(phase_handler)
+                add_schedule_data(phase_handler)
+                add_trigger_flip_data(phase_handler)
+                add_tracker_call_data(phase_handler)
+                add_gaze_quality_data(phase_handler)
+                add_pupil_response_data(phase_handler)
                 phase_handler.addData('gaze_offset_duration', offset_duration)
                 phase_handler.addData('trial_pause_duration', pause_duration)
                 phase_handler.addData('trial_nodata_duration', nodata_duration)
@@ -1013,13 +1761,14 @@ for phase in phase_handler:
                 phase_handler.addData('timestamp', timestamp)
                 phase_handler.addData('timestamp_exp', timestamp_exp)
 
-                exp.nextEntry()
+                next_entry()
 
             if baseline_trial == 'baseline_blackslide':
                 timestamp = time.time() 
                 timestamp_exp = core.getTime()
                 # Present baseline with black background:
                 send_trigger('baseline_blackslide')
+                reset_frame_timing()
                 [stimulus_duration, offset_duration, pause_duration, nodata_duration] = fixcross_gazecontingent(baseline_duration, background_color = black_slide, cross_color = 'grey')
 
                 # Save data in .csv file:
@@ -1028,6 +1777,12 @@ for phase in phase_handler:
                 phase_handler.addData('block_counter', block_counter)
                 # Information about each trial:
                 phase_handler.addData('stimulus_duration', stimulus_duration)
+                add_frame_timing_data(phase_handler)
+                add_schedule_data(phase_handler)
+                add_trigger_flip_data(phase_handler)
+                add_tracker_call_data(phase_handler)
+                add_gaze_quality_data(phase_handler)
+                add_pupil_response_data(phase_handler)
                 phase_handler.addData('gaze_offset_duration', offset_duration)
                 phase_handler.addData('trial_pause_duration', pause_duration)
                 phase_handler.addData('trial_nodata_duration', nodata_duration)
@@ -1036,18 +1791,32 @@ for phase in phase_handler:
                 phase_handler.addData('timestamp', timestamp)
                 phase_handler.addData('timestamp_exp', timestamp_exp)
 
-                exp.nextEntry()
+                next_entry()
 
 
 '''WRAP UP AND CLOSE'''
 # Send trigger that experiment has ended:
 send_trigger('experiment_end')
+wait_for_trigger_pulses()
+flush_trigger_log()
+if not testmode:
+    port.close()
 print('EXPERIMENT ENDED')
 logging.info(' EXPERIMENT ENDED.')
+# Stop gaze polling thread and save its latency histogram:
+stop_gaze_polling_thread()
+# Close in-process gaze acquisition and HDF5 file:
+if gaze_stream is not None:
+    gaze_stream.close()
+# Close crash-safe trial data:
+if trial_writer is not None:
+    trial_writer.close()
 # Close reading from eyetracker:
 tracker.setRecordingState(False)
 # Close iohub instance:
 io.quit()
 # Close window:
 mywin.close()
+# Write all queued log records:
+task_log.stop()
 core.quit()
\ No newline at end of file
@@ -0,0 +1,63 @@
+'''DEADLINE SCHEDULER'''
+# Deadline scheduler of both tasks (deadline_scheduling = True). For further information see README.md.
+
+'''EVENT SCHEDULE'''
+# Timed events are planned back-to-back from the session start time. Each event ends on its
+# planned flip deadline, thus late flips shorten the current event instead of delaying all following events.
+# All times are flip times of the window (seconds), onsets are returned relative to the session start time.
+class DeadlineScheduler:
+    def __init__(self, window, refresh_rate, resync_cutoff = 0.5):
+        self.window = window
+        self.refresh_rate = refresh_rate
+        # The schedule is restarted if the next flip is later than the planned onset by more than resync_cutoff (untimed phases):
+        self.resync_cutoff = resync_cutoff
+        self.session_start_time = None
+        self.next_event_onset = None
+        # Event that starts at the next flip, see register_onset():
+        self.pending_event = None
+        # Planned and achieved onsets of all events since the last call of pop_onsets():
+        self.events = dict()
+
+    # Define session start time at the next flip:
+    def start(self):
+        self.session_start_time = self.window.getFutureFlipTime()
+        self.next_event_onset = self.session_start_time
+        return self.session_start_time
+
+    # Plan onset of an event, returns the flip deadline at which the event ends:
+    def schedule(self, event_name, duration):
+        next_flip = self.window.getFutureFlipTime()
+        if self.next_event_onset is None or next_flip - self.next_event_onset > self.resync_cutoff:
+            self.next_event_onset = next_flip
+        planned_onset = self.next_event_onset
+        self.next_event_onset = planned_onset + duration
+        self.events[event_name] = [planned_onset, None]
+        self.pending_event = event_name
+        return self.next_event_onset
+
+    # Shift end of the current event, e.g. by pauses and gaze contingent phases:
+    def extend(self, duration):
+        self.next_event_onset += duration
+
+    # Store the flip timestamp as achieved onset of the pending event, returns event name, planned and achieved onset:
+    def register_onset(self, flip_time):
+        event_name = self.pending_event
+        self.events[event_name][1] = flip_time
+        self.pending_event = None
+        planned_onset = self.events[event_name][0]
+        return [event_name, planned_onset - self.session_start_time, flip_time - self.session_start_time]
+
+    # Check if a frame loop continues, the deadline is shifted by delay (e.g. gaze contingent delays and pauses).
+    # At least one frame is presented, afterwards until the next flip reaches the deadline:
+    def continue_loop(self, frameN, frame_deadline, delay = 0):
+        return frameN == 0 or self.window.getFutureFlipTime() < frame_deadline + delay - self.refresh_rate/2
+
+    # Planned and achieved onsets (None if not presented yet) of all events since the last call:
+    def pop_onsets(self):
+        onsets = dict()
+        for event_name, [planned_onset, achieved_onset] in self.events.items():
+            if achieved_onset is not None:
+                achieved_onset -= self.session_start_time
+            onsets[event_name] = [planned_onset - self.session_start_time, achieved_onset]
+        self.events.clear()
+        return onsets
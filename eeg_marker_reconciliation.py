@@ -0,0 +1,250 @@
+'''EEG MARKER RECONCILIATION'''
+# Checks offline that every trigger sent by a task arrived at the EEG recorder.
+# Markers of a BrainVision .vmrk file are matched to the trigger log of the session (see README.md),
+# missing, extra and merged triggers as well as the residuals of the fitted clock model are reported.
+# Usage: python eeg_marker_reconciliation.py <study folder> [--workers N]
+# The study folder contains the task folders, e.g. data/visual_oddball/trialdata and data/visual_oddball/eeg.
+
+'''LOAD MODULES'''
+import argparse, csv, os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy
+# Trigger log format of both tasks:
+from trigger_backends import trigger_log_dtype
+
+'''SETUP'''
+task_folders = ['visual_oddball', 'auditory_oddball']
+# Triggers at the start of each trial, used to check trials of the trial data file:
+trial_trigger_names = [b'trial', b'practice_trial']
+# Used if no .vhdr header file is found, in Hz:
+default_sampling_rate = 1000
+# A marker is matched to a trigger of the same value within this time window, in seconds:
+matching_tolerance = 0.02
+# Triggers closer than pulse duration + minimum gap may merge at the recorder, in seconds:
+merge_window = 0.03
+# Number of first triggers and markers used to find the initial clock offset:
+initial_alignment_events = 500
+offset_resolution = 0.001
+residual_percentiles = [5, 50, 95, 100]
+
+'''FUNCTIONS'''
+# Read stimulus markers of a BrainVision marker file, returns marker positions (in samples) and values:
+def read_vmrk(vmrk_filename):
+    positions = list()
+    marker_values = list()
+    with open(vmrk_filename, encoding = 'utf-8', errors = 'replace') as vmrk_file:
+        for line in vmrk_file:
+            # Marker line: Mk<n>=<type>,<description>,<position>,<size>,<channel>
+            if not line.startswith('Mk'):
+                continue
+            fields = line.split('=', 1)[1].split(',')
+            if fields[0] != 'Stimulus' or not fields[1].strip().startswith('S'):
+                continue
+            marker_values.append(int(fields[1].strip()[1:]))
+            positions.append(int(fields[2]))
+    return [numpy.array(positions), numpy.array(marker_values, dtype = int)]
+
+# Sampling rate from .vhdr header file next to the marker file:
+def read_sampling_rate(vmrk_filename):
+    vhdr_filename = Path(vmrk_filename).with_suffix('.vhdr')
+    if vhdr_filename.exists():
+        with open(vhdr_filename, encoding = 'utf-8', errors = 'replace') as vhdr_file:
+            for line in vhdr_file:
+                # Sampling interval in microseconds:
+                if line.startswith('SamplingInterval='):
+                    return 1e6 / float(line.split('=')[1])
+    return default_sampling_rate
+
+# Find the clock offset between trigger log and EEG recording:
+# The most frequent time difference between triggers and markers of the same value is used.
+def initial_clock_offset(trigger_times, trigger_values, marker_times, marker_values):
+    n_triggers = min(initial_alignment_events, len(trigger_times))
+    n_markers = min(initial_alignment_events, len(marker_times))
+    time_differences = marker_times[:n_markers, None] - trigger_times[None, :n_triggers]
+    same_value = marker_values[:n_markers, None] == trigger_values[None, :n_triggers]
+    offset_bins = numpy.round(time_differences[same_value] / offset_resolution)
+    if len(offset_bins) == 0:
+        return None
+    (bins, counts) = numpy.unique(offset_bins, return_counts = True)
+    return bins[numpy.argmax(counts)] * offset_resolution
+
+# Match each trigger to the closest marker of the same value within the matching tolerance.
+# Returns marker index for each trigger, -1 = no marker.
+def match_markers(predicted_times, trigger_values, marker_times, marker_values):
+    if len(marker_times) == 0:
+        return numpy.full(len(trigger_values), -1)
+    right = numpy.clip(numpy.searchsorted(marker_times, predicted_times), 0, len(marker_times) - 1)
+    left = numpy.clip(right - 1, 0, len(marker_times) - 1)
+    candidates = numpy.stack([left, right])
+    distances = numpy.abs(marker_times[candidates] - predicted_times[None, :])
+    valid = (marker_values[candidates] == trigger_values[None, :]) & (distances <= matching_tolerance)
+    distances = numpy.where(valid, distances, numpy.inf)
+    best = numpy.argmin(distances, axis = 0)
+    matched_markers = numpy.where(numpy.isfinite(distances.min(axis = 0)), candidates[best, numpy.arange(len(best))], -1)
+    # A marker is only assigned to its closest trigger:
+    matched = numpy.flatnonzero(matched_markers >= 0)
+    match_distances = distances[best[matched], matched]
+    order = numpy.lexsort((match_distances, matched_markers[matched]))
+    (assigned_markers, first) = numpy.unique(matched_markers[matched][order], return_index = True)
+    keep = numpy.zeros(len(trigger_values), dtype = bool)
+    keep[matched[order][first]] = True
+    matched_markers[~keep] = -1
+    return matched_markers
+
+# Count trials of the trial data file (rows with an ISI):
+def count_csv_trials(trials_filename):
+    if not Path(trials_filename).exists():
+        return None
+    with open(trials_filename, newline = '', encoding = 'utf-8', errors = 'replace') as trials_file:
+        return sum(1 for row in csv.DictReader(trials_file) if row.get('ISI_expected'))
+
+# Reconcile one session, returns summary and table of all triggers:
+def reconcile_session(session):
+    [session_name, trigger_log_filename, trials_filename, vmrk_filename] = session
+    summary = {'session': session_name, 'vmrk_file': str(vmrk_filename)}
+    trigger_log = numpy.fromfile(trigger_log_filename, dtype = trigger_log_dtype)
+    trigger_values = trigger_log['trigger_value'].astype(int)
+    trigger_times = trigger_log['time_exp']
+    [positions, marker_values] = read_vmrk(vmrk_filename)
+    marker_times = (positions - 1) / read_sampling_rate(vmrk_filename)
+    order = numpy.argsort(marker_times, kind = 'stable')
+    marker_times = marker_times[order]
+    marker_values = marker_values[order]
+    summary['triggers'] = len(trigger_values)
+    summary['markers'] = len(marker_values)
+
+    # Clock model: marker time = slope * trigger time + offset, refined with matched pairs.
+    offset = initial_clock_offset(trigger_times, trigger_values, marker_times, marker_values)
+    matched_markers = numpy.full(len(trigger_values), -1)
+    slope = 1.0
+    if offset is not None:
+        for iteration in range(3):
+            matched_markers = match_markers(slope * trigger_times + offset, trigger_values, marker_times, marker_values)
+            matched = matched_markers >= 0
+            if numpy.count_nonzero(matched) < 2:
+                break
+            (slope, offset) = numpy.polyfit(trigger_times[matched], marker_times[matched_markers[matched]], 1)
+    matched = matched_markers >= 0
+    # Without offset (no stimulus markers or no marker with the value of a trigger) all triggers are missing:
+    if offset is None:
+        predicted_times = numpy.full(len(trigger_values), numpy.nan)
+    else:
+        predicted_times = slope * trigger_times + offset
+    # Residual of each matched marker to the clock model (fitted on the same matches, thus the median is close to 0):
+    residuals = numpy.full(len(trigger_values), numpy.nan)
+    residuals[matched] = marker_times[matched_markers[matched]] - predicted_times[matched]
+
+    # Missing triggers close to another trigger were merged at the recorder:
+    time_to_previous = numpy.diff(trigger_times, prepend = -numpy.inf)
+    time_to_next = numpy.diff(trigger_times, append = numpy.inf)
+    close_trigger = ((time_to_previous <= merge_window) | (time_to_next <= merge_window)) & (offset is not None)
+    missing = ~matched
+    merged = missing & close_trigger
+    missing = missing & ~close_trigger
+    # Unmatched markers with the combined value (bitwise OR) of two close triggers are merged, too.
+    # With less than two triggers (e.g. aborted session) all unmatched markers are extra:
+    unmatched_markers = numpy.setdiff1d(numpy.arange(len(marker_values)), matched_markers[matched])
+    merged_markers = numpy.zeros(len(unmatched_markers), dtype = bool)
+    if len(trigger_values) >= 2 and offset is not None:
+        nearest = numpy.clip(numpy.searchsorted(predicted_times, marker_times[unmatched_markers]), 1, len(trigger_values) - 1)
+        combined_values = trigger_values[nearest - 1] | trigger_values[nearest]
+        merged_markers = (combined_values == marker_values[unmatched_markers]) & (numpy.abs(marker_times[unmatched_markers] - predicted_times[nearest]) <= merge_window)
+
+    summary['matched'] = int(numpy.count_nonzero(matched))
+    summary['missing'] = int(numpy.count_nonzero(missing))
+    summary['merged'] = int(numpy.count_nonzero(merged))
+    summary['extra'] = int(len(unmatched_markers) - numpy.count_nonzero(merged_markers))
+    summary['clock_offset'] = round(float(offset), 4) if offset is not None else ''
+    summary['clock_drift_ppm'] = round((float(slope) - 1) * 1e6, 2)
+    valid_residuals = residuals[matched] * 1000
+    for percentile in residual_percentiles:
+        summary['fit_residual_p' + str(percentile) + '_ms'] = round(float(numpy.percentile(valid_residuals, percentile)), 3) if len(valid_residuals) else ''
+    trial_triggers = numpy.isin(trigger_log['trigger_name'], trial_trigger_names)
+    summary['trials_csv'] = count_csv_trials(trials_filename)
+    summary['trial_triggers'] = int(numpy.count_nonzero(trial_triggers))
+    summary['trials_with_marker'] = int(numpy.count_nonzero(trial_triggers & matched))
+
+    status = numpy.where(matched, 'matched', numpy.where(merged, 'merged', 'missing'))
+    trigger_table = {
+        'trigger_name': trigger_log['trigger_name'].astype(str),
+        'trigger_value': trigger_values,
+        'time_exp': trigger_times,
+        'marker_time': numpy.where(matched, numpy.append(marker_times, numpy.nan)[matched_markers], numpy.nan),
+        'fit_residual_ms': residuals * 1000,
+        'status': status}
+    return [summary, trigger_table]
+
+# Summary row of a session that could not be reconciled (e.g. truncated trigger log or marker file):
+def error_summary(session, error):
+    [session_name, trigger_log_filename, trials_filename, vmrk_filename] = session
+    return {'session': session_name, 'vmrk_file': str(vmrk_filename), 'error': type(error).__name__ + ': ' + str(error)}
+
+# Find sessions with trigger log and marker file:
+# Marker files have the name of the session (e.g. visual_123_2024-05-01-1030.vmrk), otherwise the subject id is used.
+def find_sessions(study_folder, eeg_folder_name):
+    sessions = list()
+    for task_folder in task_folders:
+        trials_data_folder = Path(study_folder, task_folder, 'trialdata')
+        eeg_folder = Path(study_folder, task_folder, eeg_folder_name)
+        for trigger_log_filename in sorted(trials_data_folder.glob('*_trigger_log.bin')):
+            session_name = trigger_log_filename.name[:-len('_trigger_log.bin')]
+            vmrk_filename = Path(eeg_folder, session_name + '.vmrk')
+            if not vmrk_filename.exists():
+                subject_id = session_name.split('_')[1]
+                vmrk_candidates = sorted(eeg_folder.glob('*' + subject_id + '*.vmrk'))
+                if len(vmrk_candidates) != 1:
+                    print('no unique marker file for session: ' + session_name)
+                    continue
+                vmrk_filename = vmrk_candidates[0]
+            trials_filename = Path(trials_data_folder, session_name + '.csv')
+            sessions.append([session_name, trigger_log_filename, trials_filename, vmrk_filename])
+    return sessions
+
+# Save table of all triggers of a session:
+def write_trigger_table(filename, trigger_table):
+    columns = list(trigger_table.keys())
+    with open(filename, 'w', newline = '') as table_file:
+        writer = csv.writer(table_file)
+        writer.writerow(columns)
+        writer.writerows(zip(*[trigger_table[column] for column in columns]))
+
+'''MAIN'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Match EEG markers (.vmrk) to the trigger logs of the oddball tasks.')
+    parser.add_argument('study_folder', help = 'folder with visual_oddball and auditory_oddball data folders')
+    parser.add_argument('--eeg-folder', default = 'eeg', help = 'name of the marker file folder in each task folder')
+    parser.add_argument('--output', default = None, help = 'output folder, default: <study folder>/marker_reconciliation')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'number of parallel processes')
+    arguments = parser.parse_args()
+
+    output_folder = Path(arguments.output or Path(arguments.study_folder, 'marker_reconciliation'))
+    output_folder.mkdir(parents = True, exist_ok = True)
+    sessions = find_sessions(arguments.study_folder, arguments.eeg_folder)
+    print('sessions found: ' + str(len(sessions)))
+
+    summaries = list()
+    with ProcessPoolExecutor(max_workers = arguments.workers) as executor:
+        futures = [executor.submit(reconcile_session, session) for session in sessions]
+        # Errors are caught per session, so that one damaged session does not stop the others:
+        for session, future in zip(sessions, futures):
+            try:
+                [summary, trigger_table] = future.result()
+            except Exception as error:
+                summaries.append(error_summary(session, error))
+                print('{}: error {}'.format(session[0], summaries[-1]['error']))
+                continue
+            summaries.append(summary)
+            write_trigger_table(Path(output_folder, summary['session'] + '_triggers.csv'), trigger_table)
+            print('{}: matched {}, missing {}, merged {}, extra {}, fit residual p95 {} ms'.format(
+                summary['session'], summary['matched'], summary['missing'], summary['merged'], summary['extra'], summary['fit_residual_p95_ms']))
+
+    if summaries:
+        # Columns of all rows, error rows only have session, vmrk_file and error:
+        fieldnames = list()
+        for summary in summaries:
+            fieldnames += [column for column in summary if column not in fieldnames]
+        with open(Path(output_folder, 'marker_reconciliation.csv'), 'w', newline = '') as summary_file:
+            writer = csv.DictWriter(summary_file, fieldnames = fieldnames, restval = '')
+            writer.writeheader()
+            writer.writerows(summaries)
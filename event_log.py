@@ -0,0 +1,55 @@
+'''EVENT LOG'''
+# Structured event log of both tasks: every event kind has a typed record with fixed fields.
+# All records carry the time of the task clock (core.getTime(), seconds, monotonic).
+# Records are passed through the logging queue of task_logging.py and written as JSON lines
+# by the listener thread. For further information see README.md.
+
+'''LOAD MODULES'''
+import json, logging, collections
+
+'''EVENTS'''
+# Fields of each event kind, in addition to 'event' (kind) and 'time':
+event_fields = {
+    'trial_start': ['phase', 'trial', 'ISI'],
+    'stimulus_onset': ['trial', 'condition'],
+    'isi_result': ['ISI_expected', 'ISI_duration', 'number_of_frames', 'gaze_offset_duration', 'nodata_duration', 'pause_duration'],
+    'pause': ['key', 'pause_duration'],
+    'nodata': ['duration'],
+    'gaze_offset': ['duration'],
+    'trigger': ['trigger_value', 'trigger_name', 'queued'],
+    'response': ['key', 'rt'],
+    }
+event_types = {kind: collections.namedtuple(kind, ['time'] + fields) for kind, fields in event_fields.items()}
+event_logger = logging.getLogger('events')
+event_clock = None # set by open_event_log()
+
+# One JSON object per line, e.g. {"event": "response", "time": 12.345, "key": "space", "rt": 0.412}:
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        event = {'event': type(record.msg).__name__}
+        event.update(record.msg._asdict())
+        return json.dumps(event, default = str)
+
+# Handler for the listener of task_logging.py: task_log.add_handler('events', open_event_log(filename, core.getTime))
+def open_event_log(filename, clock):
+    global event_clock
+    event_clock = clock
+    handler = logging.FileHandler(filename, mode = 'w')
+    handler.setFormatter(JsonLinesFormatter())
+    return handler
+
+# Add an event, time is the task clock at the call if not given (e.g. flip time of a stimulus onset).
+# Missing or unknown fields raise a TypeError. Without an open event log nothing is recorded.
+def log_event(kind, time = None, **fields):
+    if event_clock is None:
+        return
+    if time is None:
+        time = event_clock()
+    event_logger.info(event_types[kind](time = time, **fields))
+
+'''LOADER'''
+# Read the event log of a session into a pandas DataFrame in one pass, one row per event
+# (columns of other event kinds are empty). Times and durations are parsed exactly as written:
+def load_event_log(filename):
+    import pandas
+    return pandas.read_json(filename, lines = True, dtype = False, precise_float = True)
@@ -0,0 +1,353 @@
+'''EYE SAMPLE MERGER'''
+# Attaches trial labels to the eye samples that iohub records in its HDF5 datastore (see README.md).
+# The samples are read in chunks, so memory use does not depend on the length of the recording.
+# Each chunk is merged with the sorted trial start times of the trial data file (timestamp_tracker
+# or timestamp_exp) and the samples within a trial are appended to a per-trial epoch table.
+# Alternatively, an epoch index (sample offsets of every trial, baseline and calibration slide in the datastore)
+# is saved next to the datastore, so that an epoch is a direct slice of the sample table.
+# Usage: python eye_sample_merger.py <study folder> [--clock exp|tracker] [--chunk-size N] [--workers N] [--index]
+# The study folder contains the task folders, e.g. data/visual_oddball/trialdata and data/visual_oddball/eyetracking.
+
+'''LOAD MODULES'''
+import argparse, csv, hashlib, json, os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy
+from trigger_backends import trigger_log_dtype
+
+'''SETUP'''
+task_folders = ['visual_oddball', 'auditory_oddball']
+# Sample tables of iohub, monocular (e.g. mouse in testmode) and binocular (e.g. Tobii):
+sample_tables = [
+    'data_collection/events/eyetracker/BinocularEyeSampleEvent',
+    'data_collection/events/eyetracker/MonocularEyeSampleEvent']
+# Sample fields copied to the epoch table (if present in the table):
+sample_fields = ['gaze_x', 'gaze_y', 'pupil_measure1',
+    'left_gaze_x', 'left_gaze_y', 'left_pupil_measure1',
+    'right_gaze_x', 'right_gaze_y', 'right_pupil_measure1', 'status']
+# Sample time field and trial start column for each clock:
+# 'exp' (default) = time of the task (iohub time = core.getTime(), trial data timestamp_exp), both in seconds.
+# 'tracker' = time of the eye tracker (iohub device_time, trial data timestamp_tracker converted to seconds).
+# device_time is the clock of the eye tracker device, timestamp_tracker is tracker.trackerTime() (Tobii: system clock),
+# thus the trial times are checked against the recorded samples before the tracker clock is used (see check_clock()).
+clock_columns = {'tracker': ['device_time', 'timestamp_tracker'], 'exp': ['time', 'timestamp_exp']}
+default_clock = 'exp'
+# Seconds per unit of timestamp_tracker (tracker.trackerTime()), Tobii: microseconds:
+tracker_time_unit = 0.000001
+# Trial labels copied from the trial data to every sample:
+label_columns = ['phase', 'block_counter', 'trial']
+default_chunk_size = 100000
+# Epoch index: trial counters of the trial data (key of each epoch) and triggers at the onset of each epoch.
+# An onset trigger is used if it was sent within onset_tolerance (seconds) of timestamp_exp of the row.
+counter_columns = ['oddball_trial_counter', 'practice_trial_counter', 'baseline_trial_counter', 'manipulation_trial_counter']
+# Trigger names as sent by the tasks (manipulation phases of the auditory task: manipulation_squeeze, manipulation_relax).
+onset_trigger_names = [b'trial', b'practice_trial', b'baseline', b'baseline_whiteslide', b'baseline_blackslide',
+    b'manipulation_squeeze', b'manipulation_relax']
+onset_tolerance = 0.1
+epoch_index_version = 3
+
+'''FUNCTIONS'''
+# Read the trial data of a session: ExperimentHandler CSV or crash-safe rows (_trials.jsonl, see trial_writer.py):
+def read_trial_rows(trials_filename):
+    with open(trials_filename, newline = '', encoding = 'utf-8', errors = 'replace') as trials_file:
+        if str(trials_filename).endswith('.jsonl'):
+            return [json.loads(line) for line in trials_file if line.strip()]
+        return list(csv.DictReader(trials_file))
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+# Time of a trial data column in seconds:
+def trial_time(row, column):
+    if column == 'timestamp_tracker':
+        return to_float(row.get(column)) * tracker_time_unit
+    return to_float(row.get(column))
+
+# Trials with a start time on the selected clock, sorted by start time.
+# A trial ends after stimulus and ISI (incl. gaze contingent delays), at the latest at the next trial start.
+# Phase rows (e.g. baseline) have no ISI and end after their stimulus duration, as in epoch_times().
+# Rows without any duration end at the next trial start:
+def trial_intervals(trial_rows, start_column):
+    trials = [row for row in trial_rows if not numpy.isnan(trial_time(row, start_column))]
+    trials.sort(key = lambda row: trial_time(row, start_column))
+    starts = numpy.array([trial_time(row, start_column) for row in trials])
+    row_durations = numpy.array([[to_float(row.get('stimulus_duration')), to_float(row.get('ISI_duration'))] for row in trials]).reshape(-1, 2)
+    durations = numpy.where(numpy.isnan(row_durations).all(axis = 1), numpy.nan, numpy.nansum(row_durations, axis = 1))
+    next_starts = numpy.append(starts[1:], numpy.inf)
+    ends = numpy.where(numpy.isnan(durations), next_starts, numpy.minimum(starts + durations, next_starts))
+    labels = [[str(row.get(column, '')) for column in label_columns] for row in trials]
+    return [starts, ends, labels]
+
+# Sample table of the iohub datastore with the most samples:
+def find_sample_table(hdf5_file):
+    tables = [hdf5_file[name] for name in sample_tables if name in hdf5_file]
+    if not tables:
+        return None
+    return max(tables, key = len)
+
+# Trial times on the tracker clock have to lie within the recorded samples, otherwise trial times and sample times
+# are not on the same clock (e.g. Tobii system clock and device clock) and the join would assign no or wrong samples:
+def check_clock(times, sample_table, clock):
+    times = numpy.asarray(times, dtype = float)
+    times = times[~numpy.isnan(times)]
+    if clock != 'tracker' or sample_table is None or len(sample_table) == 0 or len(times) == 0:
+        return
+    time_field = clock_columns[clock][0]
+    first_sample_time = float(sample_table[0][time_field])
+    last_sample_time = float(sample_table[-1][time_field])
+    outside = numpy.count_nonzero((times < first_sample_time) | (times > last_sample_time))
+    if outside > 0:
+        raise ValueError('{} of {} trial times are outside of the eye samples on the tracker clock ({} - {} s), use --clock exp'.format(
+            outside, len(times), round(first_sample_time, 3), round(last_sample_time, 3)))
+
+# Merge one session, writes the epoch table and returns a summary:
+def merge_session(session, output_folder, clock = default_clock, chunk_size = default_chunk_size):
+    import h5py
+    [session_name, trials_filename, hdf5_filename] = session
+    [time_field, start_column] = clock_columns[clock]
+    [starts, ends, labels] = trial_intervals(read_trial_rows(trials_filename), start_column)
+    summary = {'session': session_name, 'trials': len(starts), 'samples': 0, 'samples_in_trials': 0, 'trials_with_samples': 0}
+    trials_with_samples = numpy.zeros(len(starts), dtype = bool)
+
+    with h5py.File(hdf5_filename, 'r') as hdf5_file, open(Path(output_folder, session_name + '_epochs.csv'), 'w', newline = '') as epoch_file:
+        sample_table = find_sample_table(hdf5_file)
+        check_clock(starts, sample_table, clock)
+        fields = [field for field in sample_fields if sample_table is not None and field in sample_table.dtype.names]
+        writer = csv.writer(epoch_file)
+        writer.writerow(['trial_index'] + label_columns + [time_field, 'time_from_trial_start'] + fields)
+        number_of_samples = len(sample_table) if sample_table is not None else 0
+        summary['samples'] = number_of_samples
+        # Samples and trials are both sorted by time: each chunk is joined with searchsorted
+        # (trial that started last before each sample), only one chunk is held in memory.
+        for chunk_start in range(0, number_of_samples, chunk_size):
+            chunk = sample_table[chunk_start:chunk_start + chunk_size]
+            sample_times = chunk[time_field].astype(float)
+            trial_index = numpy.searchsorted(starts, sample_times, side = 'right') - 1
+            in_trial = trial_index >= 0
+            in_trial[in_trial] = sample_times[in_trial] < ends[trial_index[in_trial]]
+            trials_with_samples[trial_index[in_trial]] = True
+            summary['samples_in_trials'] += int(numpy.count_nonzero(in_trial))
+            chunk_times = sample_times[in_trial]
+            chunk_trials = trial_index[in_trial]
+            chunk_values = [chunk[field][in_trial].tolist() for field in fields]
+            writer.writerows(
+                [trial] + labels[trial] + [sample_time, round(sample_time - starts[trial], 6)] + list(values)
+                for (trial, sample_time, *values) in zip(chunk_trials.tolist(), chunk_times.tolist(), *chunk_values))
+    summary['trials_with_samples'] = int(numpy.count_nonzero(trials_with_samples))
+    return summary
+
+def merge_session_task(arguments):
+    return merge_session(*arguments)
+
+# Find sessions with iohub datastore and trial data:
+# The datastore has the name of the session (e.g. eyetracking/visual_123_2024-05-01-1030.hdf5),
+# the trial data file is the ExperimentHandler CSV, otherwise the crash-safe _trials.jsonl.
+def find_sessions(study_folder):
+    sessions = list()
+    for task_folder in task_folders:
+        trials_data_folder = Path(study_folder, task_folder, 'trialdata')
+        eyetracking_data_folder = Path(study_folder, task_folder, 'eyetracking')
+        for hdf5_filename in sorted(eyetracking_data_folder.glob('*.hdf5')):
+            # Gaze streams of gaze_acquisition.py are no iohub datastores:
+            if hdf5_filename.name.endswith('_gaze.hdf5'):
+                continue
+            session_name = hdf5_filename.stem
+            trials_filename = Path(trials_data_folder, session_name + '.csv')
+            if not trials_filename.exists():
+                trials_filename = Path(trials_data_folder, session_name + '_trials.jsonl')
+            if not trials_filename.exists():
+                print('no trial data for session: ' + session_name)
+                continue
+            sessions.append([session_name, trials_filename, hdf5_filename])
+    return sessions
+
+'''EPOCH INDEX'''
+# SHA-256 of a file, read in blocks:
+def file_hash(filename, block_size = 1 << 20):
+    file_digest = hashlib.sha256()
+    with open(filename, 'rb') as source_file:
+        for block in iter(lambda: source_file.read(block_size), b''):
+            file_digest.update(block)
+    return file_digest.hexdigest()
+
+# Hashes of this process: (filename, size, modification time) -> SHA-256, each file version is hashed once:
+file_hashes = dict()
+
+def cached_file_hash(filename):
+    file_stat = os.stat(filename)
+    key = (str(filename), file_stat.st_size, file_stat.st_mtime_ns)
+    if key not in file_hashes:
+        file_hashes[key] = file_hash(filename)
+    return file_hashes[key]
+
+# Hashes of all source files of an index, the index is rebuilt if one of them changes:
+def source_hashes(session):
+    [session_name, trials_filename, hdf5_filename] = session
+    trigger_log_filename = Path(Path(trials_filename).parent, session_name + '_trigger_log.bin')
+    hashes = [cached_file_hash(trials_filename), cached_file_hash(hdf5_filename)]
+    hashes.append(cached_file_hash(trigger_log_filename) if trigger_log_filename.exists() else '')
+    return hashes
+
+# Size and modification time of trial data, datastore and trigger log (order as source_hashes()):
+def source_stats(session):
+    [session_name, trials_filename, hdf5_filename] = session
+    trigger_log_filename = Path(Path(trials_filename).parent, session_name + '_trigger_log.bin')
+    stats = list()
+    for filename in [trials_filename, hdf5_filename, trigger_log_filename]:
+        stats.append('{}:{}'.format(os.stat(filename).st_size, os.stat(filename).st_mtime_ns) if Path(filename).exists() else '')
+    return stats
+
+def epoch_index_filename(session):
+    [session_name, trials_filename, hdf5_filename] = session
+    return Path(Path(hdf5_filename).parent, session_name + '_epoch_index.npz')
+
+# Epochs of all rows with a trial counter: onset from the trigger log (closest onset trigger to timestamp_exp),
+# otherwise from the trial record. The epoch lasts stimulus_duration (+ ISI_duration for trials).
+def epoch_times(trial_rows, trigger_log, clock):
+    onset_triggers = trigger_log[numpy.isin(trigger_log['trigger_name'], onset_trigger_names)]
+    trigger_time_column = 'time_tracker' if clock == 'tracker' else 'time_exp'
+    epochs = list()
+    for row in trial_rows:
+        counter_column = next((column for column in counter_columns if not numpy.isnan(to_float(row.get(column)))), None)
+        timestamp_exp = to_float(row.get('timestamp_exp'))
+        if counter_column is None or numpy.isnan(timestamp_exp):
+            continue
+        onset = trial_time(row, clock_columns[clock][1])
+        if len(onset_triggers):
+            nearest = numpy.argmin(numpy.abs(onset_triggers['time_exp'] - timestamp_exp))
+            if abs(onset_triggers['time_exp'][nearest] - timestamp_exp) <= onset_tolerance:
+                onset = onset_triggers[trigger_time_column][nearest]
+        duration = numpy.nansum([to_float(row.get('stimulus_duration')), to_float(row.get('ISI_duration'))])
+        epochs.append([counter_column, int(to_float(row[counter_column])), str(row.get('trial', '')), str(row.get('phase', '')), onset, onset + duration])
+    return epochs
+
+# Build the epoch index of a session and save it next to the datastore (<session>_epoch_index.npz).
+# Sample offsets are counted chunk by chunk (number of samples before each onset and end time).
+# Returns the number of epochs and the number of epochs without onset (empty epochs):
+def build_epoch_index(session, clock = default_clock, chunk_size = default_chunk_size):
+    import h5py
+    [session_name, trials_filename, hdf5_filename] = session
+    # Taken before the files are read, a file that changes meanwhile is hashed again at the next load:
+    stats = source_stats(session)
+    trigger_log_filename = Path(Path(trials_filename).parent, session_name + '_trigger_log.bin')
+    trigger_log = numpy.fromfile(trigger_log_filename, dtype = trigger_log_dtype) if trigger_log_filename.exists() else numpy.zeros(0, dtype = trigger_log_dtype)
+    epochs = epoch_times(read_trial_rows(trials_filename), trigger_log, clock)
+    start_times = numpy.array([epoch[4] for epoch in epochs], dtype = float)
+    end_times = numpy.array([epoch[5] for epoch in epochs], dtype = float)
+    # Every indexed row needs an onset (onset trigger or trial record on the selected clock):
+    missing_onsets = int(numpy.count_nonzero(numpy.isnan(start_times)))
+    if missing_onsets > 0:
+        print('warning: {}: {} of {} epochs without onset on the {} clock'.format(session_name, missing_onsets, len(epochs), clock))
+    start_offsets = numpy.zeros(len(epochs), dtype = numpy.int64)
+    end_offsets = numpy.zeros(len(epochs), dtype = numpy.int64)
+    with h5py.File(hdf5_filename, 'r') as hdf5_file:
+        sample_table = find_sample_table(hdf5_file)
+        check_clock(start_times, sample_table, clock)
+        sample_table_name = sample_table.name if sample_table is not None else ''
+        number_of_samples = len(sample_table) if sample_table is not None else 0
+        time_field = clock_columns[clock][0]
+        for chunk_start in range(0, number_of_samples, chunk_size):
+            chunk_times = sample_table[chunk_start:chunk_start + chunk_size][time_field].astype(float)
+            start_offsets += numpy.searchsorted(chunk_times, start_times)
+            end_offsets += numpy.searchsorted(chunk_times, end_times)
+    # Epochs without onset time are empty:
+    missing = numpy.isnan(start_times) | numpy.isnan(end_times)
+    start_offsets[missing] = 0
+    end_offsets[missing] = 0
+    numpy.savez(epoch_index_filename(session),
+        version = epoch_index_version,
+        clock = clock,
+        sample_table = sample_table_name,
+        source_stats = numpy.array(stats),
+        source_hashes = numpy.array(source_hashes(session)),
+        counter_column = numpy.array([epoch[0] for epoch in epochs], dtype = str),
+        counter = numpy.array([epoch[1] for epoch in epochs], dtype = numpy.int64),
+        trial = numpy.array([epoch[2] for epoch in epochs], dtype = str),
+        phase = numpy.array([epoch[3] for epoch in epochs], dtype = str),
+        start_time = start_times,
+        end_time = end_times,
+        start_offset = start_offsets,
+        end_offset = end_offsets)
+    return [len(epochs), missing_onsets]
+
+def build_epoch_index_task(arguments):
+    return build_epoch_index(*arguments)
+
+# Load the epoch index of a session, it is (re)built if it is missing, was built with another clock
+# or if the trial data, trigger log or datastore have changed since (size and modification time, otherwise SHA-256).
+# If only the modification time has changed (same hashes), the stored size and modification time are updated.
+# Returns the index arrays and a lookup (counter_column, counter, trial) -> positions in the arrays.
+def load_epoch_index(session, clock = default_clock, chunk_size = default_chunk_size):
+    index_filename = epoch_index_filename(session)
+    epoch_index = None
+    if index_filename.exists():
+        with numpy.load(index_filename) as index_file:
+            epoch_index = {name: index_file[name] for name in index_file.files}
+        if int(epoch_index['version']) != epoch_index_version or str(epoch_index['clock']) != clock:
+            epoch_index = None
+        else:
+            stats = source_stats(session)
+            if list(epoch_index['source_stats']) != stats:
+                if list(epoch_index['source_hashes']) == source_hashes(session):
+                    epoch_index['source_stats'] = numpy.array(stats)
+                    numpy.savez(index_filename, **epoch_index)
+                else:
+                    epoch_index = None
+    if epoch_index is None:
+        build_epoch_index(session, clock, chunk_size)
+        with numpy.load(index_filename) as index_file:
+            epoch_index = {name: index_file[name] for name in index_file.files}
+    lookup = dict()
+    for position, key in enumerate(zip(epoch_index['counter_column'].tolist(), epoch_index['counter'].tolist(), epoch_index['trial'].tolist())):
+        lookup.setdefault(key, list()).append(position)
+    epoch_index['lookup'] = lookup
+    return epoch_index
+
+# Samples of an epoch as a direct slice of the sample table (hdf5_file opened with h5py),
+# e.g. get_epoch(hdf5_file, epoch_index, 'oddball_trial_counter', 12, 'oddball').
+# Repeated trials with the same key are selected with occurrence.
+def get_epoch(hdf5_file, epoch_index, counter_column, counter, trial, occurrence = 0):
+    position = epoch_index['lookup'][(counter_column, counter, trial)][occurrence]
+    sample_table = hdf5_file[str(epoch_index['sample_table'])]
+    return sample_table[epoch_index['start_offset'][position]:epoch_index['end_offset'][position]]
+
+'''MAIN'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Attach trial labels to the iohub eye samples of the oddball tasks.')
+    parser.add_argument('study_folder', help = 'folder with visual_oddball and auditory_oddball data folders')
+    parser.add_argument('--clock', default = default_clock, choices = list(clock_columns.keys()), help = 'time base of the join')
+    parser.add_argument('--chunk-size', type = int, default = default_chunk_size, help = 'number of samples read at once')
+    parser.add_argument('--output', default = None, help = 'output folder, default: <study folder>/epochs')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'number of parallel processes')
+    parser.add_argument('--index', action = 'store_true', help = 'build the epoch index of each session instead of epoch tables')
+    arguments = parser.parse_args()
+
+    if arguments.index:
+        sessions = find_sessions(arguments.study_folder)
+        print('sessions found: ' + str(len(sessions)))
+        with ProcessPoolExecutor(max_workers = arguments.workers) as executor:
+            tasks = [[session, arguments.clock, arguments.chunk_size] for session in sessions]
+            for (session, [number_of_epochs, missing_onsets]) in zip(sessions, executor.map(build_epoch_index_task, tasks)):
+                print('{}: {} epochs indexed, {} without onset'.format(session[0], number_of_epochs, missing_onsets))
+    else:
+        output_folder = Path(arguments.output or Path(arguments.study_folder, 'epochs'))
+        output_folder.mkdir(parents = True, exist_ok = True)
+        sessions = find_sessions(arguments.study_folder)
+        print('sessions found: ' + str(len(sessions)))
+
+        summaries = list()
+        with ProcessPoolExecutor(max_workers = arguments.workers) as executor:
+            tasks = [[session, output_folder, arguments.clock, arguments.chunk_size] for session in sessions]
+            for summary in executor.map(merge_session_task, tasks):
+                summaries.append(summary)
+                print('{}: {} samples, {} in trials, {} of {} trials with samples'.format(
+                    summary['session'], summary['samples'], summary['samples_in_trials'], summary['trials_with_samples'], summary['trials']))
+
+        if summaries:
+            with open(Path(output_folder, 'epochs.csv'), 'w', newline = '') as summary_file:
+                writer = csv.DictWriter(summary_file, fieldnames = list(summaries[0].keys()))
+                writer.writeheader()
+                writer.writerows(summaries)
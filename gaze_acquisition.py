@@ -0,0 +1,228 @@
+'''GAZE ACQUISITION'''
+# In-process gaze acquisition with the gaze data callback of the Tobii Pro SDK (tobii_research),
+# used by both tasks if gaze_acquisition = 'tobii' or 'replay'. Gaze data reaches the gaze contingent
+# checks without the IPC round-trip to the iohub server. For further information see README.md.
+
+'''LOAD MODULES'''
+import threading, time
+import numpy
+# Columns of the sample buffer, same as the iohub samples (see gaze_samples.py):
+from gaze_samples import sample_columns
+
+# Same as tobii_research.EYETRACKER_GAZE_DATA:
+EYETRACKER_GAZE_DATA = 'gaze_data'
+
+'''GAZE STREAM'''
+# Gaze samples are written by the SDK callback thread into a preallocated ring buffer.
+# The write counter is increased after a sample is complete, so the task can read all samples
+# below the counter without a lock (one writer, one reader). If a filename is given,
+# a writer thread appends new samples to an HDF5 file (requires h5py).
+class GazeStream:
+    def __init__(self, eyetracker, window_size, clock, system_time_stamp, buffer_size = 65536, filename = None, flush_interval = 0.5):
+        self.eyetracker = eyetracker
+        self.window_size = window_size
+        self.buffer = numpy.full((buffer_size, len(sample_columns)), numpy.nan)
+        self.write_counter = 0 # samples written by the callback
+        self.read_counter = 0 # samples read by get_new_samples()
+        self.file_counter = 0 # samples written to the HDF5 file
+        self.lost_samples = 0 # samples overwritten before they were written to the HDF5 file
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.running = False
+        # Tobii system time stamps (microseconds) are translated to the task clock (seconds):
+        self.clock_offset = clock() - system_time_stamp()/1000000
+
+    def start(self):
+        self.running = True
+        if self.filename is not None:
+            import h5py
+            self.file = h5py.File(self.filename, 'w')
+            # Double precision, task clock times of long sessions need more than float32:
+            self.dataset = self.file.create_dataset('gaze', shape = (0, len(sample_columns)), dtype = 'f8',
+                maxshape = (None, len(sample_columns)), chunks = (1024, len(sample_columns)))
+            self.dataset.attrs['columns'] = sample_columns
+            self.dataset.attrs['window_size'] = self.window_size
+            self.writer = threading.Thread(target = self.write_loop, name = 'gaze_writer', daemon = True)
+            self.writer.start()
+        self.eyetracker.subscribe_to(EYETRACKER_GAZE_DATA, self.gaze_data_callback, as_dictionary = True)
+
+    # Called by the SDK for every sample (300 Hz), gaze points are translated
+    # from the display area (0-1, origin top left) to pixels (origin screen center):
+    def gaze_data_callback(self, gaze_data):
+        sample = self.buffer[self.write_counter % len(self.buffer)]
+        left_valid = gaze_data['left_gaze_point_validity'] == 1
+        right_valid = gaze_data['right_gaze_point_validity'] == 1
+        sample[0] = gaze_data['system_time_stamp']/1000000 + self.clock_offset
+        if left_valid and right_valid:
+            gaze_x = (gaze_data['left_gaze_point_on_display_area'][0] + gaze_data['right_gaze_point_on_display_area'][0])/2
+            gaze_y = (gaze_data['left_gaze_point_on_display_area'][1] + gaze_data['right_gaze_point_on_display_area'][1])/2
+        elif left_valid:
+            (gaze_x, gaze_y) = gaze_data['left_gaze_point_on_display_area']
+        elif right_valid:
+            (gaze_x, gaze_y) = gaze_data['right_gaze_point_on_display_area']
+        if left_valid or right_valid:
+            sample[1] = (gaze_x - 0.5) * self.window_size[0]
+            sample[2] = (0.5 - gaze_y) * self.window_size[1]
+        else:
+            sample[1] = numpy.nan
+            sample[2] = numpy.nan
+        sample[3] = gaze_data['left_pupil_diameter'] if gaze_data['left_pupil_validity'] == 1 else numpy.nan
+        sample[4] = gaze_data['right_pupil_diameter'] if gaze_data['right_pupil_validity'] == 1 else numpy.nan
+        sample[5] = left_valid or right_valid
+        self.write_counter += 1
+
+    # Copy of the buffer rows from sample counter start to end, in chronological order:
+    def get_samples(self, start, end):
+        buffer_size = len(self.buffer)
+        start = max(start, end - buffer_size)
+        first_row = start % buffer_size
+        last_row = end % buffer_size
+        if end - start == 0:
+            return self.buffer[:0].copy()
+        if first_row < last_row:
+            return self.buffer[first_row:last_row].copy()
+        return numpy.concatenate([self.buffer[first_row:], self.buffer[:last_row]])
+
+    # All samples since the last call, columns as in sample_columns:
+    def get_new_samples(self):
+        end = self.write_counter
+        samples = self.get_samples(self.read_counter, end)
+        self.read_counter = end
+        return samples
+
+    # Latest gaze position [x, y], None if no eyes are detected (like tracker.getPosition()):
+    def get_latest_position(self):
+        end = self.write_counter
+        if end == 0:
+            return None
+        sample = self.buffer[(end - 1) % len(self.buffer)]
+        if sample[5] != 1:
+            return None
+        return [sample[1], sample[2]]
+
+    def flush(self):
+        end = self.write_counter
+        if end - self.file_counter > len(self.buffer):
+            self.lost_samples += end - self.file_counter - len(self.buffer)
+        samples = self.get_samples(self.file_counter, end)
+        self.file_counter = end
+        if len(samples) > 0:
+            self.dataset.resize(self.dataset.shape[0] + len(samples), axis = 0)
+            self.dataset[-len(samples):] = samples
+
+    def write_loop(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        self.eyetracker.unsubscribe_from(EYETRACKER_GAZE_DATA, self.gaze_data_callback)
+        self.running = False
+        if self.filename is not None:
+            self.writer.join()
+            self.flush()
+            self.dataset.attrs['lost_samples'] = self.lost_samples
+            self.file.close()
+
+'''SIMULATED EYE TRACKER'''
+# Replays recorded samples with their original timing through the same callback as tobii_research,
+# e.g. to test the gaze contingent tasks on Linux without an eye tracker.
+# Samples are read from an HDF5 file of GazeStream, without a file a central fixation with noise and blinks is simulated.
+class SimulatedEyeTracker:
+    address = 'simulated'
+    model = 'replay'
+    device_name = 'simulated eye tracker'
+    serial_number = '0'
+
+    def __init__(self, replay_file = None, window_size = (1920, 1080), sampling_rate = 300, duration = 600):
+        if replay_file is not None:
+            import h5py
+            with h5py.File(replay_file, 'r') as file:
+                # Recordings of earlier versions are float32:
+                self.samples = file['gaze'][:].astype(float)
+                self.window_size = tuple(file['gaze'].attrs['window_size'])
+        else:
+            self.samples = simulate_samples(sampling_rate, duration)
+            self.window_size = window_size
+        self.callbacks = list()
+        self.running = False
+
+    @staticmethod
+    def get_system_time_stamp():
+        return int(time.perf_counter() * 1000000)
+
+    def subscribe_to(self, stream_type, callback, as_dictionary = True):
+        self.callbacks.append(callback)
+        if not self.running:
+            self.running = True
+            self.player = threading.Thread(target = self.replay_loop, name = 'gaze_replay', daemon = True)
+            self.player.start()
+
+    def unsubscribe_from(self, stream_type, callback = None):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+        if not self.callbacks and self.running:
+            self.running = False
+            self.player.join()
+
+    # Sample in the dictionary format of tobii_research:
+    def to_gaze_data(self, sample, system_time_stamp):
+        valid = sample[5] == 1
+        if valid:
+            gaze_point = (sample[1]/self.window_size[0] + 0.5, 0.5 - sample[2]/self.window_size[1])
+        else:
+            gaze_point = (numpy.nan, numpy.nan)
+        gaze_data = {'system_time_stamp': system_time_stamp, 'device_time_stamp': system_time_stamp}
+        for eye, pupil_column in [('left', 3), ('right', 4)]:
+            gaze_data[eye + '_gaze_point_on_display_area'] = gaze_point
+            gaze_data[eye + '_gaze_point_validity'] = int(valid)
+            gaze_data[eye + '_pupil_diameter'] = sample[pupil_column]
+            gaze_data[eye + '_pupil_validity'] = int(not numpy.isnan(sample[pupil_column]))
+        return gaze_data
+
+    def replay_loop(self):
+        replay_start = time.perf_counter()
+        sample_times = self.samples[:,0] - self.samples[0,0]
+        sample_counter = 0
+        while self.running:
+            # Replay from the beginning after the last sample:
+            if sample_counter == len(self.samples):
+                replay_start += sample_times[-1] + numpy.mean(numpy.diff(sample_times))
+                sample_counter = 0
+            remaining = replay_start + sample_times[sample_counter] - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            gaze_data = self.to_gaze_data(self.samples[sample_counter], self.get_system_time_stamp())
+            for callback in list(self.callbacks):
+                callback(gaze_data)
+            sample_counter += 1
+
+# Central fixation with gaze noise (pixels), pupil noise (mm) and a blink of 150 ms every 4 seconds:
+def simulate_samples(sampling_rate, duration, gaze_noise = 15, pupil_size = 3.5, pupil_noise = 0.05):
+    number_of_samples = int(sampling_rate * duration)
+    random_generator = numpy.random.default_rng()
+    samples = numpy.zeros((number_of_samples, len(sample_columns)))
+    samples[:,0] = numpy.arange(number_of_samples)/sampling_rate
+    samples[:,1:3] = random_generator.normal(0, gaze_noise, (number_of_samples, 2))
+    samples[:,3:5] = pupil_size + random_generator.normal(0, pupil_noise, (number_of_samples, 2))
+    samples[:,5] = 1
+    blinks = (samples[:,0] % 4) < 0.15
+    samples[blinks, 1:5] = numpy.nan
+    samples[blinks, 5] = 0
+    return samples
+
+# Open an in-process gaze stream by name: 'tobii' or 'replay':
+def open_gaze_stream(gaze_acquisition, window_size, clock, eyetracker = None, replay_file = None, filename = None):
+    if gaze_acquisition == 'tobii':
+        import tobii_research
+        if eyetracker is None:
+            eyetracker = tobii_research.find_all_eyetrackers()[0]
+        system_time_stamp = tobii_research.get_system_time_stamp
+    elif gaze_acquisition == 'replay':
+        eyetracker = SimulatedEyeTracker(replay_file, window_size)
+        system_time_stamp = eyetracker.get_system_time_stamp
+    else:
+        raise ValueError('gaze acquisition is not defined: ' + str(gaze_acquisition))
+    gaze_stream = GazeStream(eyetracker, window_size, clock, system_time_stamp, filename = filename)
+    gaze_stream.start()
+    return gaze_stream
@@ -0,0 +1,105 @@
+'''GAZE POLLING'''
+# Gaze polling thread of both tasks (gaze_polling_thread = True): the worker reads gaze data every interval
+# and publishes the latest validated state as one tuple. Replacing the tuple is atomic, thus no lock is needed.
+# For further information see README.md.
+
+'''LOAD MODULES'''
+import threading, time, collections
+import numpy
+
+# State published by the worker, checked by check_nodata() and check_gaze_offset() of the tasks:
+GazeState = collections.namedtuple('GazeState', ['time', 'position', 'nodata', 'offset', 'nodata_duration'])
+
+'''GAZE POLLER'''
+# The tracker is read with the functions of the task (iohub or gaze stream) while holding tracker_lock,
+# which is shared with the tracker calls of the main thread. The gaze data is validated with check_nodata()
+# and check_gaze_offset() of the task. With batched samples, the samples of the last sample_window seconds
+# are checked, like a batch of one flip. If read_samples is set, samples are also read without batches,
+# e.g. for the gaze quality buffer and the online pupil responses.
+class GazePoller:
+    def __init__(self, read_gaze_samples, read_gaze_position, check_nodata, check_gaze_offset, tracker_lock,
+            tracker_time, clock, batched = False, read_samples = False, sample_window = 0.05, interval = 0.002,
+            clock_interval = 1, bin_width = 0.0005):
+        self.read_gaze_samples = read_gaze_samples
+        self.read_gaze_position = read_gaze_position
+        self.check_nodata = check_nodata
+        self.check_gaze_offset = check_gaze_offset
+        self.tracker_lock = tracker_lock
+        self.tracker_time = tracker_time
+        self.clock = clock
+        self.batched = batched
+        self.read_samples = read_samples
+        self.sample_window = sample_window
+        self.interval = interval
+        self.state = GazeState(0, None, True, False, 0)
+        # Clock pair (clock(), tracker_time()) of the worker, renewed every clock_interval seconds.
+        # The tracker time is taken between two clock() calls, the pair holds their mean:
+        self.clock_pair = None
+        self.clock_interval = clock_interval
+        # Latency histogram of the worker (last bin: 100 bin widths and longer):
+        self.bin_width = bin_width
+        self.histogram = numpy.zeros(101, dtype = int)
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.worker = threading.Thread(target = self.polling_loop, name = 'gaze_polling', daemon = True)
+        self.worker.start()
+
+    def polling_loop(self):
+        recent_samples = numpy.zeros((0, 6))
+        nodata_start = None
+        while self.running:
+            poll_start = self.clock()
+            with self.tracker_lock:
+                if self.batched:
+                    recent_samples = numpy.concatenate([recent_samples, self.read_gaze_samples()])
+                else:
+                    gaze_position = self.read_gaze_position()
+                    if self.read_samples:
+                        self.read_gaze_samples()
+                if self.clock_pair is None or poll_start - self.clock_pair[0] >= self.clock_interval:
+                    time_before = self.clock()
+                    tracker_time = self.tracker_time()
+                    self.clock_pair = ((time_before + self.clock()) / 2, tracker_time)
+            poll_latency = self.clock() - poll_start
+            self.histogram[min(int(poll_latency/self.bin_width), len(self.histogram)-1)] += 1
+            if self.batched:
+                recent_samples = recent_samples[recent_samples[:,0] >= poll_start - self.sample_window]
+                gaze_data = recent_samples[:,1:3]
+                valid_samples = recent_samples[recent_samples[:,5] == 1]
+                gaze_position = list(valid_samples[-1,1:3]) if len(valid_samples) > 0 else None
+            else:
+                gaze_data = gaze_position
+            nodata = self.check_nodata(gaze_data)
+            offset = not nodata and self.check_gaze_offset(gaze_data)
+            if not nodata:
+                nodata_start = None
+            elif nodata_start is None:
+                nodata_start = poll_start
+            nodata_duration = 0 if nodata_start is None else poll_start - nodata_start
+            self.state = GazeState(poll_start, gaze_position, nodata, offset, nodata_duration)
+            time.sleep(self.interval)
+
+    # Tracker time (unit of tracker_time(), one tracker unit is tracker_time_unit seconds) converted from clock()
+    # with the clock pair of the worker, thus without waiting for the tracker lock. None before the first poll:
+    def get_tracker_time(self, tracker_time_unit):
+        clock_pair = self.clock_pair
+        if clock_pair is None:
+            return None
+        [pair_time, pair_tracker_time] = clock_pair
+        return pair_tracker_time + (self.clock() - pair_time) / tracker_time_unit
+
+    def close(self):
+        if self.running:
+            self.running = False
+            self.worker.join()
+
+    # Save the latency histogram as csv, returns the number of polls and the upper bound of the slowest poll (seconds):
+    def save_histogram(self, filename):
+        bin_starts = numpy.arange(len(self.histogram)) * self.bin_width
+        numpy.savetxt(filename, numpy.column_stack([bin_starts * 1000, self.histogram]),
+            delimiter = ',', header = 'latency_ms,polls', comments = '', fmt = ['%.1f', '%d'])
+        number_of_polls = int(numpy.sum(self.histogram))
+        slowest_bin = numpy.flatnonzero(self.histogram)[-1] if number_of_polls > 0 else 0
+        return [number_of_polls, float((slowest_bin + 1) * self.bin_width)]
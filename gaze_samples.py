@@ -0,0 +1,101 @@
+'''GAZE SAMPLES'''
+# Eye samples as NumPy arrays and the gaze quality ring buffer, used by both tasks.
+# Every sample array has the columns of sample_columns. For further information see README.md.
+
+'''LOAD MODULES'''
+import threading
+import numpy
+
+# Columns of all sample arrays, validity: 1 = gaze data, 0 = no eyes detected.
+sample_columns = ['time', 'x', 'y', 'pupil_left', 'pupil_right', 'validity']
+
+'''IOHUB EYE SAMPLES'''
+# Eye sample events of tracker.getEvents() as one array, other events are ignored:
+def gaze_samples_to_array(events):
+    from psychopy.iohub.constants import EventConstants
+    binocular = [event for event in events if event.type == EventConstants.BINOCULAR_EYE_SAMPLE]
+    monocular = [event for event in events if event.type == EventConstants.MONOCULAR_EYE_SAMPLE]
+    samples = numpy.full((len(binocular) + len(monocular), len(sample_columns)), numpy.nan)
+    if binocular:
+        values = numpy.array([[event.time, event.left_gaze_x, event.left_gaze_y, event.right_gaze_x, event.right_gaze_y,
+            event.left_pupil_measure1, event.right_pupil_measure1, event.status] for event in binocular], dtype = float)
+        # Status: 2 = right eye missing, 20 = left eye missing, 22 = both eyes missing.
+        status = values[:,7].astype(int)
+        left_valid = (status // 10) != 2
+        right_valid = (status % 10) != 2
+        number_of_eyes = left_valid.astype(int) + right_valid.astype(int)
+        # Gaze position is the mean of all detected eyes:
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            for column, left_column, right_column in [(1, 1, 3), (2, 2, 4)]:
+                samples[:len(binocular), column] = (numpy.where(left_valid, values[:,left_column], 0)
+                    + numpy.where(right_valid, values[:,right_column], 0)) / number_of_eyes
+        samples[:len(binocular), 0] = values[:,0]
+        samples[:len(binocular), 3] = numpy.where(left_valid, values[:,5], numpy.nan)
+        samples[:len(binocular), 4] = numpy.where(right_valid, values[:,6], numpy.nan)
+        samples[:len(binocular), 5] = number_of_eyes > 0
+        samples[:len(binocular), 1:3][number_of_eyes == 0] = numpy.nan
+    if monocular:
+        values = numpy.array([[event.time, event.gaze_x, event.gaze_y, event.pupil_measure1, event.status]
+            for event in monocular], dtype = float)
+        valid = values[:,4] == 0
+        samples[len(binocular):, 0:4] = values[:,0:4]
+        samples[len(binocular):, 5] = valid
+        samples[len(binocular):, 1:4][~valid] = numpy.nan
+    return samples
+
+'''RING BUFFER'''
+# Write rows into a ring buffer, returns the new number of written rows:
+def write_ring_buffer(ring_buffer, ring_counter, rows):
+    buffer_size = len(ring_buffer)
+    number_of_rows = min(len(rows), buffer_size)
+    rows = rows[len(rows)-number_of_rows:]
+    start = ring_counter % buffer_size
+    first_part = min(number_of_rows, buffer_size - start)
+    ring_buffer[start:start+first_part] = rows[:first_part]
+    ring_buffer[:number_of_rows-first_part] = rows[first_part:]
+    return ring_counter + number_of_rows
+
+'''GAZE QUALITY'''
+# Eye samples are written into a preallocated ring buffer, the oldest samples are overwritten.
+# Metrics of a fixation cross are computed in one pass at its end.
+# With the gaze polling thread, samples are written by the worker while the task computes the metrics,
+# thus samples are written and copied under a lock.
+class GazeBuffer:
+    def __init__(self, buffer_size = 8192):
+        self.buffer = numpy.zeros((buffer_size, len(sample_columns)))
+        self.counter = 0 # samples since reset
+        self.lock = threading.Lock()
+
+    def store(self, samples):
+        with self.lock:
+            self.counter = write_ring_buffer(self.buffer, self.counter, samples)
+
+    def reset(self):
+        with self.lock:
+            self.counter = 0
+
+    # Copy of the stored samples since start_time:
+    def get_samples(self, start_time):
+        with self.lock:
+            samples = self.buffer[:min(self.counter, len(self.buffer))].copy()
+        return samples[samples[:,0] >= start_time]
+
+    # Valid sample ratio, mean gaze offset from center, fixation dispersion and mean pupil size since start_time:
+    def compute_quality(self, start_time):
+        samples = self.get_samples(start_time)
+        gaze_quality = dict()
+        gaze_quality['gaze_samples'] = len(samples)
+        if len(samples) == 0:
+            return gaze_quality
+        valid = samples[:,5] == 1
+        gaze_quality['gaze_valid_ratio'] = round(float(numpy.count_nonzero(valid))/len(samples),3)
+        if numpy.any(valid):
+            x = samples[valid,1]
+            y = samples[valid,2]
+            gaze_quality['gaze_mean_offset'] = round(float(numpy.mean(numpy.hypot(x, y))),1)
+            # Dispersion as in the I-DT fixation algorithm: horizontal plus vertical range.
+            gaze_quality['gaze_dispersion'] = round(float(numpy.ptp(x) + numpy.ptp(y)),1)
+        pupil_sizes = samples[:,3:5]
+        if numpy.any(~numpy.isnan(pupil_sizes)):
+            gaze_quality['pupil_mean'] = round(float(numpy.nanmean(pupil_sizes)),3)
+        return gaze_quality
@@ -0,0 +1,112 @@
+'''PUPIL ARTIFACTS'''
+# Blink and artifact detection and interpolation of pupil samples (e.g. 300 Hz Tobii samples of iohub),
+# used offline by pupil_preprocessing.py and online by the pupil responses of both tasks.
+# All steps work on whole arrays with NumPy (no loops over samples or gaps). For further information see README.md.
+
+'''LOAD MODULES'''
+import numpy
+
+'''SETUP'''
+# Samples before and after an artifact that are rejected as well, in seconds:
+default_padding = [0.05, 0.1]
+# Dilation speed threshold: median + speed_threshold * median absolute deviation of all speeds
+# (Kret & Sjak-Shie, 2019), None = no speed criterion:
+default_speed_threshold = 16
+# Longer gaps are not interpolated, in seconds:
+default_max_gap = 0.5
+
+'''DETECTION'''
+# Valid samples: pupil size is a positive number and the eye tracker marked the sample as valid (if given):
+def validity_mask(pupil, validity = None):
+    with numpy.errstate(invalid = 'ignore'):
+        valid = numpy.isfinite(pupil) & (pupil > 0)
+    if validity is not None:
+        valid &= numpy.asarray(validity) > 0
+    return valid
+
+# Dilation speed of each sample: larger absolute change to the previous or next valid neighbour per second.
+# Samples next to invalid samples have only one speed, samples without valid neighbours nan.
+def dilation_speed(times, pupil, valid):
+    values = numpy.where(valid, pupil, numpy.nan)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        speed = numpy.abs(numpy.diff(values) / numpy.diff(times))
+    nan = numpy.full(1, numpy.nan)
+    return numpy.fmax(numpy.concatenate([nan, speed]), numpy.concatenate([speed, nan]))
+
+def speed_mask(times, pupil, valid, speed_threshold):
+    speed = dilation_speed(times, pupil, valid)
+    finite_speed = speed[numpy.isfinite(speed)]
+    if speed_threshold is None or len(finite_speed) < 3:
+        return numpy.zeros(len(pupil), dtype = bool)
+    median = numpy.median(finite_speed)
+    deviation = numpy.median(numpy.abs(finite_speed - median))
+    # Most speeds are equal (e.g. short windows, quantized pupil sizes): no outlier criterion,
+    # otherwise every sample with a nonzero speed would be rejected.
+    if deviation == 0:
+        return numpy.zeros(len(pupil), dtype = bool)
+    with numpy.errstate(invalid = 'ignore'):
+        return speed > median + speed_threshold * deviation
+
+# Extend a mask by padding[0] seconds before and padding[1] seconds after each masked sample:
+def pad_mask(times, mask, padding):
+    if not mask.any():
+        return mask.copy()
+    previous_masked = numpy.maximum.accumulate(numpy.where(mask, times, -numpy.inf))
+    next_masked = numpy.minimum.accumulate(numpy.where(mask, times, numpy.inf)[::-1])[::-1]
+    return mask | ((times - previous_masked) <= padding[1]) | ((next_masked - times) <= padding[0])
+
+# Artifacts: invalid samples and samples with outlying dilation speed, both padded:
+def artifact_mask(times, pupil, validity = None, padding = default_padding, speed_threshold = default_speed_threshold):
+    valid = validity_mask(pupil, validity)
+    artifacts = ~valid | speed_mask(times, pupil, valid, speed_threshold)
+    return pad_mask(times, artifacts, padding)
+
+'''INTERPOLATION'''
+# Replace artifacts by linear or cubic (Catmull-Rom) interpolation between the valid samples around each gap.
+# Gaps longer than max_gap and gaps at the start or end stay nan.
+def interpolate_artifacts(times, pupil, artifacts, method = 'linear', max_gap = default_max_gap):
+    cleaned = numpy.where(artifacts, numpy.nan, pupil).astype(float)
+    valid_positions = numpy.flatnonzero(~artifacts)
+    artifact_positions = numpy.flatnonzero(artifacts)
+    if len(artifact_positions) == 0 or len(valid_positions) < 2:
+        return cleaned
+    # Valid samples before (p1) and after (p2) each artifact sample:
+    after = numpy.searchsorted(valid_positions, artifact_positions)
+    inside = (after > 0) & (after < len(valid_positions))
+    after = after[inside]
+    artifact_positions = artifact_positions[inside]
+    position_1 = valid_positions[after - 1]
+    position_2 = valid_positions[after]
+    [time_1, time_2] = [times[position_1], times[position_2]]
+    [pupil_1, pupil_2] = [pupil[position_1], pupil[position_2]]
+    gap = time_2 - time_1
+    fraction = (times[artifact_positions] - time_1) / gap
+    if method == 'linear':
+        values = pupil_1 + fraction * (pupil_2 - pupil_1)
+    elif method == 'cubic':
+        # Tangents from the next valid samples outside the gap (p0 before p1, p3 after p2):
+        position_0 = valid_positions[numpy.maximum(after - 2, 0)]
+        position_3 = valid_positions[numpy.minimum(after + 1, len(valid_positions) - 1)]
+        secant = (pupil_2 - pupil_1) / gap
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            tangent_1 = numpy.where(position_0 < position_1, (pupil_2 - pupil[position_0]) / (time_2 - times[position_0]), secant)
+            tangent_2 = numpy.where(position_3 > position_2, (pupil[position_3] - pupil_1) / (times[position_3] - time_1), secant)
+        # Cubic Hermite basis functions:
+        fraction_2 = fraction * fraction
+        fraction_3 = fraction_2 * fraction
+        values = ((2 * fraction_3 - 3 * fraction_2 + 1) * pupil_1 + (fraction_3 - 2 * fraction_2 + fraction) * gap * tangent_1
+            + (-2 * fraction_3 + 3 * fraction_2) * pupil_2 + (fraction_3 - fraction_2) * gap * tangent_2)
+    else:
+        raise ValueError('interpolation method is not defined: ' + str(method))
+    short_gap = gap <= max_gap
+    cleaned[artifact_positions[short_gap]] = values[short_gap]
+    return cleaned
+
+# Detection and interpolation in one step, returns the cleaned pupil sizes and the artifact mask.
+# times in seconds (ascending), pupil sizes with nan or 0 for missing samples, validity optional:
+def clean_pupil(times, pupil, validity = None, method = 'linear', padding = default_padding,
+        speed_threshold = default_speed_threshold, max_gap = default_max_gap):
+    times = numpy.asarray(times, dtype = float)
+    pupil = numpy.asarray(pupil, dtype = float)
+    artifacts = artifact_mask(times, pupil, validity, padding, speed_threshold)
+    return [interpolate_artifacts(times, pupil, artifacts, method, max_gap), artifacts]
@@ -0,0 +1,229 @@
+'''PUPIL PREPROCESSING'''
+# Batch preprocessing of the pupil data of all sessions (see README.md):
+# blink and artifact detection, interpolation (see pupil_artifacts.py), baseline correction against the white and black slides
+# of the baseline calibration and epoching around stimulus onset.
+# Sessions are processed in parallel. Results are cached per session and only new or changed sessions are processed again.
+# Usage: python pupil_preprocessing.py <study folder> [--clock exp|tracker] [--workers N] [--force]
+# The study folder contains the task folders, e.g. data/visual_oddball/trialdata and data/visual_oddball/eyetracking.
+
+'''LOAD MODULES'''
+import argparse, csv, json, os, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import numpy
+from trigger_backends import trigger_log_dtype
+from pupil_artifacts import clean_pupil
+from eye_sample_merger import find_sessions, find_sample_table, load_epoch_index, source_hashes, source_stats, clock_columns, default_clock, default_chunk_size
+
+'''SETUP'''
+session_prefixes = ['visual_', 'auditory_']
+# Pupil fields of the iohub sample tables, binocular samples are averaged:
+pupil_fields = ['left_pupil_measure1', 'right_pupil_measure1', 'pupil_measure1']
+# Parameters of all steps, changed parameters invalidate the cache:
+parameters = {
+    # Samples before and after missing data and speed outliers that are rejected as well, in seconds:
+    'blink_padding': [0.05, 0.1],
+    # Dilation speed threshold in median absolute deviations, None = only missing data:
+    'speed_threshold': 16,
+    # 'linear' or 'cubic':
+    'interpolation': 'linear',
+    # Longer gaps are not interpolated, in seconds:
+    'max_interpolation_gap': 0.5,
+    # Epoch around stimulus onset, in seconds:
+    'epoch_window': [-0.5, 2.0],
+    # Pre-stimulus baseline of each epoch, in seconds relative to stimulus onset:
+    'epoch_baseline': [-0.2, 0.0],
+    # Part of the white and black slides used for the pupil range (the first second is the light response), in seconds:
+    'slide_window': [1.0, 5.0],
+    }
+# Trial onset triggers, the next trigger is the stimulus onset (condition trigger):
+trial_trigger_names = [b'trial', b'practice_trial']
+trial_counter_columns = ['oddball_trial_counter', 'practice_trial_counter']
+cache_version = 2
+
+'''FUNCTIONS'''
+# Mean of each row without nan values, rows without values are nan:
+def row_means(values):
+    counts = numpy.count_nonzero(~numpy.isnan(values), axis = 1)
+    sums = numpy.nansum(values, axis = 1)
+    return numpy.where(counts > 0, sums / numpy.maximum(counts, 1), numpy.nan)
+
+# Sample times and pupil size of a session, read in chunks (missing pupil size = nan):
+def read_pupil_samples(hdf5_filename, clock, chunk_size = default_chunk_size):
+    import h5py
+    time_field = clock_columns[clock][0]
+    times = list()
+    pupils = list()
+    with h5py.File(hdf5_filename, 'r') as hdf5_file:
+        sample_table = find_sample_table(hdf5_file)
+        if sample_table is None:
+            return [numpy.zeros(0), numpy.zeros(0)]
+        fields = [field for field in pupil_fields if field in sample_table.dtype.names]
+        for chunk_start in range(0, len(sample_table), chunk_size):
+            chunk = sample_table[chunk_start:chunk_start + chunk_size]
+            chunk_pupils = numpy.full((len(chunk), max(len(fields), 1)), numpy.nan)
+            for (column, field) in enumerate(fields):
+                chunk_pupils[:, column] = chunk[field]
+            chunk_pupils[~(chunk_pupils > 0)] = numpy.nan
+            times.append(chunk[time_field].astype(float))
+            pupils.append(row_means(chunk_pupils))
+    return [numpy.concatenate(times), numpy.concatenate(pupils)]
+
+def window_mean(times, pupil, start, end):
+    in_window = (times >= start) & (times < end)
+    if not numpy.any(in_window & ~numpy.isnan(pupil)):
+        return numpy.nan
+    return float(numpy.nanmean(pupil[in_window]))
+
+# Pupil range of the subject: mean pupil size during the white slide (constriction) and black slide (dilation)
+# of the baseline calibration, the first slide of each kind is used:
+def slide_range(epoch_index, times, pupil, slide_window):
+    slide_means = dict()
+    for slide in ['baseline_whiteslide', 'baseline_blackslide']:
+        positions = [position for (key, position_list) in epoch_index['lookup'].items() if key[2] == slide for position in position_list]
+        if not positions:
+            slide_means[slide] = numpy.nan
+            continue
+        slide_start = epoch_index['start_time'][min(positions)]
+        slide_means[slide] = window_mean(times, pupil, slide_start + slide_window[0], slide_start + slide_window[1])
+    return [slide_means['baseline_whiteslide'], slide_means['baseline_blackslide']]
+
+# Stimulus onset of every trial: condition trigger after the trial trigger (time on the clock of the samples).
+def stimulus_onsets(epoch_index, trigger_log, clock):
+    trigger_time_column = 'time_tracker' if clock == 'tracker' else 'time_exp'
+    trigger_times = trigger_log[trigger_time_column]
+    onsets = list()
+    for position in range(len(epoch_index['counter'])):
+        if epoch_index['counter_column'][position] not in trial_counter_columns:
+            continue
+        trial_start = epoch_index['start_time'][position]
+        next_trigger = numpy.searchsorted(trigger_times, trial_start, side = 'right')
+        if next_trigger >= len(trigger_log) or trigger_log['trigger_name'][next_trigger - 1] not in trial_trigger_names:
+            continue
+        onsets.append([position, float(trigger_times[next_trigger]), trigger_log['trigger_name'][next_trigger].decode()])
+    return onsets
+
+# Preprocess one session and save <session>_pupil.npz in the output folder:
+def preprocess_session(session, output_folder, clock = default_clock):
+    [session_name, trials_filename, hdf5_filename] = session
+    trigger_log_filename = Path(Path(trials_filename).parent, session_name + '_trigger_log.bin')
+    trigger_log = numpy.fromfile(trigger_log_filename, dtype = trigger_log_dtype) if trigger_log_filename.exists() else numpy.zeros(0, dtype = trigger_log_dtype)
+    epoch_index = load_epoch_index(session, clock)
+    [times, pupil] = read_pupil_samples(hdf5_filename, clock)
+
+    # Blink and artifact detection and interpolation:
+    [cleaned, artifacts] = clean_pupil(times, pupil, method = parameters['interpolation'], padding = parameters['blink_padding'],
+        speed_threshold = parameters['speed_threshold'], max_gap = parameters['max_interpolation_gap'])
+
+    # Baseline correction: 0 = white slide, 1 = black slide.
+    [white_mean, black_mean] = slide_range(epoch_index, times, cleaned, parameters['slide_window'])
+    normalized = (cleaned - white_mean) / (black_mean - white_mean)
+
+    # Epochs on a regular time grid at the sampling rate:
+    sampling_interval = float(numpy.median(numpy.diff(times))) if len(times) > 1 else numpy.nan
+    onsets = stimulus_onsets(epoch_index, trigger_log, clock)
+    [epoch_start, epoch_end] = parameters['epoch_window']
+    epoch_times = numpy.arange(epoch_start, epoch_end, sampling_interval) if onsets else numpy.zeros(0)
+    epochs = numpy.full((len(onsets), len(epoch_times)), numpy.nan)
+    valid_samples = ~numpy.isnan(normalized)
+    for (row, (position, onset, condition)) in enumerate(onsets):
+        in_epoch = (times >= onset + epoch_start - sampling_interval) & (times <= onset + epoch_end + sampling_interval) & valid_samples
+        if numpy.count_nonzero(in_epoch) > 1:
+            epochs[row] = numpy.interp(onset + epoch_times, times[in_epoch], normalized[in_epoch], left = numpy.nan, right = numpy.nan)
+    baseline_samples = (epoch_times >= parameters['epoch_baseline'][0]) & (epoch_times < parameters['epoch_baseline'][1])
+    epoch_baselines = row_means(epochs[:, baseline_samples])
+
+    positions = [onset[0] for onset in onsets]
+    result = {
+        'cache_version': cache_version,
+        'parameters': json.dumps(parameters),
+        'clock': clock,
+        # Validated by load_epoch_index(), thus the files are not hashed again:
+        'source_hashes': epoch_index['source_hashes'],
+        'source_stats': epoch_index['source_stats'],
+        'epoch_times': epoch_times,
+        'epochs': epochs,
+        'epochs_baseline_corrected': epochs - epoch_baselines[:, None],
+        'epoch_baselines': epoch_baselines,
+        'stimulus_onset': numpy.array([onset[1] for onset in onsets]),
+        'condition': numpy.array([onset[2] for onset in onsets], dtype = str),
+        'trial': epoch_index['trial'][positions],
+        'phase': epoch_index['phase'][positions],
+        'counter_column': epoch_index['counter_column'][positions],
+        'counter': epoch_index['counter'][positions],
+        'white_slide_pupil': white_mean,
+        'black_slide_pupil': black_mean}
+    # Written to a temporary file and renamed, an interrupted run leaves no incomplete results:
+    result_filename = Path(output_folder, session_name + '_pupil.npz')
+    with open(str(result_filename) + '.part', 'wb') as result_file:
+        numpy.savez(result_file, **result)
+    os.replace(str(result_filename) + '.part', result_filename)
+
+    summary = {'session': session_name, 'status': 'processed', 'samples': len(times),
+        'artifact_fraction': round(float(numpy.mean(artifacts)), 4) if len(times) else '',
+        'missing_after_interpolation': round(float(numpy.mean(numpy.isnan(cleaned))), 4) if len(times) else '',
+        'trials': len(onsets), 'white_slide_pupil': round(white_mean, 4), 'black_slide_pupil': round(black_mean, 4)}
+    return summary
+
+# A session is cached if its result was computed from the same files with the same parameters.
+# Files are only hashed (SHA-256) if size or modification time have changed:
+def is_cached(session, output_folder, clock):
+    result_filename = Path(output_folder, session[0] + '_pupil.npz')
+    if not result_filename.exists():
+        return False
+    with numpy.load(result_filename) as result:
+        if int(result['cache_version']) != cache_version or str(result['parameters']) != json.dumps(parameters) or str(result['clock']) != clock:
+            return False
+        if list(result['source_stats']) == source_stats(session):
+            return True
+        if list(result['source_hashes']) != source_hashes(session):
+            return False
+        result = {name: result[name] for name in result.files}
+    # Same hashes, only the modification time has changed: stored size and modification time are updated.
+    result['source_stats'] = numpy.array(source_stats(session))
+    with open(str(result_filename) + '.part', 'wb') as result_file:
+        numpy.savez(result_file, **result)
+    os.replace(str(result_filename) + '.part', result_filename)
+    return True
+
+def preprocess_session_task(arguments):
+    [session, output_folder, clock, force] = arguments
+    if not force and is_cached(session, output_folder, clock):
+        return {'session': session[0], 'status': 'cached'}
+    try:
+        return preprocess_session(session, output_folder, clock)
+    except Exception as error:
+        return {'session': session[0], 'status': 'failed: ' + repr(error)}
+
+'''MAIN'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Preprocess the pupil data of all sessions of the oddball tasks.')
+    parser.add_argument('study_folder', help = 'folder with visual_oddball and auditory_oddball data folders')
+    parser.add_argument('--clock', default = default_clock, choices = list(clock_columns.keys()), help = 'time base of samples and triggers')
+    parser.add_argument('--output', default = None, help = 'output folder, default: <study folder>/pupil_preprocessing')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'number of parallel processes')
+    parser.add_argument('--force', action = 'store_true', help = 'process all sessions again, also cached sessions')
+    arguments = parser.parse_args()
+
+    output_folder = Path(arguments.output or Path(arguments.study_folder, 'pupil_preprocessing'))
+    output_folder.mkdir(parents = True, exist_ok = True)
+    sessions = [session for session in find_sessions(arguments.study_folder) if session[0].startswith(tuple(session_prefixes))]
+    print('sessions found: ' + str(len(sessions)))
+
+    # Progress is printed for every finished session, results of finished sessions are kept if the run is interrupted:
+    summaries = list()
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers = arguments.workers) as executor:
+        futures = [executor.submit(preprocess_session_task, [session, output_folder, arguments.clock, arguments.force]) for session in sessions]
+        for (finished, future) in enumerate(as_completed(futures), start = 1):
+            summary = future.result()
+            summaries.append(summary)
+            print('[{}/{}] {:.0f} s {}: {}'.format(finished, len(sessions), time.time() - start_time, summary['session'], summary['status']))
+
+    # Summary of this run, cached sessions have only session and status:
+    if summaries:
+        fieldnames = list(dict.fromkeys(name for summary in summaries for name in summary))
+        with open(Path(output_folder, 'pupil_preprocessing.csv'), 'w', newline = '') as summary_file:
+            writer = csv.DictWriter(summary_file, fieldnames = fieldnames)
+            writer.writeheader()
+            writer.writerows(sorted(summaries, key = lambda summary: summary['session']))
@@ -0,0 +1,106 @@
+'''PUPIL RESPONSES'''
+# Online pupil responses of both tasks (online_pupil_responses = True). For further information see README.md.
+
+'''LOAD MODULES'''
+import threading, collections
+import numpy
+from gaze_samples import write_ring_buffer
+# Blink and artifact rejection of the response windows:
+from pupil_artifacts import clean_pupil
+
+'''PUPIL RESPONSE ENGINE'''
+# Pupil sizes are kept in a small ring buffer (bounded memory).
+# Every stimulus onset is queued and evaluated as soon as its response window is complete:
+# baseline = mean pupil size before onset, peak dilation = maximum pupil size in the window minus baseline.
+# Blinks and artifacts are interpolated before, unless interpolation is None.
+# Running mean and variance of the peak dilation are updated with Welford's algorithm
+# for each condition and each factor level.
+# Stimuli are numbered, the response of each stimulus is stored under its number until its trial is saved.
+# With the gaze polling thread, samples are fed by the worker, thus results and statistics are locked.
+class PupilResponseEngine:
+    def __init__(self, baseline_duration = 0.5, response_window = 1.5, interpolation = 'linear', buffer_size = 4096):
+        self.baseline_duration = baseline_duration
+        self.response_window = response_window
+        self.interpolation = interpolation
+        self.buffer = numpy.full((buffer_size, 2), numpy.nan) # time, pupil size (mean of both eyes)
+        self.buffer_counter = 0
+        self.pending_trials = collections.deque() # [stimulus number, onset time, condition, factors]
+        self.stimulus_counter = 0
+        self.results = dict() # stimulus number -> columns of the pupil response
+        self.statistics = dict() # condition or (factor, level) -> [count, mean, sum of squared differences]
+        self.lock = threading.Lock()
+
+    # Queue a stimulus onset, returns the number of the stimulus:
+    def register_trial(self, onset_time, condition, factors):
+        self.stimulus_counter += 1
+        self.pending_trials.append([self.stimulus_counter, onset_time, condition, factors])
+        return self.stimulus_counter
+
+    # Eye samples with the columns of gaze_samples.sample_columns:
+    def feed(self, samples):
+        if len(samples) == 0:
+            return
+        # Samples without pupil size are kept (nan), so that blinks are detected in the window:
+        number_of_eyes = numpy.count_nonzero(~numpy.isnan(samples[:,3:5]), axis = 1)
+        pupil_sizes = numpy.where(number_of_eyes > 0, numpy.nansum(samples[:,3:5], axis = 1) / numpy.maximum(number_of_eyes, 1), numpy.nan)
+        self.buffer_counter = write_ring_buffer(self.buffer, self.buffer_counter, numpy.column_stack([samples[:,0], pupil_sizes]))
+        while self.pending_trials and samples[-1,0] >= self.pending_trials[0][1] + self.response_window:
+            self.evaluate_trial(*self.pending_trials.popleft())
+
+    def update_statistics(self, key, value):
+        [count, mean, squared_differences] = self.statistics.get(key, [0, 0.0, 0.0])
+        count += 1
+        delta = value - mean
+        mean += delta/count
+        squared_differences += delta * (value - mean)
+        self.statistics[key] = [count, mean, squared_differences]
+
+    def evaluate_trial(self, stimulus_number, onset_time, condition, factors):
+        stored = self.buffer[:min(self.buffer_counter, len(self.buffer))]
+        window = stored[(stored[:,0] >= onset_time - self.baseline_duration) & (stored[:,0] < onset_time + self.response_window)]
+        # Ring buffer rows in chronological order:
+        window = window[numpy.argsort(window[:,0])]
+        pupil_sizes = window[:,1]
+        pupil_response = dict()
+        pupil_response['pupil_condition'] = condition
+        if self.interpolation is not None and len(window) > 0:
+            [pupil_sizes, artifacts] = clean_pupil(window[:,0], window[:,1], method = self.interpolation)
+            pupil_response['pupil_artifact_fraction'] = round(float(numpy.mean(artifacts)),3)
+        valid = ~numpy.isnan(pupil_sizes)
+        baseline = pupil_sizes[valid & (window[:,0] < onset_time)]
+        response_times = window[valid & (window[:,0] >= onset_time), 0]
+        response_sizes = pupil_sizes[valid & (window[:,0] >= onset_time)]
+        if len(baseline) == 0 or len(response_times) == 0:
+            with self.lock:
+                self.results[stimulus_number] = pupil_response
+            return
+        pupil_baseline = float(numpy.mean(baseline))
+        peak = numpy.argmax(response_sizes)
+        peak_dilation = float(response_sizes[peak]) - pupil_baseline
+        pupil_response['pupil_baseline'] = round(pupil_baseline,3)
+        pupil_response['pupil_peak_dilation'] = round(peak_dilation,3)
+        pupil_response['pupil_peak_latency'] = round(float(response_times[peak]) - onset_time,3)
+        with self.lock:
+            self.results[stimulus_number] = pupil_response
+            self.update_statistics(condition, peak_dilation)
+            for factor, level in factors.items():
+                self.update_statistics((factor, level), peak_dilation)
+
+    # Columns of the pupil response of a stimulus, empty if it is not evaluated yet.
+    # Results of earlier stimuli that were not taken in time are dropped:
+    def pop_result(self, stimulus_number):
+        with self.lock:
+            pupil_response = self.results.pop(stimulus_number, dict())
+            for earlier_stimulus in [number for number in self.results if number < stimulus_number]:
+                del self.results[earlier_stimulus]
+        return pupil_response
+
+    # Number, mean and standard deviation of peak dilations per condition and factor level:
+    def get_summary(self):
+        with self.lock:
+            statistics = sorted(list(self.statistics.items()), key = lambda item: str(item[0]))
+        summary = list()
+        for key, [count, mean, squared_differences] in statistics:
+            standard_deviation = numpy.sqrt(squared_differences/(count - 1)) if count > 1 else 0
+            summary.append([key, count, mean, standard_deviation])
+        return summary
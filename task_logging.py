@@ -0,0 +1,124 @@
+'''TASK LOGGING'''
+# Asynchronous logging for both tasks: the presentation thread only puts records into a queue.
+# A QueueListener thread formats the records and writes the log file and the console output,
+# thus no file or console I/O happens in the frame loops. For further information see README.md.
+
+'''LOAD MODULES'''
+import logging, logging.handlers, queue, sys, time, atexit
+
+'''QUEUE LOGGING'''
+# Records are put into the queue without waiting, records that do not fit are dropped and counted.
+# Only the message is merged with its arguments here, time and level are formatted by the listener.
+# Structured records (e.g. events of event_log.py) are passed unchanged:
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, record_queue, statistics):
+        super().__init__(record_queue)
+        self.statistics = statistics
+
+    def prepare(self, record):
+        if not hasattr(record.msg, '_asdict'):
+            record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.statistics['dropped'] += 1
+
+# Replaces sys.stdout: print() puts the text into the same queue, in quiet mode the text is discarded.
+class QueueConsole:
+    def __init__(self, record_queue, statistics):
+        self.queue = record_queue
+        self.statistics = statistics
+        self.quiet = False
+
+    def write(self, text):
+        if not self.quiet and text:
+            try:
+                self.queue.put_nowait(logging.makeLogRecord({'name': 'console', 'msg': text}))
+            except queue.Full:
+                self.statistics['dropped'] += 1
+        return len(text)
+
+    def flush(self):
+        pass
+
+# Writes console records to the console, records of named loggers to their handlers (see TaskLog.add_handler())
+# and all other records to the log file.
+# Records that are handled later than late_cutoff (seconds) after they were created are counted.
+class TaskLogListener(logging.handlers.QueueListener):
+    def __init__(self, record_queue, file_handler, console, statistics, late_cutoff):
+        super().__init__(record_queue, file_handler)
+        self.console = console
+        self.statistics = statistics
+        self.late_cutoff = late_cutoff
+        self.named_handlers = dict()
+
+    def handle(self, record):
+        if time.time() - record.created > self.late_cutoff:
+            self.statistics['late'] += 1
+        if record.name == 'console':
+            self.console.write(record.msg)
+            self.console.flush()
+        elif record.name in self.named_handlers:
+            self.named_handlers[record.name].handle(record)
+        else:
+            super().handle(record)
+
+    # The sentinel must not be dropped like a record: wait until there is space in the queue.
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+class TaskLog:
+    def __init__(self, listener, file_handler, console, statistics):
+        self.listener = listener
+        self.file_handler = file_handler
+        self.console = console
+        self.statistics = statistics
+        self.stopped = False
+
+    # Quiet mode: no console output, log file is written as usual.
+    def set_quiet(self, quiet):
+        self.console.quiet = quiet
+
+    # Records of the logger logger_name are written by handler instead of the log file:
+    def add_handler(self, logger_name, handler):
+        self.listener.named_handlers[logger_name] = handler
+
+    # Write all queued records, report dropped and late records and restore the console.
+    # Stopped is set after the listener has stopped, so that a failed stop is retried at exit:
+    def stop(self):
+        if self.stopped:
+            return
+        self.listener.stop()
+        self.stopped = True
+        sys.stdout = self.listener.console
+        summary = 'LOGGING: ' + str(self.statistics['dropped']) + ' DROPPED RECORDS, ' + str(self.statistics['late']) + ' LATE RECORDS'
+        self.file_handler.handle(logging.makeLogRecord({'name': 'root', 'levelno': logging.INFO, 'levelname': 'INFO', 'msg': summary}))
+        self.file_handler.close()
+        for handler in self.listener.named_handlers.values():
+            handler.close()
+        print(summary.lower())
+
+# Setup of the root logger, like logging.basicConfig(level = logging.DEBUG, filename = filename, filemode = 'w').
+# The listener is stopped automatically at exit (e.g. core.quit()), so that all queued records are written.
+def setup_task_logging(filename, format, queue_size = 100000, late_cutoff = 0.5):
+    statistics = {'dropped': 0, 'late': 0}
+    record_queue = queue.Queue(queue_size)
+    file_handler = logging.FileHandler(filename, mode = 'w')
+    file_handler.setFormatter(logging.Formatter(format))
+    listener = TaskLogListener(record_queue, file_handler, sys.stdout, statistics, late_cutoff)
+    console = QueueConsole(record_queue, statistics)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(NonBlockingQueueHandler(record_queue, statistics))
+    sys.stdout = console
+    listener.start()
+    task_log = TaskLog(listener, file_handler, console, statistics)
+    atexit.register(task_log.stop)
+    return task_log
@@ -0,0 +1,38 @@
+'''DEADLINE SCHEDULER TESTS'''
+# Flip deadlines and onsets of DeadlineScheduler with a simulated window.
+
+import pytest
+from deadline_scheduler import DeadlineScheduler
+
+class SimulatedWindow:
+    def __init__(self):
+        self.next_flip = 10.0
+
+    def getFutureFlipTime(self):
+        return self.next_flip
+
+def test_late_flip_does_not_delay_following_events():
+    window = SimulatedWindow()
+    event_scheduler = DeadlineScheduler(window, 1/60)
+    event_scheduler.start()
+    assert event_scheduler.schedule('fixcross', 1) == 11
+    # The fixcross starts 50 ms late:
+    [event_name, planned_onset, achieved_onset] = event_scheduler.register_onset(10.05)
+    assert [event_name, planned_onset] == ['fixcross', 0]
+    assert achieved_onset == pytest.approx(0.05)
+    window.next_flip = 11.01
+    assert event_scheduler.schedule('stimulus', 0.1) == 11.1
+    onsets = event_scheduler.pop_onsets()
+    assert onsets['stimulus'] == [1, None]
+    assert event_scheduler.pop_onsets() == {}
+
+def test_schedule_restarts_after_untimed_phase():
+    window = SimulatedWindow()
+    event_scheduler = DeadlineScheduler(window, 1/60, resync_cutoff = 0.5)
+    event_scheduler.start()
+    event_scheduler.schedule('fixcross', 1)
+    event_scheduler.extend(0.2)
+    window.next_flip = 20
+    assert event_scheduler.schedule('stimulus', 0.1) == 20.1
+    assert event_scheduler.continue_loop(0, 20.1)
+    assert not event_scheduler.continue_loop(1, 20)
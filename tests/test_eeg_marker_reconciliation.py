@@ -0,0 +1,26 @@
+'''EEG MARKER RECONCILIATION TESTS'''
+# Sessions without matching markers of eeg_marker_reconciliation.py.
+
+import numpy
+from eeg_marker_reconciliation import reconcile_session
+from trigger_backends import trigger_log_dtype
+
+def write_session(folder, marker_lines):
+    trigger_log = numpy.zeros(3, dtype = trigger_log_dtype)
+    trigger_log['trigger_value'] = [1, 2, 1]
+    trigger_log['trigger_name'] = [b'trial', b'stimulus', b'trial']
+    trigger_log['time_exp'] = [1.0, 1.5, 3.0]
+    trigger_log.tofile(folder / 'session_triggers.bin')
+    with open(folder / 'session.vmrk', 'w') as vmrk_file:
+        vmrk_file.write('[Marker Infos]\n' + ''.join(marker_lines))
+    return ['session', folder / 'session_triggers.bin', folder / 'session.csv', folder / 'session.vmrk']
+
+def test_session_without_markers_reports_all_triggers_missing(tmp_path):
+    [summary, trigger_table] = reconcile_session(write_session(tmp_path, ['Mk1=New Segment,,1,1,0\n']))
+    assert [summary['matched'], summary['missing'], summary['merged'], summary['extra']] == [0, 3, 0, 0]
+    assert summary['clock_offset'] == ''
+    assert list(trigger_table['status']) == ['missing'] * 3
+
+def test_markers_of_other_values_are_extra(tmp_path):
+    [summary, trigger_table] = reconcile_session(write_session(tmp_path, ['Mk1=Stimulus,S  7,5001,1,0\n']))
+    assert [summary['matched'], summary['missing'], summary['extra']] == [0, 3, 1]
@@ -0,0 +1,61 @@
+'''EVENT LOG TESTS'''
+# Typed records of event_log.py with the fields the tasks pass.
+
+import ast, json, logging, os
+import pytest
+import event_log
+from event_log import event_fields, open_event_log, log_event
+
+task_scripts = ['visual_oddball.py', 'auditory_oddball.py']
+
+# Event kind and keyword arguments (without time) of every log_event() call of a task script:
+def task_events(script):
+    filename = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), script)
+    with open(filename, encoding = 'utf-8') as task_file:
+        tree = ast.parse(task_file.read())
+    events = list()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'log_event':
+            keywords = [keyword.arg for keyword in node.keywords if keyword.arg != 'time']
+            events.append([node.args[0].value, keywords])
+    return events
+
+@pytest.fixture
+def event_file(tmp_path):
+    filename = str(tmp_path / 'session_events.jsonl')
+    handler = open_event_log(filename, clock = lambda: 1.0)
+    event_log.event_logger.addHandler(handler)
+    event_log.event_logger.setLevel(logging.INFO)
+    yield filename
+    event_log.event_logger.removeHandler(handler)
+    handler.close()
+    event_log.event_clock = None
+
+@pytest.mark.parametrize('script', task_scripts)
+def test_task_events_are_logged(script, event_file):
+    events = task_events(script)
+    assert set(kind for [kind, keywords] in events) <= set(event_fields)
+    for [kind, keywords] in events:
+        log_event(kind, **{keyword: 0 for keyword in keywords})
+    with open(event_file) as lines:
+        records = [json.loads(line) for line in lines]
+    assert [record['event'] for record in records] == [kind for [kind, keywords] in events]
+    for record, [kind, keywords] in zip(records, events):
+        assert sorted(record) == sorted(['event', 'time'] + keywords)
+
+def test_event_log_round_trip(event_file):
+    pandas = pytest.importorskip('pandas')
+    log_event('trial_start', phase = 'experiment', trial = 'oddball', ISI = 1.2)
+    log_event('response', time = 2.5, key = 'space', rt = 0.412)
+    log_event('trigger', trigger_value = 13, trigger_name = 'practice_trial', queued = True)
+    events = event_log.load_event_log(event_file)
+    assert list(events['event']) == ['trial_start', 'response', 'trigger']
+    # Time of the clock, unless it is given:
+    assert list(events['time']) == [1.0, 2.5, 1.0]
+    assert events['ISI'][0] == 1.2
+    assert events['rt'][1] == 0.412
+    assert events['trigger_value'][2] == 13
+    assert bool(events['queued'][2]) is True
+    # Columns of other event kinds are empty:
+    assert pandas.isna(events['rt'][0])
+    assert list(events.columns) == ['event', 'time', 'phase', 'trial', 'ISI', 'key', 'rt', 'trigger_value', 'trigger_name', 'queued']
@@ -0,0 +1,79 @@
+'''EYE SAMPLE MERGER TESTS'''
+# Trial intervals and epoch index of eye_sample_merger.py.
+
+import os
+import numpy
+import pytest
+import eye_sample_merger
+from eye_sample_merger import trial_intervals, load_epoch_index, get_epoch
+
+def test_baseline_ends_after_its_duration():
+    # Baseline phase (no ISI) followed by instructions, then the first trial:
+    trial_rows = [
+        {'phase': 'baseline', 'trial': 'baseline', 'timestamp_exp': '10.0', 'stimulus_duration': '5.0'},
+        {'phase': 'experiment', 'trial': 'standard', 'timestamp_exp': '30.0', 'stimulus_duration': '0.1', 'ISI_duration': '1.0'},
+        {'phase': 'experiment', 'trial': 'oddball', 'timestamp_exp': '31.0', 'stimulus_duration': '0.1', 'ISI_duration': '1.0'},
+        {'phase': 'experiment', 'trial': 'standard', 'timestamp_exp': '33.0'}]
+    [starts, ends, labels] = trial_intervals(trial_rows, 'timestamp_exp')
+    assert list(starts) == [10.0, 30.0, 31.0, 33.0]
+    # Samples of the instruction gap (15 - 30 s) are not assigned to the baseline.
+    # A trial ends at the latest at the next trial start, a row without durations at the next trial start:
+    assert list(ends[:3]) == [15.0, 31.0, 32.1]
+    assert ends[3] == float('inf')
+    assert labels[0] == ['baseline', '', 'baseline']
+
+# Session with 10 s of samples at 100 Hz (time field of the task clock) and two trials:
+@pytest.fixture
+def session(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    samples = numpy.zeros(1000, dtype = [('time', 'f8'), ('device_time', 'f8'), ('gaze_x', 'f4')])
+    samples['time'] = numpy.arange(1000) / 100
+    hdf5_filename = tmp_path / 'visual_1_2024-05-01-1030.hdf5'
+    with h5py.File(hdf5_filename, 'w') as hdf5_file:
+        hdf5_file.create_dataset(eye_sample_merger.sample_tables[0], data = samples)
+    trials_filename = tmp_path / 'visual_1_2024-05-01-1030.csv'
+    trials_filename.write_text('trial,oddball_trial_counter,timestamp_exp,stimulus_duration,ISI_duration\n'
+        'standard,1,2.0,0.5,1.5\noddball,2,5.0,0.5,1.5\n')
+    return ['visual_1_2024-05-01-1030', trials_filename, hdf5_filename]
+
+@pytest.fixture
+def builds(monkeypatch):
+    builds = list()
+    build_epoch_index = eye_sample_merger.build_epoch_index
+    def counted_build(*arguments):
+        builds.append(arguments)
+        return build_epoch_index(*arguments)
+    monkeypatch.setattr(eye_sample_merger, 'build_epoch_index', counted_build)
+    return builds
+
+def test_epoch_index_slices_samples(session, builds):
+    h5py = pytest.importorskip('h5py')
+    epoch_index = load_epoch_index(session)
+    with h5py.File(session[2], 'r') as hdf5_file:
+        epoch = get_epoch(hdf5_file, epoch_index, 'oddball_trial_counter', 2, 'oddball')
+    assert [epoch['time'][0], epoch['time'][-1]] == pytest.approx([5.0, 6.99])
+    # The index is built once and then loaded:
+    load_epoch_index(session)
+    assert len(builds) == 1
+
+def test_epoch_index_is_rebuilt_after_changes(session, builds):
+    trials_filename = session[1]
+    load_epoch_index(session)
+    # Only the modification time changes (same content): the stored stats are updated, no rebuild:
+    os.utime(trials_filename, ns = (1, 1))
+    load_epoch_index(session)
+    assert len(builds) == 1
+    assert load_epoch_index(session)['source_stats'][0].endswith(':1')
+    # Same size, other content:
+    trials_filename.write_text(trials_filename.read_text().replace('5.0,', '6.0,'))
+    os.utime(trials_filename, ns = (2, 2))
+    assert load_epoch_index(session)['start_time'][1] == 6.0
+    assert len(builds) == 2
+    # Other size:
+    with open(trials_filename, 'a') as trials_file:
+        trials_file.write('standard,3,8.0,0.5,1.5\n')
+    assert len(load_epoch_index(session)['counter']) == 3
+    assert len(builds) == 3
+    # Other clock (no timestamp_tracker in the trial data, thus empty epochs):
+    assert str(load_epoch_index(session, clock = 'tracker')['clock']) == 'tracker'
+    assert len(builds) == 4
@@ -0,0 +1,54 @@
+'''GAZE ACQUISITION TESTS'''
+# Gaze stream of gaze_acquisition.py with the simulated eye tracker (replay).
+
+import time
+import numpy
+import pytest
+from gaze_acquisition import GazeStream, SimulatedEyeTracker, open_gaze_stream
+
+window_size = (1920, 1080)
+
+def test_callback_converts_gaze_data():
+    eyetracker = SimulatedEyeTracker(window_size = window_size, duration = 1)
+    gaze_stream = GazeStream(eyetracker, window_size, lambda: 10.0, lambda: 4000000, buffer_size = 4)
+    samples = numpy.array([
+        [0, 96, -54, 3.5, 3.6, 1],
+        [0, numpy.nan, numpy.nan, numpy.nan, 3.4, 0]])
+    for number, sample in enumerate(samples):
+        gaze_stream.gaze_data_callback(eyetracker.to_gaze_data(sample, 4000000 + number * 1000))
+    received = gaze_stream.get_new_samples()
+    # Tobii system time (microseconds) on the task clock (seconds):
+    assert list(received[:,0]) == pytest.approx([10.0, 10.001])
+    assert list(received[0,1:]) == pytest.approx([96, -54, 3.5, 3.6, 1])
+    assert numpy.isnan(received[1,1:4]).all()
+    assert list(received[1,4:]) == pytest.approx([3.4, 0])
+    assert gaze_stream.get_latest_position() is None
+    assert len(gaze_stream.get_new_samples()) == 0
+
+def test_ring_buffer_returns_newest_samples():
+    eyetracker = SimulatedEyeTracker(window_size = window_size, duration = 1)
+    gaze_stream = GazeStream(eyetracker, window_size, lambda: 0.0, lambda: 0, buffer_size = 4)
+    for number in range(6):
+        gaze_stream.gaze_data_callback(eyetracker.to_gaze_data(numpy.array([0, 0, 0, 3, 3, 1]), number * 1000000))
+    assert list(gaze_stream.get_new_samples()[:,0]) == [2, 3, 4, 5]
+    assert gaze_stream.get_latest_position() == [0, 0]
+
+def test_recorded_samples_are_replayed(tmp_path):
+    pytest.importorskip('h5py')
+    recording = str(tmp_path / 'recording_gaze.hdf5')
+    gaze_stream = open_gaze_stream('replay', window_size, time.perf_counter, filename = recording)
+    time.sleep(0.2)
+    gaze_stream.close()
+    with pytest.importorskip('h5py').File(recording, 'r') as file:
+        recorded = file['gaze'][:]
+        assert file['gaze'].attrs['lost_samples'] == 0
+    # 300 Hz, recorded with their original timing:
+    assert 20 < len(recorded) <= 70
+    assert numpy.all(numpy.diff(recorded[:,0]) > 0)
+    # The recording is replayed with the same gaze positions and pupil sizes:
+    replayed_stream = open_gaze_stream('replay', window_size, time.perf_counter, replay_file = recording)
+    time.sleep(0.1)
+    replayed_stream.close()
+    replayed = replayed_stream.get_new_samples()
+    assert len(replayed) > 10
+    numpy.testing.assert_allclose(replayed[:,1:], recorded[:len(replayed),1:])
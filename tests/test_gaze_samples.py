@@ -0,0 +1,30 @@
+'''GAZE SAMPLES TESTS'''
+# Ring buffer and gaze quality of gaze_samples.py.
+
+import numpy
+from gaze_samples import GazeBuffer, write_ring_buffer
+
+def test_ring_buffer_keeps_newest_rows():
+    ring_buffer = numpy.zeros((4, 1))
+    counter = write_ring_buffer(ring_buffer, 3, numpy.arange(6).reshape(-1, 1))
+    assert counter == 7
+    # Rows 2 to 5 remain, row 5 is the last written row:
+    assert sorted(ring_buffer[:,0]) == [2, 3, 4, 5]
+    assert ring_buffer[(counter - 1) % 4, 0] == 5
+
+def test_quality_of_samples_since_start_time():
+    gaze_buffer = GazeBuffer(8)
+    samples = numpy.zeros((6, 6))
+    samples[:,0] = numpy.arange(6)
+    samples[:,1] = [0, 3, 3, 3, 3, 3]
+    samples[:,2] = [0, 4, 4, 4, 4, 4]
+    samples[:,3:5] = 3
+    samples[:,5] = [1, 1, 1, 1, 1, 0]
+    gaze_buffer.store(samples)
+    gaze_quality = gaze_buffer.compute_quality(1)
+    assert gaze_quality['gaze_samples'] == 5
+    assert gaze_quality['gaze_valid_ratio'] == 0.8
+    assert gaze_quality['gaze_mean_offset'] == 5
+    assert gaze_quality['gaze_dispersion'] == 0
+    gaze_buffer.reset()
+    assert gaze_buffer.compute_quality(0) == {'gaze_samples': 0}
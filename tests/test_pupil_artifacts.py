@@ -0,0 +1,23 @@
+'''PUPIL ARTIFACTS TESTS'''
+# Speed criterion and interpolation of clean_pupil().
+
+import numpy
+from pupil_artifacts import clean_pupil, speed_mask, validity_mask
+
+times = numpy.arange(300) / 300
+
+def test_zero_deviation_rejects_nothing_by_speed():
+    # Quantized pupil sizes: most speeds are 0, thus the median absolute deviation is 0.
+    pupil = numpy.full(len(times), 3.0)
+    pupil[100:150] = 3.01
+    assert not speed_mask(times, pupil, validity_mask(pupil), 16).any()
+    [cleaned, artifacts] = clean_pupil(times, pupil)
+    assert not artifacts.any()
+    numpy.testing.assert_array_equal(cleaned, pupil)
+
+def test_blink_is_interpolated():
+    pupil = 3 + 0.01 * numpy.sin(times * 10)
+    pupil[100:130] = numpy.nan
+    [cleaned, artifacts] = clean_pupil(times, pupil)
+    assert artifacts[100:130].all()
+    assert not numpy.isnan(cleaned[100:130]).any()
@@ -0,0 +1,68 @@
+'''PUPIL PREPROCESSING TESTS'''
+# Preprocessing, cache and resume of pupil_preprocessing.py with a synthetic session.
+
+import os
+import numpy
+import pytest
+import pupil_preprocessing
+from pupil_preprocessing import preprocess_session_task
+from trigger_backends import trigger_log_dtype
+
+session_name = 'visual_1_2024-05-01-1030'
+
+# 20 s of samples at 100 Hz: white slide (pupil 3 mm), black slide (5 mm) and one trial (4 mm):
+@pytest.fixture
+def session(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    samples = numpy.zeros(2000, dtype = [('time', 'f8'), ('device_time', 'f8'), ('left_pupil_measure1', 'f4'), ('right_pupil_measure1', 'f4')])
+    samples['time'] = numpy.arange(2000) / 100
+    pupil = numpy.where(samples['time'] < 7, 3.0, numpy.where(samples['time'] < 13, 5.0, 4.0))
+    samples['left_pupil_measure1'] = pupil
+    samples['right_pupil_measure1'] = pupil
+    hdf5_filename = tmp_path / (session_name + '.hdf5')
+    with h5py.File(hdf5_filename, 'w') as hdf5_file:
+        hdf5_file.create_dataset('data_collection/events/eyetracker/BinocularEyeSampleEvent', data = samples)
+    trials_filename = tmp_path / (session_name + '.csv')
+    trials_filename.write_text('phase,trial,baseline_trial_counter,oddball_trial_counter,timestamp_exp,stimulus_duration,ISI_duration\n'
+        'baseline_calibration,baseline_whiteslide,1,,1.0,5.0,\n'
+        'baseline_calibration,baseline_blackslide,2,,7.0,5.0,\n'
+        'experiment,oddball,,1,14.0,0.5,1.5\n')
+    trigger_log = numpy.zeros(2, dtype = trigger_log_dtype)
+    trigger_log['trigger_name'] = [b'trial', b'oddball_shigh_uhigh']
+    trigger_log['time_exp'] = [14.0, 14.5]
+    trigger_log.tofile(tmp_path / (session_name + '_trigger_log.bin'))
+    output_folder = tmp_path / 'pupil_preprocessing'
+    output_folder.mkdir()
+    return [[session_name, trials_filename, hdf5_filename], output_folder]
+
+def run(session, force = False):
+    return preprocess_session_task([session[0], session[1], 'exp', force])['status']
+
+def test_session_is_preprocessed(session):
+    assert run(session) == 'processed'
+    with numpy.load(session[1] / (session_name + '_pupil.npz')) as result:
+        assert [float(result['white_slide_pupil']), float(result['black_slide_pupil'])] == pytest.approx([3, 5])
+        assert list(result['condition']) == ['oddball_shigh_uhigh']
+        # 4 mm between white (0) and black slide (1):
+        assert numpy.nanmean(result['epochs']) == pytest.approx(0.5)
+
+def test_unchanged_session_is_skipped(session, monkeypatch):
+    assert run(session) == 'processed'
+    assert run(session) == 'cached'
+    # Only the modification time changes:
+    os.utime(session[0][1], ns = (1, 1))
+    assert run(session) == 'cached'
+    assert run(session, force = True) == 'processed'
+    # Changed parameters:
+    monkeypatch.setitem(pupil_preprocessing.parameters, 'interpolation', 'cubic')
+    assert run(session) == 'processed'
+    assert run(session) == 'cached'
+    # Changed trial data:
+    with open(session[0][1], 'a') as trials_file:
+        trials_file.write('experiment,standard,,2,17.0,0.5,1.5\n')
+    assert run(session) == 'processed'
+
+def test_failed_session_is_reported(session):
+    session[0][2].write_bytes(b'no datastore')
+    assert run(session).startswith('failed')
+    assert not (session[1] / (session_name + '_pupil.npz')).exists()
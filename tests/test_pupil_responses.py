@@ -0,0 +1,34 @@
+'''PUPIL RESPONSES TESTS'''
+# Evaluation of stimulus onsets by PupilResponseEngine.
+
+import numpy
+from pupil_responses import PupilResponseEngine
+
+times = numpy.arange(0, 4, 1/300)
+
+def samples_with_dilation(onset, dilation = 0.2, duration = 0.5):
+    samples = numpy.zeros((len(times), 6))
+    samples[:,0] = times
+    samples[:,3:5] = 3 + dilation * ((times >= onset) & (times < onset + duration))[:,None]
+    samples[:,5] = 1
+    return samples
+
+def test_response_is_evaluated_when_window_is_complete():
+    pupil_engine = PupilResponseEngine(interpolation = None)
+    stimulus_number = pupil_engine.register_trial(2.0, 'oddball_++', {'trial': 'oddball'})
+    samples = samples_with_dilation(2.0)
+    pupil_engine.feed(samples[times < 3])
+    assert pupil_engine.pop_result(stimulus_number) == {}
+    pupil_engine.feed(samples[times >= 3])
+    pupil_response = pupil_engine.pop_result(stimulus_number)
+    assert pupil_response['pupil_baseline'] == 3
+    assert pupil_response['pupil_peak_dilation'] == 0.2
+    assert [key for [key, count, mean, standard_deviation] in pupil_engine.get_summary()] == [('trial', 'oddball'), 'oddball_++']
+
+def test_results_of_earlier_stimuli_are_dropped():
+    pupil_engine = PupilResponseEngine(response_window = 0.5)
+    first_stimulus = pupil_engine.register_trial(1.0, 'standard', {})
+    second_stimulus = pupil_engine.register_trial(2.0, 'standard', {})
+    pupil_engine.feed(samples_with_dilation(2.0))
+    assert 'pupil_peak_dilation' in pupil_engine.pop_result(second_stimulus)
+    assert pupil_engine.pop_result(first_stimulus) == {}
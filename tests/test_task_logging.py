@@ -0,0 +1,47 @@
+'''TASK LOGGING TESTS'''
+# Dropped and late records of the asynchronous logging of task_logging.py.
+
+import logging, queue, sys, time
+import pytest
+from task_logging import NonBlockingQueueHandler, QueueConsole, TaskLogListener, setup_task_logging
+
+def test_full_queue_drops_records():
+    statistics = {'dropped': 0, 'late': 0}
+    record_queue = queue.Queue(2)
+    handler = NonBlockingQueueHandler(record_queue, statistics)
+    for number in range(3):
+        handler.handle(logging.makeLogRecord({'name': 'root', 'msg': 'record %d', 'args': (number,)}))
+    console = QueueConsole(record_queue, statistics)
+    console.write('console text')
+    assert statistics['dropped'] == 2
+    # The message is merged with its arguments before it is queued:
+    assert [record_queue.get_nowait().msg for number in range(2)] == ['record 0', 'record 1']
+
+def test_late_records_are_counted(tmp_path):
+    statistics = {'dropped': 0, 'late': 0}
+    file_handler = logging.FileHandler(str(tmp_path / 'task.log'))
+    listener = TaskLogListener(queue.Queue(), file_handler, sys.stdout, statistics, late_cutoff = 0.5)
+    listener.handle(logging.makeLogRecord({'name': 'root', 'msg': 'in time'}))
+    listener.handle(logging.makeLogRecord({'name': 'root', 'msg': 'late', 'created': time.time() - 1}))
+    file_handler.close()
+    assert statistics['late'] == 1
+    assert (tmp_path / 'task.log').read_text().splitlines() == ['in time', 'late']
+
+@pytest.fixture
+def task_log(tmp_path):
+    root_handlers = list(logging.getLogger().handlers)
+    root_level = logging.getLogger().level
+    stdout = sys.stdout
+    task_log = setup_task_logging(str(tmp_path / 'task.log'), '%(levelname)s %(message)s', queue_size = 10)
+    yield task_log
+    task_log.stop()
+    sys.stdout = stdout
+    logging.getLogger().handlers = root_handlers
+    logging.getLogger().setLevel(root_level)
+
+def test_stop_writes_records_and_counts(task_log, tmp_path):
+    logging.info(' TRIAL %d', 1)
+    print('console text')
+    # Queued records are written at stop, followed by the summary:
+    task_log.stop()
+    assert (tmp_path / 'task.log').read_text().splitlines() == ['INFO  TRIAL 1', 'INFO LOGGING: 0 DROPPED RECORDS, 0 LATE RECORDS']
@@ -0,0 +1,45 @@
+'''TRIAL REPETITIONS TESTS'''
+# Scheduling of failed trials with TrialRepetitions, driven like gated_trials() in both tasks.
+
+from trial_repetitions import TrialRepetitions
+
+# Run a block of conditions, trials in failed_trials (numbers of regular trials) fail once, or always with fail_repetitions:
+def run_block(conditions, failed_trials, budget, fail_repetitions = False):
+    trial_repetitions = TrialRepetitions(budget)
+    presented = list() # [condition, repetition_of]
+    for trial_number, condition in enumerate(conditions):
+        remaining_trials = len(conditions) - trial_number - 1
+        presented.append([condition, None])
+        passed = trial_number not in failed_trials
+        while True:
+            if not passed:
+                trial_repetitions.schedule(condition, trial_number, remaining_trials)
+            due_repetition = trial_repetitions.pop_due(remaining_trials)
+            if due_repetition is None:
+                break
+            [condition, repetition_of] = due_repetition
+            presented.append([condition, repetition_of])
+            passed = not fail_repetitions
+    return presented
+
+def test_failed_trial_is_inserted_once():
+    conditions = ['standard'] * 8 + ['oddball'] * 2
+    # Positions are random, thus several blocks:
+    for block in range(20):
+        presented = run_block(conditions, failed_trials = [8], budget = 10)
+        repetitions = [trial for trial in presented if trial[1] is not None]
+        assert repetitions == [['oddball', 8]]
+        # Inserted after the failed trial, the regular trials keep their order:
+        assert presented.index(['oddball', 8]) > 8
+        assert [trial for trial in presented if trial[1] is None] == [[condition, None] for condition in conditions]
+
+def test_repetition_budget_is_respected():
+    conditions = ['standard', 'oddball'] * 5
+    presented = run_block(conditions, failed_trials = range(10), budget = 3, fail_repetitions = True)
+    repetitions = [trial for trial in presented if trial[1] is not None]
+    assert len(repetitions) == 3
+    assert len(presented) == 13
+
+def test_repetition_after_last_trial_is_due():
+    presented = run_block(['standard', 'oddball'], failed_trials = [1], budget = 1)
+    assert presented[-1] == ['oddball', 1]
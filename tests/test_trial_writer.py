@@ -0,0 +1,73 @@
+'''TRIAL WRITER TESTS'''
+# Round trip of trial rows through TrialWriter, the Parquet table and load_trial_tables().
+
+import os
+import numpy, pytest
+pytest.importorskip('pyarrow')
+pytest.importorskip('pandas')
+from trial_writer import open_trial_writer, load_trial_data, load_trial_tables
+
+# Rows as written by exp.nextEntry(): numpy scalars, lists of response times, missing columns and strings:
+rows = [
+    {'trial': 'standard', 'oddball_trial_counter': 1, 'ISI_duration': numpy.float64(2.301), 'responses_rt': [],
+        'trial_quality_passed': True, 'timestamp_tracker': numpy.int64(1234567890)},
+    {'trial': 'oddball', 'oddball_trial_counter': 2, 'ISI_duration': 2.4, 'responses_rt': [0.41, numpy.float64(0.52)],
+        'trial_quality_passed': False, 'feedback': 'correct response'},
+    {'trial': 'standard', 'oddball_trial_counter': 3, 'ISI_duration': 2, 'responses_rt': (0.3,),
+        'trial_quality_passed': True, 'timestamp_tracker': 1234999999}]
+
+def write_session(folder, session = 'visual_123_2024-05-01-1030'):
+    jsonl_filename = os.path.join(folder, session + '_trials.jsonl')
+    table_filename = os.path.join(folder, session + '_trials.parquet')
+    trial_writer = open_trial_writer(jsonl_filename, frame_duration = 1/60, table_filename = table_filename)
+    for row in rows:
+        trial_writer.write(row)
+    return [trial_writer, jsonl_filename, table_filename]
+
+def test_parquet_round_trip(tmp_path):
+    [trial_writer, jsonl_filename, table_filename] = write_session(str(tmp_path))
+    trial_writer.close()
+    trials = load_trial_tables([table_filename])
+    assert list(trials['session']) == ['visual_123_2024-05-01-1030'] * 3
+    assert list(trials['trial']) == ['standard', 'oddball', 'standard']
+    assert trials['oddball_trial_counter'].dtype == numpy.int64
+    assert trials['ISI_duration'].dtype == numpy.float64
+    assert list(trials['ISI_duration']) == [2.301, 2.4, 2.0]
+    assert trials['trial_quality_passed'].dtype == bool
+    # Responses are a list column, not stringified lists:
+    assert [list(value) for value in trials['responses_rt']] == [[], [0.41, 0.52], [0.3]]
+    # Rows without a column are null:
+    assert trials['feedback'].isna().tolist() == [True, False, True]
+    assert numpy.isnan(trials['timestamp_tracker'][1])
+    # The JSON lines file holds the same rows:
+    assert list(load_trial_data(jsonl_filename)['trial']) == ['standard', 'oddball', 'standard']
+
+def test_parquet_only_written_at_close(tmp_path):
+    [trial_writer, jsonl_filename, table_filename] = write_session(str(tmp_path))
+    # Before close (e.g. after a crash) only the JSON lines file exists:
+    assert not os.path.exists(table_filename)
+    assert len(load_trial_data(jsonl_filename)) == 3
+    trial_writer.close()
+    assert os.path.exists(table_filename)
+
+def test_list_column_types(tmp_path):
+    import pyarrow, pyarrow.parquet
+    table_filename = str(tmp_path / 'visual_123_2024-05-01-1030_trials.parquet')
+    trial_writer = open_trial_writer(str(tmp_path / 'visual_123_2024-05-01-1030_trials.jsonl'), frame_duration = 1/60,
+        table_filename = table_filename)
+    # Arrays, integer items, missing items, only empty lists, lists of strings and lists mixed with scalars:
+    trial_writer.write({'responses_timestamp': numpy.array([12.5, 13.25]), 'responses_rt': [1, None],
+        'no_responses': [], 'keys': ['space'], 'mixed': [0.1]})
+    trial_writer.write({'responses_timestamp': [], 'responses_rt': [0.4], 'no_responses': (), 'mixed': 0.2})
+    trial_writer.close()
+    schema = pyarrow.parquet.read_schema(table_filename)
+    for name in ['responses_timestamp', 'responses_rt', 'no_responses']:
+        assert schema.field(name).type == pyarrow.list_(pyarrow.float64())
+    # Lists that are not numeric in every row are stored as strings:
+    assert schema.field('keys').type == pyarrow.string()
+    assert schema.field('mixed').type == pyarrow.string()
+    trials = load_trial_tables([table_filename])
+    assert [list(value) for value in trials['responses_timestamp']] == [[12.5, 13.25], []]
+    assert list(trials['responses_rt'][0])[0] == 1.0 and numpy.isnan(list(trials['responses_rt'][0])[1])
+    assert trials['keys'][0] == "['space']"
+    assert trials['keys'].isna().tolist() == [False, True]
@@ -0,0 +1,106 @@
+'''TRIGGER BACKENDS TESTS'''
+# Trigger table, pulses and trigger log of TriggerSender with the recorder backend.
+
+import ast, os, time
+import numpy
+import pytest
+from trigger_backends import RecorderBackend, TriggerSender, compile_trigger_table, compile_condition_triggers, trigger_log_dtype
+
+task_scripts = ['visual_oddball.py', 'auditory_oddball.py']
+
+# Literal setting of a task script, e.g. trigger_name_list:
+def task_setting(script, name):
+    filename = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), script)
+    with open(filename, encoding = 'utf-8') as task_file:
+        tree = ast.parse(task_file.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and getattr(node.targets[0], 'id', None) == name:
+            return ast.literal_eval(node.value)
+
+@pytest.mark.parametrize('script', task_scripts)
+def test_task_trigger_table(script):
+    trigger_name_list = task_setting(script, 'trigger_name_list')
+    trigger_table = compile_trigger_table(trigger_name_list)
+    assert len(trigger_table) == len(trigger_name_list)
+    assert trigger_table['trial'] == trigger_name_list.index('trial')
+    assert max(trigger_table.values()) <= 255
+
+def test_trigger_table_is_validated():
+    with pytest.raises(ValueError, match = 'defined twice'):
+        compile_trigger_table(['PLACEHOLDER', 'trial', 'trial'])
+    with pytest.raises(ValueError, match = '8 bits'):
+        compile_trigger_table(['code_' + str(trigger_value) for trigger_value in range(257)])
+
+def visual_condition_trigger_name(block, trial, salience, utility):
+    prefix = {('oddball_block', 'standard'): 'standard', ('oddball_block', 'oddball'): 'oddball',
+        ('practice_block', 'standard'): 'pract_standard', ('practice_block', 'oddball'): 'practoddball'}
+    level = {'+': 'high', '-': 'low'}
+    return prefix[(block, trial)] + '_s' + level[salience] + '_u' + level[utility]
+
+def test_visual_condition_triggers():
+    trigger_table = compile_trigger_table(task_setting('visual_oddball.py', 'trigger_name_list'))
+    condition_triggers = compile_condition_triggers(trigger_table, task_setting('visual_oddball.py', 'condition_trigger_base'),
+        task_setting('visual_oddball.py', 'condition_bit_fields'), visual_condition_trigger_name)
+    assert len(condition_triggers) == 16
+    assert condition_triggers[('oddball_block', 'standard', '+', '+')] == 'standard_shigh_uhigh'
+    # S16 + 8 (practice block) + 4 (oddball) + 2 (low salience) + 1 (low utility):
+    assert trigger_table[condition_triggers[('practice_block', 'oddball', '-', '-')]] == 31
+
+def test_auditory_condition_triggers():
+    trigger_table = compile_trigger_table(task_setting('auditory_oddball.py', 'trigger_name_list'))
+    # S2 + 4 (reversed block) + 2 (standard) + 1 (500 Hz):
+    bit_fields = {'trial': {'oddball': 0, 'standard': 2, 'oddball_rev': 4, 'standard_rev': 6}, 'pitch': {750: 0, 500: 1}}
+    condition_triggers = compile_condition_triggers(trigger_table, 2, bit_fields, lambda trial, pitch: trial + '_' + str(pitch) + 'Hz')
+    assert len(condition_triggers) == 8
+    assert trigger_table[condition_triggers[('standard', 500)]] == 5
+
+def test_condition_triggers_are_validated():
+    trigger_table = compile_trigger_table(['PLACEHOLDER', 'a_x', 'a_y', 'b_x', 'b_y'])
+    def trigger_name(trial, level):
+        return trial + '_' + level
+    assert compile_condition_triggers(trigger_table, 1, {'trial': {'a': 0, 'b': 2}, 'level': {'x': 0, 'y': 1}}, trigger_name) == {
+        ('a', 'x'): 'a_x', ('a', 'y'): 'a_y', ('b', 'x'): 'b_x', ('b', 'y'): 'b_y'}
+    with pytest.raises(ValueError, match = 'used twice'):
+        compile_condition_triggers(trigger_table, 1, {'trial': {'a': 0, 'b': 1}, 'level': {'x': 0, 'y': 1}}, trigger_name)
+    with pytest.raises(ValueError, match = 'does not match'):
+        compile_condition_triggers(trigger_table, 1, {'trial': {'a': 0, 'b': 4}, 'level': {'x': 0, 'y': 1}}, trigger_name)
+    with pytest.raises(ValueError, match = '8 bits'):
+        compile_condition_triggers(trigger_table, 256, {'trial': {'a': 0, 'b': 2}, 'level': {'x': 0, 'y': 1}}, trigger_name)
+
+def test_queued_triggers_keep_minimum_gap_and_are_logged(tmp_path):
+    port = RecorderBackend()
+    log_filename = tmp_path / 'trigger_log.bin'
+    # Log buffer of two entries, the third entry is written to the spare buffer:
+    trigger_sender = TriggerSender(port, time.perf_counter, pulse_duration = 0.005, trigger_min_gap = 0.01,
+        log_filename = log_filename, log_size = 2)
+    trigger_sender.start()
+    results = [trigger_sender.send(value, name) for [value, name] in [[1, 'trial'], [2, 'standard'], [3, 'response']]]
+    trigger_sender.wait()
+    assert [queued for [trigger_time, queued] in results] == [False, True, True]
+
+    # Every trigger is a single write followed by a reset, pins stay low for the minimum gap.
+    # The recorder takes its timestamps after the write, thus 0.1 ms tolerance:
+    [timestamps, values] = port.get_writes()
+    assert list(values) == [1, 0, 2, 0, 3, 0]
+    assert numpy.all(timestamps[1::2] - timestamps[0::2] >= 0.0049)
+    assert numpy.all(timestamps[2::2] - timestamps[1:-1:2] >= 0.0099)
+
+    trigger_sender.set_tracker_offset(100.0, time_exp = 0)
+    trigger_sender.set_tracker_offset(100.0, time_exp = 1e9)
+    assert trigger_sender.flush_log() == 3
+    trigger_log = numpy.fromfile(log_filename, dtype = trigger_log_dtype)
+    assert list(trigger_log['trigger_value']) == [1, 2, 3]
+    assert list(trigger_log['trigger_name']) == [b'trial', b'standard', b'response']
+    # Queued triggers are logged at the port write with the delay since send():
+    assert trigger_log['queue_delay'][0] < 0.001
+    assert numpy.all(trigger_log['queue_delay'][1:] > 0.005)
+    assert trigger_log['time_exp'][1] == pytest.approx(results[1][0] + trigger_log['queue_delay'][1])
+    assert numpy.allclose(trigger_log['time_tracker'], trigger_log['time_exp'] + 100)
+    assert trigger_sender.flush_log() == 0
+
+def test_tracker_offset_is_interpolated():
+    trigger_sender = TriggerSender(None, time.perf_counter)
+    assert numpy.isnan(trigger_sender.tracker_times(numpy.array([1.0]))).all()
+    trigger_sender.set_tracker_offset(10.0, time_exp = 0)
+    trigger_sender.set_tracker_offset(10.2, time_exp = 100)
+    assert list(trigger_sender.tracker_times(numpy.array([-5.0, 50.0, 200.0]))) == pytest.approx([5.0, 60.1, 210.2])
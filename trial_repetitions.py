@@ -0,0 +1,32 @@
+'''TRIAL REPETITIONS'''
+# Repetitions of trials that failed the data quality gate in both tasks (repeat_failed_trials = True).
+# For further information see README.md.
+
+'''LOAD MODULES'''
+import random
+
+'''TRIAL REPETITIONS'''
+# A failed trial is scheduled at a random position of the remaining trials of its block,
+# at most budget times per block. Positions are counted as the number of remaining trials of the trial handler,
+# a repetition is due after the trial that leaves this number of trials (after the last trial all are due).
+class TrialRepetitions:
+    def __init__(self, budget):
+        self.repetitions_left = budget
+        self.scheduled = list() # [number of remaining trials when due, condition, number of the failed trial]
+
+    # Schedule the repetition of a failed trial, returns False if the budget is used up.
+    # trial_number is the thisN of the regular trial, also if a repetition failed again:
+    def schedule(self, condition, trial_number, remaining_trials):
+        if self.repetitions_left <= 0:
+            return False
+        self.repetitions_left -= 1
+        self.scheduled.append([random.randint(0, max(remaining_trials - 1, 0)), condition, trial_number])
+        return True
+
+    # Next due repetition with remaining_trials left: [condition, number of the failed trial], None if no repetition is due:
+    def pop_due(self, remaining_trials):
+        for repetition in self.scheduled:
+            if repetition[0] >= remaining_trials:
+                self.scheduled.remove(repetition)
+                return repetition[1:]
+        return None
@@ -0,0 +1,166 @@
+'''TRIAL WRITER'''
+# Crash-safe trial data of both tasks: every row of exp.nextEntry() is appended immediately as one JSON line,
+# in addition to the files of the ExperimentHandler that are only written at exit.
+# The file is written as <filename>.part, flushed after every row (data survives a crash of the script)
+# and synced to disk at block boundaries (data survives a reboot). When the writer is closed,
+# the file is renamed to <filename> (atomic). Optionally, the rows are also saved as a typed table
+# (Parquet, requires pyarrow) with native scalar columns and list columns for per-trial arrays
+# (e.g. responses_rt). The table is built from the rows kept in memory and only written when the writer is closed:
+# after a crash there is no Parquet file, the rows are read from the JSON lines file with load_trial_data().
+# For further information see README.md.
+
+'''LOAD MODULES'''
+import json, logging, os, time
+import numpy
+
+# numpy values (e.g. numpy.float64, arrays) and other objects in trial data:
+def to_json_value(value):
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    return str(value)
+
+# Plain Python values for the typed table: numpy values are converted, tuples and arrays become lists:
+def to_table_value(value):
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, (numpy.ndarray, list, tuple)):
+        return [to_table_value(item) for item in value]
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+'''TYPED TABLE'''
+# Column type from all values of a column: bool, int64, float64, list of float64 or string (everything else).
+# Missing values (rows without the column) are stored as null.
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def column_type(values):
+    import pyarrow
+    values = [value for value in values if value is not None]
+    if not values:
+        return pyarrow.string()
+    if all(isinstance(value, bool) for value in values):
+        return pyarrow.bool_()
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+        return pyarrow.int64()
+    if all(is_number(value) for value in values):
+        return pyarrow.float64()
+    if all(isinstance(value, list) and all(is_number(item) or item is None for item in value) for value in values):
+        return pyarrow.list_(pyarrow.float64())
+    return pyarrow.string()
+
+def to_table(rows):
+    import pyarrow
+    column_names = list(dict.fromkeys(name for row in rows for name in row))
+    columns = dict()
+    for name in column_names:
+        values = [row.get(name) for row in rows]
+        data_type = column_type(values)
+        if data_type == pyarrow.string():
+            values = [None if value is None else str(value) for value in values]
+        elif data_type == pyarrow.float64():
+            values = [None if value is None else float(value) for value in values]
+        elif data_type == pyarrow.list_(pyarrow.float64()):
+            values = [None if value is None else [None if item is None else float(item) for item in value] for value in values]
+        columns[name] = pyarrow.array(values, type = data_type)
+    return pyarrow.table(columns)
+
+# Write rows (list of dicts) as Parquet file, via a temporary file that is renamed (atomic):
+def write_trial_table(rows, filename):
+    import pyarrow.parquet
+    pyarrow.parquet.write_table(to_table(rows), filename + '.part')
+    os.replace(filename + '.part', filename)
+
+'''WRITER'''
+class TrialWriter:
+    def __init__(self, filename, frame_duration, table_filename = None):
+        self.filename = filename
+        self.table_filename = table_filename
+        # Rows of the typed table, pyarrow is imported here so that a missing package is noticed at the start:
+        self.table_rows = list()
+        if table_filename is not None:
+            import pyarrow.parquet
+        self.part_filename = filename + '.part'
+        self.frame_duration = frame_duration
+        self.file = open(self.part_filename, 'w', encoding = 'utf-8')
+        self.rows = 0
+        self.syncs = 0
+        # Write cost of every row (seconds), rows slower than one frame are counted:
+        self.write_durations = list()
+        self.slow_writes = 0
+        self.closed = False
+
+    # Append one row (dict) and pass it to the operating system:
+    def write(self, row):
+        if self.closed:
+            return
+        write_start = time.perf_counter()
+        self.file.write(json.dumps(row, default = to_json_value) + '\n')
+        self.file.flush()
+        if self.table_filename is not None:
+            self.table_rows.append({name: to_table_value(value) for (name, value) in row.items()})
+        write_duration = time.perf_counter() - write_start
+        self.write_durations.append(write_duration)
+        if write_duration > self.frame_duration:
+            self.slow_writes += 1
+        self.rows += 1
+
+    # Force written rows to disk, called at block boundaries (outside the frame loops):
+    def sync(self):
+        if self.closed:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.syncs += 1
+
+    def close(self):
+        if self.closed:
+            return
+        self.sync()
+        self.file.close()
+        self.closed = True
+        os.replace(self.part_filename, self.filename)
+        if self.table_filename is not None and self.table_rows:
+            write_trial_table(self.table_rows, self.table_filename)
+        if self.write_durations:
+            summary = 'TRIAL WRITER: {} ROWS, WRITE COST MEAN {:.6f} S, MAX {:.6f} S, {} WRITES LONGER THAN ONE FRAME'.format(
+                self.rows, numpy.mean(self.write_durations), numpy.max(self.write_durations), self.slow_writes)
+            logging.info(summary)
+            print(summary.lower())
+
+# Open a trial writer, frame_duration (seconds) is the budget of one row.
+# With a table_filename, the rows are additionally saved as Parquet file when the writer is closed:
+def open_trial_writer(filename, frame_duration, table_filename = None):
+    return TrialWriter(filename, frame_duration, table_filename)
+
+'''LOADER'''
+# Read trial data into a pandas DataFrame, also from an unfinished file (<filename>.part) after a crash.
+# A last row that was not written completely is skipped:
+def load_trial_data(filename):
+    import pandas
+    if not os.path.exists(filename) and os.path.exists(filename + '.part'):
+        filename = filename + '.part'
+    rows = list()
+    with open(filename, encoding = 'utf-8') as file:
+        lines = file.read().splitlines()
+    for line_number, line in enumerate(lines):
+        try:
+            rows.append(json.loads(line))
+        except json.JSONDecodeError:
+            if line_number < len(lines) - 1:
+                raise
+    return pandas.DataFrame(rows)
+
+# Read the typed tables of many sessions into one pandas DataFrame, the column session is the filename
+# without _trials.parquet (e.g. visual_123_2024-05-01-1030):
+def load_trial_tables(filenames):
+    import pandas, pyarrow.parquet
+    sessions = list()
+    for filename in filenames:
+        session = pyarrow.parquet.read_table(filename).to_pandas()
+        session.insert(0, 'session', os.path.basename(str(filename)).replace('_trials.parquet', ''))
+        sessions.append(session)
+    return pandas.concat(sessions, ignore_index = True)
@@ -0,0 +1,329 @@
+'''TRIGGER BACKENDS'''
+# Backends for sending EEG triggers, used by send_trigger() in both tasks and by trigger_benchmark.py.
+# Every backend provides setData(value) like psychopy.parallel.ParallelPort,
+# thus the tasks use each backend as "port". TriggerSender sends the pulses and writes the trigger log
+# for the tasks and the benchmark. For further information see README.md.
+
+'''LOAD MODULES'''
+import socket, threading, time, collections, itertools
+import numpy
+
+'''BACKENDS'''
+# Parallel port of the presentation PC (requires inpout32.dll, see README.md):
+class ParallelPortBackend:
+    def __init__(self, parallel_port_adress):
+        from psychopy import parallel
+        self.port = parallel.ParallelPort(parallel_port_adress)
+
+    def setData(self, value):
+        self.port.setData(value)
+
+    def close(self):
+        self.port.setData(0)
+
+# Recorder: every write is stored with a timestamp in a preallocated ring buffer.
+# If a filename is given, the buffer is saved as .npz file when the backend is closed.
+class RecorderBackend:
+    def __init__(self, buffer_size = 65536, filename = None):
+        self.timestamps = numpy.zeros(buffer_size)
+        self.values = numpy.zeros(buffer_size, dtype = numpy.uint8)
+        self.write_counter = 0
+        self.filename = filename
+
+    def setData(self, value):
+        position = self.write_counter % len(self.values)
+        self.timestamps[position] = time.perf_counter()
+        self.values[position] = value
+        self.write_counter += 1
+
+    # Recorded writes in chronological order, oldest writes are overwritten if the buffer is full:
+    def get_writes(self):
+        buffer_size = len(self.values)
+        if self.write_counter <= buffer_size:
+            return [self.timestamps[:self.write_counter].copy(), self.values[:self.write_counter].copy()]
+        order = numpy.roll(numpy.arange(buffer_size), -(self.write_counter % buffer_size))
+        return [self.timestamps[order], self.values[order]]
+
+    def close(self):
+        if self.filename is not None:
+            [timestamps, values] = self.get_writes()
+            numpy.savez(self.filename, timestamps = timestamps, values = values)
+
+# Loopback: every write is sent as one byte through a local socket pair.
+# A reader thread receives and timestamps the bytes like the EEG recorder at the other end of the cable.
+class LoopbackBackend:
+    def __init__(self, buffer_size = 65536):
+        (self.sender, self.receiver) = socket.socketpair()
+        self.received = RecorderBackend(buffer_size)
+        self.reader = threading.Thread(target = self.read_loop, name = 'trigger_loopback', daemon = True)
+        self.reader.start()
+
+    def setData(self, value):
+        self.sender.send(bytes([value]))
+
+    def read_loop(self):
+        while True:
+            data = self.receiver.recv(4096)
+            if not data:
+                break
+            for value in data:
+                self.received.setData(value)
+
+    # Received values with receive timestamps:
+    def get_writes(self):
+        return self.received.get_writes()
+
+    def close(self):
+        self.sender.close()
+        self.reader.join()
+        self.receiver.close()
+
+# Open a trigger backend by name: 'parallel', 'recorder' or 'loopback':
+def open_trigger_port(trigger_backend, parallel_port_adress = None, filename = None):
+    if trigger_backend == 'parallel':
+        port = ParallelPortBackend(parallel_port_adress)
+    elif trigger_backend == 'recorder':
+        port = RecorderBackend(filename = filename)
+    elif trigger_backend == 'loopback':
+        port = LoopbackBackend()
+    else:
+        raise ValueError('trigger backend is not defined: ' + str(trigger_backend))
+    # Set all pins to low, otherwise no triggers will be sent.
+    port.setData(0)
+    return port
+
+'''TRIGGER TABLE'''
+# Trigger table of both tasks, compiled once: trigger name -> trigger value (position in trigger_name_list, S0-S255).
+# Names must be unique and values need to fit into one byte of the parallel port:
+def compile_trigger_table(trigger_name_list):
+    if len(trigger_name_list) > 256:
+        raise ValueError('trigger values do not fit into 8 bits: ' + str(len(trigger_name_list)) + ' trigger names')
+    trigger_table = dict()
+    for trigger_value, trigger_name in enumerate(trigger_name_list):
+        if trigger_name in trigger_table:
+            raise ValueError('trigger name is defined twice: ' + trigger_name)
+        trigger_table[trigger_name] = trigger_value
+    return trigger_table
+
+# Condition encoder of both tasks: the trigger value of a condition is base + the bits of its level in every field
+# (bit_fields: field -> {level: bits}), condition_trigger_name(*levels) returns its trigger name.
+# Returns the trigger name of every combination of levels (in the order of the fields): {levels: trigger name}.
+# Every derived value has to be unique, fit into 8 bits and match the position of its trigger name in the trigger table:
+def compile_condition_triggers(trigger_table, base, bit_fields, condition_trigger_name):
+    condition_triggers = dict()
+    condition_trigger_names = dict() # trigger value -> trigger name, to find collisions
+    for levels in itertools.product(*bit_fields.values()):
+        trigger_value = base + sum(bits[level] for bits, level in zip(bit_fields.values(), levels))
+        trigger_name = condition_trigger_name(*levels)
+        if trigger_value > 255:
+            raise ValueError('condition trigger does not fit into 8 bits: ' + trigger_name + ' = S' + str(trigger_value))
+        if trigger_value in condition_trigger_names:
+            raise ValueError('condition trigger value is used twice: S' + str(trigger_value)
+                + ' (' + condition_trigger_names[trigger_value] + ', ' + trigger_name + ')')
+        if trigger_table.get(trigger_name) != trigger_value:
+            raise ValueError('condition trigger does not match trigger_name_list: ' + trigger_name + ' = S' + str(trigger_value))
+        condition_trigger_names[trigger_value] = trigger_name
+        condition_triggers[levels] = trigger_name
+    return condition_triggers
+
+'''TRIGGER SENDER'''
+# Trigger log format:
+# Each entry holds trigger value and name with three clocks: task clock, time.time() and eye tracker time.
+# All times are in seconds: time_tracker is the eye tracker clock (tracker.trackerTime() converted to seconds,
+# e.g. Tobii system time / 1000000), nan without eye tracker.
+# All times are taken when the trigger value is written to the port. queue_delay is the time between
+# send() and the port write (seconds), e.g. a trigger that waited for the pulse and minimum gap of the previous trigger.
+# Read log file: numpy.fromfile(filename, dtype = trigger_log_dtype)
+trigger_log_dtype = numpy.dtype([
+    ('trigger_value', 'u1'),
+    ('trigger_name', 'S32'),
+    ('time_exp', 'f8'),
+    ('time_epoch', 'f8'),
+    ('time_tracker', 'f8'),
+    ('queue_delay', 'f8')])
+
+# Sends trigger pulses on a port (None = no port, e.g. testmode) and records every trigger in the trigger log.
+# Asynchronous pulses: the trigger value is written immediately, if the port is free. Otherwise it is queued.
+# A timer thread resets the pins after pulse duration, keeps the minimum gap between triggers and writes queued triggers.
+# Without asynchronous pulses, send() waits for the pulse duration.
+# Trigger log entries are written at the port write (also for queued triggers), collected in a preallocated buffer
+# and appended to the binary log file by flush_log() (between blocks). A full buffer is swapped with a spare buffer
+# and written at the next flush_log(), so the log file is never written while the lock is held.
+# No eye tracker call is made while sending: tracker times are computed at flush_log() from the task clock time
+# and the tracker clock offsets of set_tracker_offset() (sampled outside the frame loops, e.g. at every flush).
+# The offset is interpolated linearly between the last two samples (clock drift during a block),
+# entries before the first or after the last sample get the offset of that sample.
+class TriggerSender:
+    def __init__(self, port, clock, pulse_duration = 0.01, trigger_min_gap = 0.01, async_pulses = True,
+            log_filename = None, log_size = 4096):
+        self.port = port
+        self.clock = clock
+        self.pulse_duration = pulse_duration
+        self.trigger_min_gap = trigger_min_gap
+        self.async_pulses = async_pulses and port is not None
+        # Reentrant lock, log entries of both threads are written while it is held:
+        self.condition = threading.Condition()
+        self.pending_values = collections.deque() # [trigger value, trigger name, send time]
+        self.pulse_reset_time = None # pins are high until this time
+        self.port_free_time = 0 # next trigger is not sent before this time
+        self.log_filename = log_filename
+        self.log_buffer = numpy.zeros(log_size, dtype = trigger_log_dtype)
+        self.spare_log_buffer = numpy.zeros(log_size, dtype = trigger_log_dtype)
+        self.full_log_buffers = list() # written at the next flush_log()
+        self.log_counter = 0
+        # Last two samples of [task clock time, tracker time - task clock time] in seconds, nan = no eye tracker:
+        self.tracker_offsets = list()
+
+    # Start the timer thread of asynchronous pulses:
+    def start(self):
+        if self.async_pulses:
+            self.pulse_thread = threading.Thread(target = self.pulse_loop, name = 'trigger_pulses', daemon = True)
+            self.pulse_thread.start()
+
+    # Send a trigger and record it in the trigger log, returns [trigger time (task clock), queued].
+    # The trigger time is the time of the port write. A queued trigger is written later by the timer thread,
+    # then the time of the send() call is returned and its log entry is written at the port write:
+    def send(self, trigger_value, trigger_name):
+        send_time = self.clock()
+        if self.async_pulses:
+            return self.send_pulse_async(trigger_value, trigger_name, send_time)
+        trigger_time_epoch = time.time()
+        if self.port is not None:
+            # All eight data pins are set with a single write (pin 2 = S1 ... pin 9 = S128):
+            self.port.setData(trigger_value)
+            # Wait for pulse duration:
+            time.sleep(self.pulse_duration)
+            self.port.setData(0)
+        self.record(trigger_value, trigger_name, send_time, trigger_time_epoch, 0)
+        return [send_time, False]
+
+    # Set pins, plan reset and write the log entry, condition needs to be acquired.
+    # Trigger times are taken directly before the port is set, returns the trigger time:
+    def start_pulse(self, trigger_value, trigger_name, send_time):
+        trigger_time_exp = self.clock()
+        trigger_time_epoch = time.time()
+        self.port.setData(trigger_value)
+        self.pulse_reset_time = trigger_time_exp + self.pulse_duration
+        self.record(trigger_value, trigger_name, trigger_time_exp, trigger_time_epoch, trigger_time_exp - send_time)
+        return trigger_time_exp
+
+    # Send trigger without waiting for the pulse duration:
+    def send_pulse_async(self, trigger_value, trigger_name, send_time):
+        with self.condition:
+            if self.pulse_reset_time is None and not self.pending_values and self.clock() >= self.port_free_time:
+                result = [self.start_pulse(trigger_value, trigger_name, send_time), False]
+            else:
+                self.pending_values.append([trigger_value, trigger_name, send_time])
+                result = [send_time, True]
+            self.condition.notify()
+        return result
+
+    # Wait until the port is free (no pulse, no queued trigger and the minimum gap has elapsed),
+    # so that the next trigger is written without delay. Returns the waiting time:
+    def wait_for_port(self):
+        if not self.async_pulses:
+            return 0
+        wait_start = self.clock()
+        with self.condition:
+            while self.pulse_reset_time is not None or self.pending_values:
+                self.condition.wait(self.pulse_duration)
+            while self.clock() < self.port_free_time:
+                self.wait_until(self.port_free_time)
+        return self.clock() - wait_start
+
+    # Wait until deadline with high resolution. Lock is released while waiting.
+    # Last 2 ms are polled, as thread wake-up is not precise enough:
+    def wait_until(self, deadline):
+        remaining = deadline - self.clock()
+        if remaining > 0.002:
+            self.condition.wait(remaining - 0.002)
+        elif remaining > 0:
+            self.condition.wait(0)
+
+    # Timer thread: reset pins after pulse duration and send queued triggers:
+    def pulse_loop(self):
+        with self.condition:
+            while True:
+                if self.pulse_reset_time is not None:
+                    if self.clock() >= self.pulse_reset_time:
+                        self.port.setData(0)
+                        self.pulse_reset_time = None
+                        self.port_free_time = self.clock() + self.trigger_min_gap
+                        self.condition.notify_all()
+                    else:
+                        self.wait_until(self.pulse_reset_time)
+                elif self.pending_values:
+                    if self.clock() >= self.port_free_time:
+                        self.start_pulse(*self.pending_values.popleft())
+                    else:
+                        self.wait_until(self.port_free_time)
+                else:
+                    self.condition.wait()
+
+    # Wait until all triggers are sent and pins are low, e.g. before closing the experiment:
+    def wait(self):
+        if self.async_pulses:
+            with self.condition:
+                while self.pulse_reset_time is not None or self.pending_values:
+                    self.condition.wait(self.pulse_duration)
+
+    # Empty log buffer, the spare buffer if it is not in use. Condition needs to be acquired:
+    def take_log_buffer(self):
+        if self.spare_log_buffer is None:
+            return numpy.zeros(len(self.log_buffer), dtype = trigger_log_dtype)
+        log_buffer = self.spare_log_buffer
+        self.spare_log_buffer = None
+        return log_buffer
+
+    # Add trigger to trigger log buffer:
+    def record(self, trigger_value, trigger_name, trigger_time_exp, trigger_time_epoch, queue_delay):
+        if self.log_filename is None:
+            return
+        with self.condition:
+            # Buffer is full: keep it for the next flush and continue in an empty buffer, so that no entry is lost.
+            if self.log_counter == len(self.log_buffer):
+                self.full_log_buffers.append(self.log_buffer)
+                self.log_buffer = self.take_log_buffer()
+                self.log_counter = 0
+            entry = self.log_buffer[self.log_counter]
+            entry['trigger_value'] = trigger_value
+            entry['trigger_name'] = trigger_name
+            entry['time_exp'] = trigger_time_exp
+            entry['time_epoch'] = trigger_time_epoch
+            entry['queue_delay'] = queue_delay
+            self.log_counter += 1
+
+    # Tracker clock offset (tracker time - task clock time in seconds) sampled at time_exp (task clock, default: now):
+    def set_tracker_offset(self, tracker_offset, time_exp = None):
+        if time_exp is None:
+            time_exp = self.clock()
+        self.tracker_offsets = (self.tracker_offsets + [[time_exp, tracker_offset]])[-2:]
+
+    # Tracker times of task clock times, nan without tracker clock offset:
+    def tracker_times(self, times_exp):
+        if not self.tracker_offsets:
+            return numpy.full(len(times_exp), numpy.nan)
+        [sample_times, offsets] = numpy.array(self.tracker_offsets).T
+        return times_exp + numpy.interp(times_exp, sample_times, offsets)
+
+    # Append buffered entries to trigger log file (append-only), returns the number of entries.
+    # Queued triggers that are not yet written to the port are logged with the next flush:
+    def flush_log(self):
+        if self.log_filename is None:
+            return 0
+        # Buffers are swapped under the lock, the timer thread is not blocked while the file is written:
+        with self.condition:
+            log_buffers = self.full_log_buffers + [self.log_buffer[:self.log_counter]]
+            written_buffer = self.log_buffer
+            self.full_log_buffers = list()
+            self.log_buffer = self.take_log_buffer()
+            self.log_counter = 0
+        entries = numpy.concatenate(log_buffers)
+        with self.condition:
+            self.spare_log_buffer = written_buffer
+        if len(entries) == 0:
+            return 0
+        entries['time_tracker'] = self.tracker_times(entries['time_exp'])
+        with open(self.log_filename, 'ab') as trigger_log_file:
+            entries.tofile(trigger_log_file)
+        return len(entries)
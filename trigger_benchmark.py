@@ -0,0 +1,121 @@
+'''TRIGGER BENCHMARK'''
+# Fires thousands of trigger codes through send_trigger() and reports latency percentiles.
+# With trigger_backend = 'loopback' or 'recorder' no parallel port hardware is required,
+# e.g. to check trigger timing on a Linux build box. For further information see README.md.
+
+'''LOAD MODULES'''
+import time, os, tempfile
+import numpy
+# Trigger backends (parallel port, recorder, loopback) and trigger sender of both tasks:
+from trigger_backends import open_trigger_port, compile_trigger_table, TriggerSender, trigger_log_dtype
+
+'''SETUP'''
+# Benchmark settings:
+trigger_backend = 'loopback'
+parallel_port_adress = 0x03FF8
+number_of_triggers = 2000
+# Time between two send_trigger() calls, 25 ms ~ 1.5 frames at 60 Hz:
+trigger_interval = 0.025
+percentiles = [50, 90, 99, 100]
+
+# Trigger settings, as in both tasks:
+pulse_duration = 0.01
+async_trigger_pulses = True
+trigger_min_gap = 0.01
+record_trigger_log = True
+trigger_log_size = 4096
+# Trigger log of the benchmark, deleted at the end:
+trigger_log_filename = os.path.join(tempfile.gettempdir(), 'trigger_benchmark_trigger_log.bin')
+
+# Trigger values 1-255 are sent in turn:
+trigger_name_list = ['PLACEHOLDER'] + ['code_' + str(trigger_value) for trigger_value in range(1, 256)]
+trigger_table = compile_trigger_table(trigger_name_list)
+
+port = open_trigger_port(trigger_backend, parallel_port_adress = parallel_port_adress)
+# Same trigger sender as in both tasks, core.getTime() is replaced by time.perf_counter():
+trigger_sender = TriggerSender(
+    port,
+    clock = time.perf_counter,
+    pulse_duration = pulse_duration,
+    trigger_min_gap = trigger_min_gap,
+    async_pulses = async_trigger_pulses,
+    log_filename = trigger_log_filename if record_trigger_log else None,
+    log_size = trigger_log_size)
+if os.path.exists(trigger_log_filename):
+    os.remove(trigger_log_filename)
+
+'''FUNCTIONS'''
+# send_trigger() of both tasks without testmode and event log:
+def send_trigger(trigger_name):
+    trigger_value = trigger_table.get(trigger_name)
+    if trigger_value is None:
+        print('trigger name is not defined: ' + trigger_name)
+        return
+    trigger_sender.send(trigger_value, trigger_name)
+
+# Print percentiles of a duration array in milliseconds:
+def print_percentiles(name, durations):
+    if len(durations) == 0:
+        print(name + ': no data')
+        return
+    values = numpy.percentile(durations, percentiles) * 1000
+    text = ', '.join('p' + str(percentile) + ' = ' + str(round(value, 3)) for percentile, value in zip(percentiles, values))
+    print(name + ' [ms]: ' + text)
+
+'''BENCHMARK'''
+trigger_sender.start()
+
+print('trigger backend: ' + trigger_backend + ', number of triggers: ' + str(number_of_triggers))
+call_start_times = numpy.zeros(number_of_triggers)
+call_durations = numpy.zeros(number_of_triggers)
+sent_values = numpy.zeros(number_of_triggers, dtype = numpy.uint8)
+next_call_time = time.perf_counter()
+for trigger_counter in range(number_of_triggers):
+    # Wait for next call. Like the frame loop waiting for a flip, the waiting thread releases the GIL:
+    remaining = next_call_time - time.perf_counter()
+    if remaining > 0:
+        time.sleep(remaining)
+    trigger_value = trigger_counter % 255 + 1
+    call_start_times[trigger_counter] = time.perf_counter()
+    send_trigger(trigger_name_list[trigger_value])
+    call_durations[trigger_counter] = time.perf_counter() - call_start_times[trigger_counter]
+    sent_values[trigger_counter] = trigger_value
+    next_call_time += trigger_interval
+
+trigger_sender.wait()
+# Caller is blocked for this time (incl. trigger log entry), i.e. time that is missing in the frame loop:
+print_percentiles('send_trigger() call duration', call_durations)
+if record_trigger_log:
+    trigger_sender.flush_log()
+    trigger_log = numpy.fromfile(trigger_log_filename, dtype = trigger_log_dtype)
+    os.remove(trigger_log_filename)
+    print('trigger log entries: ' + str(len(trigger_log)))
+    # Time between send_trigger() and port write, e.g. triggers queued behind the previous pulse and minimum gap:
+    print_percentiles('queue delay (trigger log)', trigger_log['queue_delay'])
+
+# Recorder and loopback backends provide timestamps of all writes:
+if hasattr(port, 'get_writes'):
+    # Let loopback reader receive the last bytes:
+    time.sleep(0.1)
+    port.close()
+    [write_timestamps, write_values] = port.get_writes()
+    # First write is the initial reset of open_trigger_port():
+    write_timestamps = write_timestamps[1:]
+    write_values = write_values[1:]
+    code_writes = numpy.flatnonzero(write_values)
+    received_values = write_values[code_writes]
+    print('sent triggers: ' + str(number_of_triggers) + ', received triggers: ' + str(len(code_writes)))
+    if len(code_writes) == number_of_triggers and numpy.array_equal(received_values, sent_values):
+        print_percentiles('trigger latency (call to port)', write_timestamps[code_writes] - call_start_times)
+    else:
+        print('warning: received trigger values do not match sent values')
+    # Pulse width: code until next reset, gap: reset until next code.
+    reset_writes = code_writes + 1
+    complete_pulses = reset_writes < len(write_values)
+    print_percentiles('pulse width', write_timestamps[reset_writes[complete_pulses]] - write_timestamps[code_writes[complete_pulses]])
+    gaps = write_timestamps[code_writes[1:]] - write_timestamps[code_writes[1:] - 1]
+    print_percentiles('gap between triggers', gaps)
+    merged_triggers = numpy.count_nonzero(write_values[code_writes[1:] - 1] != 0)
+    print('merged triggers (no reset between two codes): ' + str(merged_triggers))
+else:
+    port.close()
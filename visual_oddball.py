@@ -3,19 +3,41 @@
 
 '''LOAD MODULES'''
 # Core libraries
-from psychopy import visual, core, event, clock, data, gui, monitors, parallel
+from psychopy import visual, core, event, clock, data, gui, monitors
 import random, time, numpy
 # For controlling eyetracker and eye-tracking SDK
 import tobii_research
 from psychopy.iohub import launchHubServer
 # For getting keyboard input
 from psychopy.hardware import keyboard
+# Trigger backends (parallel port, recorder, loopback):
+from trigger_backends import open_trigger_port, compile_trigger_table, compile_condition_triggers, TriggerSender
+# In-process gaze acquisition (Tobii SDK callback or simulated eye tracker):
+from gaze_acquisition import open_gaze_stream
+# Eye sample arrays and the gaze quality ring buffer:
+from gaze_samples import gaze_samples_to_array, GazeBuffer
+# Gaze polling thread:
+from gaze_polling import GazePoller, GazeState
 # Library for managing paths
 from pathlib import Path
 # For logging data in a .log file:
 import logging
+# Log file and console output are written by a listener thread:
+from task_logging import setup_task_logging
+# Structured event log (JSON lines):
+from event_log import open_event_log, log_event
+# Crash-safe trial data (JSON lines):
+from trial_writer import open_trial_writer
+# Online pupil responses:
+from pupil_responses import PupilResponseEngine
+# Flip deadlines of timed events:
+from deadline_scheduler import DeadlineScheduler
+# Repetitions of trials that failed the data quality gate:
+from trial_repetitions import TrialRepetitions
 from datetime import datetime
 import os
+# The iohub connection is shared with the gaze polling thread:
+import threading
 # Miscellaneous: Hide messages in console from pygame:
 from os import environ 
 environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1' 
@@ -28,10 +50,10 @@ formatted_datetime = str(current_datetime.strftime("%Y-%m-%d %H-%M-%S"))
 logging_path = Path("Desktop", "tasks", "data", "visual_oddball", "logging_data").resolve()
 filename_visual_oddball = os.path.join(logging_path, formatted_datetime)
 
-logging.basicConfig(
-    level = logging.DEBUG,
-    filename = filename_visual_oddball,
-    filemode = 'w', # w = write, for each subject an separate log file.
+# Log records and print() output are queued and written by a listener thread, see task_logging.py.
+# For each subject a separate log file is written.
+task_log = setup_task_logging(
+    filename_visual_oddball,
     format = '%(asctime)s:%(levelname)s:%(name)s:%(message)s')
     
 print("THIS IS VISUAL ODDBALL.")
@@ -69,6 +91,66 @@ black_slide = 'black'
 baseline_duration = 5 
 #  After 500ms the no data detection warning should be displayed on screen.
 no_data_warning_cutoff = 0.5
+# Frame timing recorder (optional): flip timestamps of each trial are stored to detect dropped frames.
+record_frame_timing = False
+# Preallocated number of flip timestamps per trial, 36000 frames = 10 minutes at 60 Hz.
+max_frames_per_trial = 36000
+# Deadline scheduling (optional): events end on absolute flip deadlines planned from session start,
+# FALSE = durations are translated to a number of frames.
+deadline_scheduling = False
+# After untimed phases (e.g. instructions, dialogs) longer than this cutoff, the schedule restarts at the next flip.
+schedule_resync_cutoff = 0.5
+# Flip-locked triggers (optional): condition triggers are sent on the flip that starts the stimulus,
+# FALSE = condition triggers are sent before the first flip.
+flip_locked_triggers = False
+# Batched gaze samples (optional): gaze contingent checks use all eye samples since the last flip (300 Hz),
+# FALSE = only the latest gaze position of each flip is checked.
+batched_gaze_samples = False
+# Gaze offset is detected if at least this number of samples of one flip exceed gaze_offset_cutoff:
+gaze_offset_min_samples = 2
+# Samples older than this (in seconds) are not checked, e.g. samples recorded during the stimulus:
+gaze_sample_max_age = 0.05
+# Gaze quality (optional): eye samples of each fixation cross are stored to compute gaze and pupil metrics per trial.
+# Adds one tracker call per flip, unless batched_gaze_samples = True.
+record_gaze_quality = False
+# Preallocated number of samples, 8192 samples = 27 seconds at 300 Hz.
+gaze_buffer_size = 8192
+# Gaze acquisition for the gaze contingent checks: 'iohub' (default), 'tobii' = in-process gaze data
+# subscription of the Tobii SDK without iohub IPC, 'replay' = simulated eye tracker replaying gaze_replay_file.
+# iohub keeps recording in both cases.
+gaze_acquisition = 'iohub'
+# HDF5 file of a previous session (<fileName>_gaze.hdf5), None = simulated central fixation with blinks.
+gaze_replay_file = None
+# Gaze polling thread (optional): gaze data is read continuously by a worker thread,
+# the frame loop only reads the latest gaze state and never waits for the eye tracker.
+gaze_polling_thread = False
+# Time between two polls of the worker thread, in seconds:
+gaze_polling_interval = 0.002
+# Online pupil responses (optional): pre-stimulus baseline and peak dilation of every stimulus,
+# running mean and variance of the peak dilation per condition are shown at each baseline phase.
+online_pupil_responses = False
+# Baseline before and response window after stimulus onset, in seconds:
+pupil_baseline_duration = 0.5
+pupil_response_window = 1.5
+# Blinks and artifacts in baseline and response window are interpolated: 'linear', 'cubic' or None (only valid samples are used).
+pupil_interpolation = 'linear'
+# Data quality gate (optional): oddball block trials with too little gaze data or too much gaze offset
+# during the ISI are repeated at a random position of the remaining block, at most trial_repetition_budget times per block.
+repeat_failed_trials = False
+min_valid_fraction = 0.8
+max_offset_fraction = 0.2
+trial_repetition_budget = 10
+# Quiet mode: no console output during trial phases (log file is written as usual).
+quiet_console = False
+# Structured event log: trial starts, stimulus onsets, ISI results, pauses, no data, gaze offsets,
+# triggers and responses are written to <fileName>_events.jsonl in the trialdata folder.
+record_event_log = True
+# Crash-safe trial data: every row of exp.nextEntry() is written directly to <fileName>_trials.jsonl
+# (in addition to the files of the ExperimentHandler, which are written at exit).
+record_trial_rows = True
+# Typed trial table: the rows are additionally saved as <fileName>_trials.parquet at the end,
+# with native columns and list columns for responses (requires record_trial_rows and pyarrow).
+record_trial_table = False
 # One baseline assessment (black and white screen) at the beginning of the experiment:
 baseline_calibration_repetition = 1
 # Settings are stored automatically for each trial.
@@ -79,6 +161,16 @@ rewarded_responses = list()
 # EEG trigger variables. 10ms duration of trigger signal:
 pulse_duration = 0.01 
 parallel_port_adress = 0x03FF8
+# Asynchronous trigger pulses: pins are reset by a timer thread, FALSE = send_trigger() waits for pulse duration.
+async_trigger_pulses = True
+# Minimum time all pins stay low between two consecutive triggers, so that triggers never merge:
+trigger_min_gap = 0.01
+# Trigger backend: 'parallel' = parallel port, 'recorder' = triggers are saved to file, 'loopback' = local socket.
+trigger_backend = 'parallel'
+# Trigger log: every sent trigger is saved with experiment, epoch and eye-tracker time in a binary file.
+record_trigger_log = True
+# Preallocated number of trigger log entries, buffer is written to file between blocks:
+trigger_log_size = 4096
 
 # Presenting a dialog box. Infos are added to "settings".
 # id = 123 is used as default testing value.
@@ -102,8 +194,13 @@ exp = data.ExperimentHandler(
     extraInfo = settings,
     dataFileName = str(trials_data_folder / fileName),
     )
+
 str(trials_data_folder / fileName),
 
+# Structured event log, written by the logging listener thread:
+if record_event_log:
+    task_log.add_handler('events', open_event_log(str(trials_data_folder / (fileName + '_events.jsonl')), clock = core.getTime))
+
 # Monitor seettings: Distance is from screen in cm.
 mon = monitors.Monitor(
     name = 'eizo_eyetracker',
@@ -124,12 +221,21 @@ mywin = visual.Window(
 refresh_rate = mywin.monitorFramePeriod 
 print('monitor refresh rate: ' + str(round(refresh_rate, 3)) + ' seconds')
 
+# Crash-safe trial data, the write cost of each row is compared with one frame:
+trial_writer = None
+if record_trial_rows:
+    trial_table_filename = str(trials_data_folder / (fileName + '_trials.parquet')) if record_trial_table else None
+    trial_writer = open_trial_writer(str(trials_data_folder / (fileName + '_trials.jsonl')), frame_duration = refresh_rate,
+        table_filename = trial_table_filename)
+
 # SETUP EYETRACKING
 # Output gazeposition is alwys centered, i.e. screen center = [0,0].
 if testmode:
     logging.info(' TESTMODE = TRUE.')
     print('mouse is used to mimic eyetracker...')
     iohub_config = {'eyetracker.hw.mouse.EyeTracker': {'name': 'tracker'}}
+    # Seconds per unit of tracker.trackerTime(), the mouse eye tracker returns seconds:
+    tracker_time_unit = 1
 if not testmode:
     logging.info(' TESTMODE = FALSE')
     # Search for eye tracker:
@@ -147,6 +253,8 @@ if not testmode:
     # Define a config that allows iohub to connect to the eye-tracker:
     iohub_config = {'eyetracker.hw.tobii.EyeTracker':
         {'name': 'tracker', 'runtime_settings': {'sampling_rate': 300, }}}
+    # Seconds per unit of tracker.trackerTime(), the Tobii eye tracker returns its system time in microseconds:
+    tracker_time_unit = 0.000001
 
 # IOHUB creates a different instance that records eye tracking data in hdf5 file saved in datastore_name:
 io = launchHubServer(**iohub_config,
@@ -159,6 +267,17 @@ io = launchHubServer(**iohub_config,
 tracker = io.devices.tracker
 tracker.setRecordingState(True)
 
+# In-process gaze acquisition (optional), samples are streamed to <fileName>_gaze.hdf5:
+gaze_stream = None
+if gaze_acquisition != 'iohub':
+    gaze_stream = open_gaze_stream(
+        gaze_acquisition,
+        window_size = mywin.size,
+        clock = core.getTime,
+        eyetracker = None if testmode else my_eyetracker,
+        replay_file = gaze_replay_file,
+        filename = str(eyetracking_data_folder / (fileName + '_gaze.hdf5')))
+
 #SETUP PARALLEL PORT TRIGGER
 # List position defines trigger value that is sent, see function send_trigger(),
 # i.e. list position 2 will send a trigger with value "S2".
@@ -198,184 +317,297 @@ trigger_name_list = ['PLACEHOLDER', #0
 
 print(trigger_name_list)
 
-# Find a parallel port:
+# Trigger table is compiled once: trigger name -> trigger value (S0-S255), see trigger_backends.py.
+trigger_table = compile_trigger_table(trigger_name_list)
+
+# Condition encoder: trigger values of the ball conditions are composed of bit fields,
+# S16 + 8 (practice block) + 4 (oddball) + 2 (low salience) + 1 (low utility).
+# The condition table is compiled once: (block, trial, salience, utility) -> [trigger name, ball size],
+# thus present_ball() needs a single lookup per trial. Every derived value has to be unique,
+# fit into 8 bits and match the position of its trigger name in trigger_name_list.
+condition_trigger_base = 16
+condition_bit_fields = {
+    'block': {'oddball_block': 0, 'practice_block': 8},
+    'trial': {'standard': 0, 'oddball': 4},
+    'salience': {'+': 0, '-': 2},
+    'utility': {'+': 0, '-': 1}}
+condition_name_prefix = {
+    ('oddball_block', 'standard'): 'standard',
+    ('oddball_block', 'oddball'): 'oddball',
+    ('practice_block', 'standard'): 'pract_standard',
+    ('practice_block', 'oddball'): 'practoddball'}
+condition_name_level = {'+': 'high', '-': 'low'}
+
+def condition_trigger_name(block, trial, salience, utility):
+    return condition_name_prefix[(block, trial)] + '_s' + condition_name_level[salience] + '_u' + condition_name_level[utility]
+
+# Trigger values are checked in compile_condition_triggers(), see trigger_backends.py:
+condition_table = dict()
+for [(block, trial, salience, utility), trigger_name] in compile_condition_triggers(
+        trigger_table, condition_trigger_base, condition_bit_fields, condition_trigger_name).items():
+    if trial == 'standard':
+        ball_size = standard_ball_size
+    elif salience == '+':
+        ball_size = high_salience_ball_size
+    else:
+        ball_size = low_salience_ball_size
+    condition_table[(block, trial, salience, utility)] = [trigger_name, ball_size]
+
+# Find a parallel port or open another trigger backend, all pins are set to low:
+port = None
 if not testmode:
-    port = parallel.ParallelPort(parallel_port_adress) 
-    # Set all pins to low, otherwise no triggers will be sent.
-    port.setData(0)
+    port = open_trigger_port(
+        trigger_backend,
+        parallel_port_adress = parallel_port_adress,
+        filename = str(trials_data_folder / (fileName + '_triggers')))
+# Trigger pulses and trigger log (trigger_backends.TriggerSender, also used by trigger_benchmark.py):
+trigger_sender = TriggerSender(
+    port,
+    clock = core.getTime,
+    pulse_duration = pulse_duration,
+    trigger_min_gap = trigger_min_gap,
+    async_pulses = async_trigger_pulses,
+    log_filename = str(trials_data_folder / (fileName + '_trigger_log.bin')) if record_trigger_log else None,
+    log_size = trigger_log_size)
 
 # SETUP KEYBOARD
 kb = keyboard.Keyboard()
 
 '''FUNCTIONS'''
+def start_trigger_pulse_thread():
+    if trigger_sender.async_pulses:
+        trigger_sender.start()
+        logging.info(' ASYNCHRONOUS TRIGGER PULSES STARTED.')
+
+# Wait until all triggers are sent and pins are low, e.g. before closing the experiment:
+def wait_for_trigger_pulses():
+    trigger_sender.wait()
+
+# Wait until pulse and minimum gap of the previous trigger have elapsed, called before the stimulus,
+# so that the condition trigger is not queued behind the trial trigger. The schedule is shifted by the waiting time:
+def wait_for_trigger_port():
+    port_wait = trigger_sender.wait_for_port()
+    extend_event(port_wait)
+    return port_wait
+
+# Next row of the experiment handler, the complete row (incl. loop data and settings) is written directly:
+def next_entry():
+    exp.nextEntry()
+    if trial_writer is not None:
+        trial_writer.write(exp.entries[-1])
+
+# Offset of the eye tracker clock to core.getTime() in seconds, the tracker time is taken between two core.getTime() calls
+# and converted to seconds (see tracker_time_unit):
+def sample_tracker_offset():
+    time_before = core.getTime()
+    tracker_time = get_tracker_time() * tracker_time_unit
+    time_after = core.getTime()
+    return tracker_time - (time_before + time_after) / 2
+
+# Append buffered entries to trigger log file (append-only), called outside the frame loops.
+# Tracker times of the entries are computed from the tracker clock offsets of this and the last flush (interpolated),
+# send_trigger() makes no iohub call:
+def flush_trigger_log():
+    trigger_sender.set_tracker_offset(sample_tracker_offset())
+    number_of_entries = trigger_sender.flush_log()
+    if number_of_entries > 0:
+        logging.info(' TRIGGER LOG: ' f'{number_of_entries}' ' ENTRIES WRITTEN.')
+
 # Send a trigger to EEG recording PC via parallel port:
 def send_trigger(trigger_name):
-    trigger_name_found = False
-    for i in trigger_name_list:
-        if i == trigger_name:
-            trigger_value = trigger_name_list.index(trigger_name)
-            trigger_byte = f'{trigger_value:08b}'
-            if not testmode:
-                port.setPin(2, int(trigger_byte[7]))
-                port.setPin(3, int(trigger_byte[6]))
-                port.setPin(4, int(trigger_byte[5]))
-                port.setPin(5, int(trigger_byte[4]))
-                port.setPin(6, int(trigger_byte[3]))
-                port.setPin(7, int(trigger_byte[2]))
-                port.setPin(8, int(trigger_byte[1]))
-                port.setPin(9, int(trigger_byte[0]))
-                # Wait for pulse duration:
-                time.sleep(pulse_duration)
-                port.setData(0)
-            if testmode:
-                print('sent DUMMY trigger S' + str(trigger_value))
-                logging.info(' DUMMY TRIGGER WAS SENT: S' f'{trigger_value}')
-                
-            trigger_name_found = True
-    if not trigger_name_found:
-         print('trigger name is not defined: ' + trigger_name)
-         logging.info(' trigger name is not defined: ' f'{trigger_name}')
-
-# Draw instruction slides:
-def draw_instruction(text, background_color = background_color_rgb):
-    if background_color is not background_color_rgb:
+    trigger_value = trigger_table.get(trigger_name)
+    if trigger_value is None:
+        print('trigger name is not defined: ' + trigger_name)
+        logging.info(' trigger name is not defined: ' f'{trigger_name}')
+        return
+    # All eight data pins are set with a single write (pin 2 = S1 ... pin 9 = S128),
+    # the trigger log is written after the port, so that it does not delay the trigger:
+    [trigger_time_exp, trigger_queued] = trigger_sender.send(trigger_value, trigger_name)
+    if testmode:
+        print('sent DUMMY trigger S' + str(trigger_value))
+        logging.info(' DUMMY TRIGGER WAS SENT: S' f'{trigger_value}')
+    # A queued trigger waits for pulse and minimum gap of the previous trigger, its port write is in the trigger log:
+    log_event('trigger', time = trigger_time_exp, trigger_value = trigger_value, trigger_name = trigger_name, queued = trigger_queued)
+    return [trigger_time_exp, trigger_queued]
+
+# Stimulus cache:
+# PsychoPy objects are built once per key and afterwards only drawn inside the frame loops.
+# Each entry holds a list of stimuli which are drawn in list order.
+stimulus_cache = {}
+
+# Build all stimuli that belong to a cache key:
+def build_stimuli(key):
+    stimulus_type = key[0]
+
+    if stimulus_type == 'background':
+        (stimulus_type, background_color) = key
         background_rect = visual.Rect(
             win = mywin,
             size = mywin.size,
             fillColor = background_color)
-        background_rect.draw()
+        return [background_rect]
 
-    instruction_slide = visual.TextStim(
-        win = mywin,
-        text = text,
-        color = 'black',
-        units = 'pix',
-        wrapWidth = 900,
-        height = size_fixation_cross_in_pixels)
-    instruction_slide.draw()
+    if stimulus_type == 'instruction':
+        (stimulus_type, text, size) = key
+        instruction_slide = visual.TextStim(
+            win = mywin,
+            text = text,
+            color = 'black',
+            units = 'pix',
+            wrapWidth = 900,
+            height = size)
+        return [instruction_slide]
+
+    if stimulus_type == 'fixcross':
+        (stimulus_type, cross_color, size) = key
+        line1 = visual.Line(win = mywin, units = 'pix', lineColor = cross_color) 
+        line1.start = [-(size/2), 0]
+        line1.end = [+(size/2), 0]
+        line2 = visual.Line(win = mywin, units = 'pix', lineColor = cross_color) 
+        line2.start = [0, -(size/2)]
+        line2.end = [0, +(size/2)]
+        return [line1, line2]
+
+    if stimulus_type == 'gazedirect':
+        (stimulus_type, background_color, size) = key
+        # Parameters:
+        function_color = 'red'
+        arrow_size_pix = size
+        arrow_pos_offset = 5
+        width = 3
+
+        rect1 = visual.Rect(
+            win = mywin,
+            units = 'pix',
+            lineColor = function_color,
+            fillColor = background_color,
+            lineWidth = width,
+            size = size*6)
+
+        # Arrow left:
+        al_line1 = visual.Line(win = mywin, units = 'pix', lineColor=function_color, lineWidth=width)
+        al_line1.start = [-(arrow_size_pix*arrow_pos_offset), 0]
+        al_line1.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+        al_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth=width)
+        al_line2.start = [-(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), -arrow_size_pix/2]
+        al_line2.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+        al_line3 = visual.Line(win = mywin, units = 'pix', lineColor=function_color, lineWidth=width)
+        al_line3.start = [-(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), +arrow_size_pix/2]
+        al_line3.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+
+        # Arrow right:
+        ar_line1 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ar_line1.start = [+(arrow_size_pix*arrow_pos_offset), 0]
+        ar_line1.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+        ar_line2 = visual.Line(win = mywin, units='pix', lineColor = function_color, lineWidth = width)
+        ar_line2.start = [+(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), -arrow_size_pix/2]
+        ar_line2.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+        ar_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ar_line3.start = [+(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), +arrow_size_pix/2]
+        ar_line3.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
+
+        # Arrow top:
+        at_line1 = visual.Line(win = mywin, units='pix', lineColor = function_color, lineWidth = width)
+        at_line1.start = [0, +(arrow_size_pix*arrow_pos_offset)]
+        at_line1.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+        at_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        at_line2.start = [-arrow_size_pix/2, +(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
+        at_line2.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+        at_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        at_line3.start = [+arrow_size_pix/2, +(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
+        at_line3.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+
+        # Arrow bottom:
+        ab_line1 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth=width)
+        ab_line1.start = [0, -(arrow_size_pix*arrow_pos_offset)]
+        ab_line1.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+        ab_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ab_line2.start = [+arrow_size_pix/2, -(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
+        ab_line2.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+        ab_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
+        ab_line3.start = [-arrow_size_pix/2, -(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
+        ab_line3.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
+
+        # Draw order: arrows first, then the frame around the fixation area.
+        return [al_line1, al_line2, al_line3,
+                ar_line1, ar_line2, ar_line3,
+                at_line1, at_line2, at_line3,
+                ab_line1, ab_line2, ab_line3,
+                rect1]
+
+    if stimulus_type == 'nodata':
+        (stimulus_type, text, size) = key
+        no_data_warning = visual.TextStim(
+            win = mywin,
+            text = text,
+            color = 'red',
+            units = 'pix',
+            height = size)
+        return [no_data_warning]
+
+    if stimulus_type == 'ball':
+        (stimulus_type, ball_color, size) = key
+        circle1 = visual.Circle(
+            win = mywin,
+            radius = size,
+            units = 'pix',
+            fillColor = ball_color,
+            interpolate = True)
+        return [circle1]
+
+# Draw cached stimuli. Stimuli are only built, if key was not requested before:
+def draw_cached(key):
+    if key not in stimulus_cache:
+        stimulus_cache[key] = build_stimuli(key)
+    for stimulus in stimulus_cache[key]:
+        stimulus.draw()
+
+# Build all stimuli of the frame loops before the experiment starts:
+def warm_up_stimulus_cache():
+    timestamp = core.getTime()
+    for background_color in [background_color_rgb, white_slide, black_slide]:
+        draw_cached(('background', background_color))
+        draw_cached(('gazedirect', background_color, size_fixation_cross_in_pixels))
+    for cross_color in ['black', 'grey']:
+        draw_cached(('fixcross', cross_color, size_fixation_cross_in_pixels))
+    draw_cached(('nodata', 'AUGEN NICHT ERKANNT!', size_fixation_cross_in_pixels))
+    for ball_size in [standard_ball_size, high_salience_ball_size, low_salience_ball_size]:
+        draw_cached(('ball', standard_ball_color, ball_size))
+    # Warm-up stimuli are drawn once, but never shown on screen:
+    mywin.clearBuffer()
+    warm_up_duration = round(core.getTime()-timestamp,3)
+    number_of_objects = sum(len(stimuli) for stimuli in stimulus_cache.values())
+    print('stimulus cache: ' + str(number_of_objects) + ' objects, warm-up duration: ' + str(warm_up_duration))
+    logging.info(' STIMULUS CACHE: ' f'{number_of_objects}' ' OBJECTS, WARM-UP DURATION: ' f'{warm_up_duration}')
+    return [number_of_objects, warm_up_duration]
+
+# Draw instruction slides:
+def draw_instruction(text, background_color = background_color_rgb):
+    if background_color is not background_color_rgb:
+        draw_cached(('background', background_color))
+    draw_cached(('instruction', text, size_fixation_cross_in_pixels))
 
 # Draw fixation cross from lines:
 def draw_fixcross(
     background_color = background_color_rgb,
     cross_color = 'black'):
     if background_color is not background_color_rgb:
-        background_rect = visual.Rect(
-            win = mywin,
-            size = mywin.size,
-            fillColor = background_color)
-        background_rect.draw()
-    line1 = visual.Line(win = mywin, units = 'pix', lineColor = cross_color) 
-    line1.start = [-(size_fixation_cross_in_pixels/2), 0]
-    line1.end = [+(size_fixation_cross_in_pixels/2), 0]
-    line2 = visual.Line(win = mywin, units = 'pix', lineColor = cross_color) 
-    line2.start = [0, -(size_fixation_cross_in_pixels/2)]
-    line2.end = [0, +(size_fixation_cross_in_pixels/2)]
-    line1.draw()
-    line2.draw()
+        draw_cached(('background', background_color))
+    draw_cached(('fixcross', cross_color, size_fixation_cross_in_pixels))
 
 # Draw figure for gaze contincency, when gaze is offset:
 def draw_gazedirect(background_color = background_color_rgb):
         # Adapt background according to provided "background color"
     if background_color is not background_color_rgb:
-        background_rect = visual.Rect(
-            win = mywin,
-            size = mywin.size,
-            fillColor = background_color)
-        background_rect.draw()
-    # Parameters:
-    function_color = 'red'
-    arrow_size_pix = size_fixation_cross_in_pixels
-    arrow_pos_offset = 5
-    width = 3
-
-    rect1 = visual.Rect(
-        win = mywin,
-        units = 'pix',
-        lineColor = function_color,
-        fillColor = background_color,
-        lineWidth = width,
-        size = size_fixation_cross_in_pixels*6)
-
-    # Arrow left:
-    al_line1 = visual.Line(win = mywin, units = 'pix', lineColor=function_color, lineWidth=width)
-    al_line1.start = [-(arrow_size_pix*arrow_pos_offset), 0]
-    al_line1.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-    al_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth=width)
-    al_line2.start = [-(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), -arrow_size_pix/2]
-    al_line2.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-    al_line3 = visual.Line(win = mywin, units = 'pix', lineColor=function_color, lineWidth=width)
-    al_line3.start = [-(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), +arrow_size_pix/2]
-    al_line3.end = [-(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-
-    # Arrow right:
-    ar_line1 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    ar_line1.start = [+(arrow_size_pix*arrow_pos_offset), 0]
-    ar_line1.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-    ar_line2 = visual.Line(win = mywin, units='pix', lineColor = function_color, lineWidth = width)
-    ar_line2.start = [+(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), -arrow_size_pix/2]
-    ar_line2.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-    ar_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    ar_line3.start = [+(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2)), +arrow_size_pix/2]
-    ar_line3.end = [+(arrow_size_pix*arrow_pos_offset-arrow_size_pix), 0]
-
-    # Arrow top:
-    at_line1 = visual.Line(win = mywin, units='pix', lineColor = function_color, lineWidth = width)
-    at_line1.start = [0, +(arrow_size_pix*arrow_pos_offset)]
-    at_line1.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-    at_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    at_line2.start = [-arrow_size_pix/2, +(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
-    at_line2.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-    at_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    at_line3.start = [+arrow_size_pix/2, +(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
-    at_line3.end = [0, +(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-
-    # Arrow bottom:
-    ab_line1 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth=width)
-    ab_line1.start = [0, -(arrow_size_pix*arrow_pos_offset)]
-    ab_line1.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-    ab_line2 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    ab_line2.start = [+arrow_size_pix/2, -(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
-    ab_line2.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-    ab_line3 = visual.Line(win = mywin, units = 'pix', lineColor = function_color, lineWidth = width)
-    ab_line3.start = [-arrow_size_pix/2, -(arrow_size_pix*arrow_pos_offset-(arrow_size_pix/2))]
-    ab_line3.end = [0, -(arrow_size_pix*arrow_pos_offset-arrow_size_pix)]
-
-    # Draw all:
-    al_line1.draw()
-    al_line2.draw()
-    al_line3.draw()
-
-    ar_line1.draw()
-    ar_line2.draw()
-    ar_line3.draw()
-
-    at_line1.draw()
-    at_line2.draw()
-    at_line3.draw()
-
-    ab_line1.draw()
-    ab_line2.draw()
-    ab_line3.draw()
-
-    rect1.draw()
+        draw_cached(('background', background_color))
+    draw_cached(('gazedirect', background_color, size_fixation_cross_in_pixels))
 
 # Feedback indicating that no eyes are currently detected thus eye tracking data is NA:
 def draw_nodata_info(background_color = background_color_rgb):
     # Adapt background according to provided "background color":
     if background_color is not background_color_rgb:
-        background_rect = visual.Rect(
-            win = mywin,
-            size = mywin.size,
-            fillColor = background_color)
-        background_rect.draw()
-
-    no_data_warning = visual.TextStim(
-        win = mywin,
-        text = 'AUGEN NICHT ERKANNT!',
-        color = 'red',
-        units = 'pix',
-        height = size_fixation_cross_in_pixels)
-    no_data_warning.draw()
+        draw_cached(('background', background_color))
+    draw_cached(('nodata', 'AUGEN NICHT ERKANNT!', size_fixation_cross_in_pixels))
 
 # Check for keypresses, used to pause and quit experiment:
 def check_keypress():
@@ -388,27 +620,47 @@ def check_keypress():
         dlg.addText('Do you really want to quit? - Then press OK')
         ok_data = dlg.show()  # show dialog and wait for OK or Cancel
         if dlg.OK:  # or if ok_data is not None
-            send_trigger('experiment_absorded')
+            send_trigger('experiment_aborted')
+            wait_for_trigger_pulses()
+            flush_trigger_log()
+            stop_gaze_polling_thread()
+            if gaze_stream is not None:
+                gaze_stream.close()
+            if trial_writer is not None:
+                trial_writer.close()
             print('EXPERIMENT ABORTED!')
+            # Write all queued log records:
+            task_log.stop()
             core.quit()
         else:
             send_trigger('pause_ended')
             print('Experiment continues...')
         pause_time = clock.getTime() - timestamp_keypress
+        log_event('pause', key = 'escape', pause_duration = round(pause_time,3))
     elif 'p' in keys:
         send_trigger('pause_initiated')
         dlg = gui.Dlg(title = 'Pause', labelButtonOK = 'Continue')
         dlg.addText('Experiment is paused - Press Continue, when ready')
         ok_data = dlg.show()  # show dialog and wait for OK
         pause_time = clock.getTime() - timestamp_keypress
-        send_trigger('pause ended')
+        send_trigger('pause_ended')
+        log_event('pause', key = 'p', pause_duration = round(pause_time,3))
     else:
         pause_time = 0
 
     pause_time = round(pause_time,3)
+    # The next flip interval contains the pause, see get_frame_timing():
+    if pause_time > 0:
+        mark_frame_pause()
     return pause_time
 
 def check_nodata(gaze_position):
+    # Gaze state of the polling thread:
+    if isinstance(gaze_position, GazeState):
+        return gaze_position.nodata
+    # Batch of samples: no data if none of the samples since the last flip contains gaze data.
+    if isinstance(gaze_position, numpy.ndarray):
+        return not numpy.any(~numpy.isnan(gaze_position[:,0]))
     if gaze_position == None:
         nodata_boolean = True
     else:
@@ -419,6 +671,16 @@ def check_nodata(gaze_position):
 # Then check for the offset of gaze from the center screen.
 def check_gaze_offset(gaze_position):
     # gaze_position = tracker.getPosition()
+    # Gaze state of the polling thread:
+    if isinstance(gaze_position, GazeState):
+        return gaze_position.offset
+    # Batch of samples: offset if enough samples since the last flip exceed the cutoff.
+    if isinstance(gaze_position, numpy.ndarray):
+        gaze_center_offsets = numpy.hypot(gaze_position[:,0], gaze_position[:,1])
+        number_of_valid_samples = numpy.count_nonzero(~numpy.isnan(gaze_center_offsets))
+        number_of_offset_samples = numpy.count_nonzero(gaze_center_offsets >= gaze_offset_cutoff)
+        # Short batches (e.g. a single sample) need fewer offset samples:
+        return number_of_offset_samples > 0 and number_of_offset_samples >= min(gaze_offset_min_samples, number_of_valid_samples)
     gaze_center_offset = numpy.sqrt((gaze_position[0])**2 + (gaze_position[1])**2) # Pythagoras theorem
     if gaze_center_offset >= gaze_offset_cutoff:
         offset_boolean = True
@@ -426,19 +688,360 @@ def check_gaze_offset(gaze_position):
         offset_boolean = False
     return offset_boolean
 
+# Gaze snapshot: every tracker call is an IPC round-trip to the iohub server process.
+# The gaze position is requested at most once per flip and shared by check_nodata(),
+# check_gaze_offset() and the loggers. Number and latency of tracker calls are counted per trial.
+flip_counter = 0 # flips since start, see flip_window()
+gaze_snapshot = {'flip': -1, 'position': None}
+tracker_call_counter = 0
+tracker_call_duration = 0
+tracker_call_max = 0
+# Time the main thread waited for the tracker lock (held by the gaze polling thread):
+tracker_lock_wait_duration = 0
+tracker_lock_wait_max = 0
+
+# The iohub connection is shared with the gaze polling thread, one request at a time:
+tracker_lock = threading.Lock()
+
+def call_tracker(tracker_method):
+    global tracker_call_counter, tracker_call_duration, tracker_call_max, tracker_lock_wait_duration, tracker_lock_wait_max
+    call_start = core.getTime()
+    with tracker_lock:
+        lock_wait = core.getTime() - call_start
+        result = tracker_method()
+    call_duration = core.getTime() - call_start
+    tracker_call_counter += 1
+    tracker_call_duration += call_duration
+    tracker_call_max = max(tracker_call_max, call_duration)
+    tracker_lock_wait_duration += lock_wait
+    tracker_lock_wait_max = max(tracker_lock_wait_max, lock_wait)
+    return result
+
+def read_gaze_position():
+    if gaze_stream is not None:
+        return gaze_stream.get_latest_position()
+    return tracker.getPosition()
+
+# Gaze position of the current flip, None if no eyes are detected:
+def get_gaze_position():
+    if gaze_polling_thread:
+        return gaze_poller.state.position
+    if gaze_snapshot['flip'] != flip_counter:
+        gaze_snapshot['position'] = call_tracker(read_gaze_position)
+        gaze_snapshot['flip'] = flip_counter
+    return gaze_snapshot['position']
+
+# Tracker time (unit of tracker.trackerTime(), see tracker_time_unit): with the gaze polling thread, it is converted
+# from core.getTime() with the clock pair published by the worker, so the main thread never waits for the tracker lock:
+def get_tracker_time():
+    if gaze_polling_thread:
+        tracker_time = gaze_poller.get_tracker_time(tracker_time_unit)
+        if tracker_time is not None:
+            return tracker_time
+    return call_tracker(tracker.trackerTime)
+
+# Batched gaze samples: all eye sample events since the last flip are drained with one tracker call.
+# Each row holds the gaze position [x, y] of one sample, NaN if no eye was detected.
+# recent holds the rows (all columns) of the last batch that was not empty.
+gaze_batch = {'flip': -1, 'samples': numpy.zeros((0, 2)), 'recent': numpy.zeros((0, 6))}
+
+def read_gaze_samples():
+    if gaze_stream is not None:
+        samples = gaze_stream.get_new_samples()
+    else:
+        samples = gaze_samples_to_array(tracker.getEvents())
+    if record_gaze_quality:
+        gaze_buffer.store(samples)
+    if online_pupil_responses:
+        pupil_engine.feed(samples)
+    return samples
+
+# Gaze samples of the current flip.
+# An empty batch (no new samples yet, iohub delivers samples in bursts) holds no new information:
+# the samples of the last batch are used again, as long as they are not older than gaze_sample_max_age.
+def get_gaze_samples():
+    if gaze_batch['flip'] != flip_counter:
+        samples = call_tracker(read_gaze_samples)
+        if len(samples) > 0:
+            gaze_batch['recent'] = samples
+        recent_samples = gaze_batch['recent'][gaze_batch['recent'][:,0] >= core.getTime() - gaze_sample_max_age]
+        gaze_batch['samples'] = recent_samples[:, 1:3]
+        gaze_batch['flip'] = flip_counter
+    return gaze_batch['samples']
+
+# Gaze data for check_nodata() and check_gaze_offset():
+def get_gaze_data():
+    if gaze_polling_thread:
+        return gaze_poller.state
+    if batched_gaze_samples:
+        return get_gaze_samples()
+    if record_gaze_quality or online_pupil_responses:
+        get_gaze_samples()
+    return get_gaze_position()
+
+# Gaze polling thread, see gaze_polling.py. With batched samples, the samples of the last frame are checked:
+gaze_poller = GazePoller(read_gaze_samples, read_gaze_position, check_nodata, check_gaze_offset, tracker_lock,
+    tracker.trackerTime, core.getTime, batched = batched_gaze_samples, read_samples = record_gaze_quality or online_pupil_responses,
+    sample_window = min(refresh_rate, gaze_sample_max_age), interval = gaze_polling_interval)
+
+def start_gaze_polling_thread():
+    if gaze_polling_thread:
+        gaze_poller.start()
+
+# Stop the worker and save its latency histogram as <fileName>_gaze_polling.csv:
+def stop_gaze_polling_thread():
+    if gaze_polling_thread and gaze_poller.running:
+        gaze_poller.close()
+        [number_of_polls, slowest_poll] = gaze_poller.save_histogram(trials_data_folder / (fileName + '_gaze_polling.csv'))
+        print('gaze polling: ' + str(number_of_polls) + ' polls, slowest poll < ' + str(round(slowest_poll * 1000, 1)) + ' ms')
+        logging.info(' GAZE POLLING: ' f'{number_of_polls}' ' POLLS, SLOWEST POLL < ' f'{round(slowest_poll * 1000, 1)}' ' MS')
+
+# Duration without gaze data: timed by the polling thread, otherwise counted in frames:
+def get_nodata_duration(gaze_position, counted_duration):
+    if isinstance(gaze_position, GazeState):
+        return gaze_position.nodata_duration
+    return counted_duration
+
+# Gaze quality of the fixation crosses, see gaze_samples.py:
+gaze_buffer = GazeBuffer(gaze_buffer_size)
+gaze_quality = dict()
+
+# Valid sample ratio, mean gaze offset from center, fixation dispersion and mean pupil size since start_time:
+def compute_gaze_quality(start_time):
+    gaze_quality.clear()
+    gaze_quality.update(gaze_buffer.compute_quality(start_time))
+    return gaze_quality
+
+# Add gaze quality of the last fixation cross to trial handler:
+def add_gaze_quality_data(handler):
+    for column, value in gaze_quality.items():
+        handler.addData(column, value)
+    gaze_quality.clear()
+
+# Online pupil responses, see pupil_responses.py:
+pupil_engine = PupilResponseEngine(pupil_baseline_duration, pupil_response_window, pupil_interpolation)
+pupil_stimulus_to_save = None # stimulus of the current trial, see add_pupil_response_data()
+
+def register_pupil_trial(onset_time, condition, factors):
+    global pupil_stimulus_to_save
+    if online_pupil_responses:
+        pupil_stimulus_to_save = pupil_engine.register_trial(onset_time, condition, factors)
+
+# Add baseline and peak dilation of the stimulus of the current trial to trial handler.
+# Nothing is added to phases without stimulus, results of earlier stimuli that were not saved in time are dropped:
+def add_pupil_response_data(handler):
+    global pupil_stimulus_to_save
+    if pupil_stimulus_to_save is None:
+        return
+    pupil_response = pupil_engine.pop_result(pupil_stimulus_to_save)
+    handler.addData('pupil_stimulus', pupil_stimulus_to_save)
+    for column, value in pupil_response.items():
+        handler.addData(column, value)
+    pupil_stimulus_to_save = None
+
+# Live summary: number, mean and standard deviation of peak dilations per condition and factor level:
+def print_pupil_summary():
+    if not online_pupil_responses:
+        return
+    print('pupil responses (peak dilation):')
+    logging.info(' PUPIL RESPONSES (PEAK DILATION):')
+    for [key, count, mean, standard_deviation] in pupil_engine.get_summary():
+        summary = str(key) + ': n = ' + str(count) + ', mean = ' + str(round(mean,3)) + ', sd = ' + str(round(standard_deviation,3))
+        print('    ' + summary)
+        logging.info(' ' + summary)
+
+def reset_tracker_calls():
+    global tracker_call_counter, tracker_call_duration, tracker_call_max, tracker_lock_wait_duration, tracker_lock_wait_max
+    tracker_call_counter = 0
+    tracker_call_duration = 0
+    tracker_call_max = 0
+    tracker_lock_wait_duration = 0
+    tracker_lock_wait_max = 0
+
+# Add number and latency of tracker calls and the wait for the tracker lock since the last trial to trial handler:
+def add_tracker_call_data(handler):
+    handler.addData('tracker_calls', tracker_call_counter)
+    if tracker_call_counter > 0:
+        handler.addData('tracker_call_latency_mean', round(tracker_call_duration/tracker_call_counter,5))
+        handler.addData('tracker_call_latency_max', round(tracker_call_max,5))
+        handler.addData('tracker_lock_wait_total', round(tracker_lock_wait_duration,5))
+        handler.addData('tracker_lock_wait_max', round(tracker_lock_wait_max,5))
+    reset_tracker_calls()
+
+# Frame timing recorder:
+# Flip timestamps of the current trial are written into a preallocated array.
+# Flip intervals that contain a pause (dialog of check_keypress()) are marked and not counted as dropped frames.
+frame_timestamps = numpy.zeros(max_frames_per_trial)
+frame_after_pause = numpy.zeros(max_frames_per_trial, dtype = bool)
+frame_counter = 0
+frame_pause_pending = False
+# Time of the last flip and flip-to-flip time of the last frame (one refresh period after a pause):
+last_flip_time = None
+last_frame_duration = refresh_rate
+
+# Start recording flip timestamps of a new trial:
+def reset_frame_timing():
+    global frame_counter, frame_pause_pending
+    frame_counter = 0
+    frame_pause_pending = False
+
+def mark_frame_pause():
+    global frame_pause_pending
+    frame_pause_pending = True
+
+# Flip window and store the flip timestamp, used in all frame loops:
+def flip_window():
+    global frame_counter, flip_counter, frame_pause_pending, last_flip_time, last_frame_duration
+    flip_time = mywin.flip()
+    flip_counter += 1
+    flip_after_pause = frame_pause_pending
+    frame_pause_pending = False
+    if last_flip_time is not None and not flip_after_pause:
+        last_frame_duration = flip_time - last_flip_time
+    else:
+        last_frame_duration = refresh_rate
+    last_flip_time = flip_time
+    if record_frame_timing and frame_counter < max_frames_per_trial:
+        frame_timestamps[frame_counter] = flip_time
+        frame_after_pause[frame_counter] = flip_after_pause
+        frame_counter += 1
+    if event_scheduler.pending_event is not None:
+        register_event_onset(flip_time)
+    if pending_flip_trigger is not None:
+        register_trigger_flip(flip_time)
+    return flip_time
+
+# Duration of the last frame of the gaze contingent loops: in deadline mode the measured flip-to-flip time,
+# so dropped frames count with their real duration, otherwise one refresh period (frame counting):
+def get_frame_duration():
+    if deadline_scheduling:
+        return last_frame_duration
+    return refresh_rate
+
+# Dropped frames, maximum inter-flip interval and jitter of the current trial:
+def get_frame_timing():
+    flip_intervals = numpy.diff(frame_timestamps[:frame_counter])[~frame_after_pause[1:frame_counter]]
+    if len(flip_intervals) == 0:
+        return [0, 0, 0]
+    # A flip interval of n refresh periods means that n-1 frames were dropped:
+    missed_refreshes = numpy.round(flip_intervals/refresh_rate) - 1
+    dropped_frames = int(numpy.sum(missed_refreshes[missed_refreshes > 0]))
+    max_frame_interval = round(float(numpy.max(flip_intervals)),4)
+    frame_jitter = round(float(numpy.std(flip_intervals)),4)
+    if dropped_frames > 0:
+        print('warning: dropped frames: ' + str(dropped_frames))
+        logging.warning(' DROPPED FRAMES: ' f'{dropped_frames}' ' MAX FRAME INTERVAL: ' f'{max_frame_interval}')
+    return [dropped_frames, max_frame_interval, frame_jitter]
+
+# Add frame timing of the current trial to trial handler:
+def add_frame_timing_data(handler):
+    if record_frame_timing:
+        [dropped_frames, max_frame_interval, frame_jitter] = get_frame_timing()
+        handler.addData('dropped_frames', dropped_frames)
+        handler.addData('max_frame_interval', max_frame_interval)
+        handler.addData('frame_jitter', frame_jitter)
+
+# Deadline scheduler, see deadline_scheduler.py:
+event_scheduler = DeadlineScheduler(mywin, refresh_rate, schedule_resync_cutoff)
+
+# Define session start time at the next flip:
+def start_session_schedule():
+    session_start_time = event_scheduler.start()
+    if deadline_scheduling:
+        print('session start time: ' + str(round(session_start_time,4)))
+        logging.info(' SESSION START TIME: ' f'{round(session_start_time,4)}')
+
+# Plan onset of an event, returns the flip deadline at which the event ends:
+def schedule_event(event_name, duration):
+    if not deadline_scheduling:
+        return None
+    # The achieved onset is the timestamp of the next flip, see flip_window():
+    return event_scheduler.schedule(event_name, duration)
+
+# Shift end of the current event, e.g. by pauses and gaze contingent phases:
+def extend_event(duration):
+    if deadline_scheduling:
+        event_scheduler.extend(duration)
+
+# Store achieved onset of the event that was scheduled last:
+def register_event_onset(flip_time):
+    [event_name, planned_onset, achieved_onset] = event_scheduler.register_onset(flip_time)
+    logging.info(' EVENT ONSET: ' f'{event_name}' ' PLANNED: ' f'{round(planned_onset,4)}' ' ACHIEVED: ' f'{round(achieved_onset,4)}' ' DELAY: ' f'{round(achieved_onset - planned_onset,4)}')
+
+# Check if a frame loop continues, either by number of frames or by flip deadline:
+# In deadline mode the deadline is shifted by delay (e.g. gaze contingent delays and pauses):
+def continue_frame_loop(frameN, number_of_frames, frame_deadline, delay = 0):
+    if not deadline_scheduling:
+        return frameN < number_of_frames
+    return event_scheduler.continue_loop(frameN, frame_deadline, delay)
+
+# Add planned and achieved onsets (relative to session start) to trial handler:
+def add_schedule_data(handler):
+    if deadline_scheduling:
+        for event_name, [planned_onset, achieved_onset] in event_scheduler.pop_onsets().items():
+            handler.addData(event_name + '_onset_planned', round(planned_onset,4))
+            if achieved_onset is not None:
+                handler.addData(event_name + '_onset_achieved', round(achieved_onset,4))
+
+# Flip-locked triggers:
+# Condition triggers are queued with callOnFlip and sent directly after the flip that starts the stimulus.
+pending_flip_trigger = None
+# Flip timestamp, port write time and queue state of the last flip-locked trigger since the last saved trial:
+trigger_flip_timing = dict()
+
+# Send condition trigger, either immediately or on next flip:
+def send_trigger_on_flip(trigger_name):
+    global pending_flip_trigger
+    if flip_locked_triggers:
+        mywin.callOnFlip(send_flip_locked_trigger, trigger_name)
+        pending_flip_trigger = trigger_name
+    else:
+        send_trigger(trigger_name)
+
+# Called by window directly after the flip. The port is free (see wait_for_trigger_port()), thus the trigger time
+# is the port write. A queued trigger is flagged, then the trigger time is the call and its port write is in the trigger log:
+def send_flip_locked_trigger(trigger_name):
+    [trigger_time_exp, trigger_queued] = send_trigger(trigger_name)
+    trigger_flip_timing['trigger_sent_time'] = trigger_time_exp
+    trigger_flip_timing['trigger_queued'] = trigger_queued
+
+# Store flip timestamp of a flip-locked trigger, called by flip_window():
+def register_trigger_flip(flip_time):
+    global pending_flip_trigger
+    trigger_flip_timing['trigger_name'] = pending_flip_trigger
+    trigger_flip_timing['trigger_flip_time'] = flip_time
+    pending_flip_trigger = None
+
+# Add flip timestamp and remaining offset between flip and port write of the trigger to trial handler:
+def add_trigger_flip_data(handler):
+    if flip_locked_triggers and 'trigger_flip_time' in trigger_flip_timing:
+        trigger_flip_time = trigger_flip_timing['trigger_flip_time']
+        handler.addData('trigger_flip_time', round(trigger_flip_time,4))
+        handler.addData('trigger_flip_offset', round(trigger_flip_timing['trigger_sent_time'] - trigger_flip_time,4))
+        handler.addData('trigger_queued', trigger_flip_timing['trigger_queued'])
+        trigger_flip_timing.clear()
+
 # Fixation cross: Check for data availability and screen center gaze.
 def fixcross_gazecontingent(duration_in_seconds, background_color = background_color_rgb, cross_color = 'black'):
     # Translate duration to number of frames:
     number_of_frames = round(duration_in_seconds/refresh_rate)
+    # Alternatively, flip deadline at which the fixation cross ends:
+    frame_deadline = schedule_event('fixcross', duration_in_seconds)
     timestamp = core.getTime()
+    # The polling thread writes samples continuously, older samples are excluded by time:
+    if not gaze_polling_thread:
+        gaze_buffer.reset()
     gaze_offset_duration = 0
     pause_duration = 0
     nodata_duration = 0 
+    # Time spent in gaze contingent loops, extends the deadline:
+    contingency_delay = 0
     # Variables contain all space bar presses in a single trial.
     responses_timestamp = list() # since experiment start
     responses_rt = list() # since trial start
     # Present cross for number of frames:
-    for frameN in range(number_of_frames):
+    frameN = 0
+    while continue_frame_loop(frameN, number_of_frames, frame_deadline, delay = contingency_delay + pause_duration):
         # Check for space bar presses during practice trials and oddball blocks:
         responses = kb.getKeys([' '], waitRelease = True)
         response_timestamp = core.getTime()
@@ -447,44 +1050,60 @@ def fixcross_gazecontingent(duration_in_seconds, background_color = background_c
                 send_trigger('response')
                 responses_timestamp.append(response_timestamp)
                 responses_rt.append(response.rt)
+                log_event('response', time = response_timestamp, key = response.name, rt = response.rt)
                 print('RESPONSE: [{}] [{}] ({})'.format(response_timestamp, response.name, response.rt))
         # Check for keypress
         pause_duration += check_keypress()
-        gaze_position = tracker.getPosition()
+        gaze_position = get_gaze_data()
         # Check for eyetracking data:
         if check_nodata(gaze_position):
             print('warning: no eyes detected')
             logging.warning(' NO EYES DETECTED')
-            # Reset duration for loop, restart ISI:
-            frameN = 1 
+            delay_start = core.getTime()
             nodata_current_duration = 0
             while check_nodata(gaze_position):
-                if nodata_current_duration > no_data_warning_cutoff:
+                if get_nodata_duration(gaze_position, nodata_current_duration) > no_data_warning_cutoff:
                     draw_nodata_info(background_color)
-                mywin.flip()
-                nodata_duration += refresh_rate
-                nodata_current_duration += refresh_rate
-                gaze_position = tracker.getPosition() 
+                flip_window()
+                frame_duration = get_frame_duration()
+                nodata_duration += frame_duration
+                nodata_current_duration += frame_duration
+                gaze_position = get_gaze_data() 
+            contingency_delay += core.getTime() - delay_start
+            log_event('nodata', time = delay_start, duration = round(core.getTime() - delay_start,3))
         # Check for gaze
         elif check_gaze_offset(gaze_position):
             print('warning: gaze offset')
             logging.warning(' GAZE OFFSET')
-            # Reset duration of for loop - resart ISI:
-            frameN = 1 
+            delay_start = core.getTime()
+            pause_before_offset = pause_duration
             while not check_nodata(gaze_position) and check_gaze_offset(gaze_position):
                 # Listen for keypress:
                 pause_duration += check_keypress()
                 # Redirect attention to fixation cross area:
                 draw_gazedirect(background_color)
                 # Wait for monitor refresh time:
-                mywin.flip()
-                gaze_offset_duration += refresh_rate
+                flip_window()
+                gaze_offset_duration += get_frame_duration()
                 # Get new gaze data:
-                gaze_position = tracker.getPosition() 
+                gaze_position = get_gaze_data() 
+            # Pauses during gaze offset are already included in pause duration:
+            contingency_delay += core.getTime() - delay_start - (pause_duration - pause_before_offset)
+            log_event('gaze_offset', time = delay_start, duration = round(core.getTime() - delay_start,3))
         # Draw fixation cross:
         draw_fixcross(background_color, cross_color)
-        mywin.flip()
-
+        flip_window()
+        frameN += 1
+
+    # Next event is planned after the extended deadline:
+    extend_event(contingency_delay + pause_duration)
+    # Gaze quality and pupil responses, including samples of the last frame:
+    if (record_gaze_quality or online_pupil_responses) and not gaze_polling_thread:
+        get_gaze_samples()
+    if record_gaze_quality:
+        compute_gaze_quality(timestamp)
+        print('gaze quality: ' + str(gaze_quality))
+        logging.info(' GAZE QUALITY: ' f'{gaze_quality}')
     # Output info:
     actual_fixcross_duration = round(core.getTime()-timestamp,3)
     gaze_offset_duration = round(gaze_offset_duration,3)
@@ -500,71 +1119,39 @@ def fixcross_gazecontingent(duration_in_seconds, background_color = background_c
     print('actual fixcross duration: ' + str(actual_fixcross_duration))
     logging.info(' ACTUAL FIXCROSS DURAION: ' f'{actual_fixcross_duration}')
 
+    log_event('isi_result', ISI_expected = duration_in_seconds, ISI_duration = actual_fixcross_duration, number_of_frames = number_of_frames,
+        gaze_offset_duration = gaze_offset_duration, nodata_duration = nodata_duration, pause_duration = pause_duration)
+
     return [actual_fixcross_duration, gaze_offset_duration, pause_duration, nodata_duration, responses_timestamp, responses_rt]
 
 # Stimulus for manipulation:
 def draw_ball(size):
-    circle1 = visual.Circle(
-        win = mywin,
-        radius = size,
-        units = 'pix',
-        fillColor = standard_ball_color,
-        interpolate = True)
-    circle1.draw()
+    draw_cached(('ball', standard_ball_color, size))
 
 # Stimulus presentation
 def present_ball(duration, trial, salience, utility, block):
-    if trial == 'standard':
-        size = standard_ball_size
-    elif trial == 'oddball':
-        if salience == '+':
-            size = high_salience_ball_size
-        elif salience == '-':
-            size = low_salience_ball_size
+    # Trigger name and ball size of the condition, see condition encoder in SETUP:
+    [trigger_name, ball_size] = condition_table[(block, trial, salience, utility)]
 
     number_of_frames = round(duration/refresh_rate) 
     timestamp = clock.getTime()
     print('presenting ball: {} {} {} {}'.format(duration, trial, salience, utility))
     logging.info(' PRESENTING BALL: ' f'{duration}' ' ' f'{trial}' ' ' f'{salience}' ' ' f'{utility}')
     
-    if block == 'oddball_block': 
-        if trial == 'standard' and salience == '+' and utility == '+':
-            send_trigger('standard_shigh_uhigh')
-        elif trial == 'standard' and salience == '+' and utility == '-':
-            send_trigger('standard_shigh_ulow')
-        elif trial == 'standard' and salience == '-' and utility == '+':
-            send_trigger('standard_slow_uhigh')
-        elif trial == 'standard' and salience == '-' and utility == '-':
-            send_trigger('standard_slow_ulow')
-        elif trial == 'oddball' and salience == '+' and utility == '+':
-            send_trigger('oddball_shigh_uhigh')
-        elif trial == 'oddball' and salience == '+' and utility == '-':
-            send_trigger('oddball_shigh_ulow')
-        elif trial == 'oddball' and salience == '-' and utility == '+':
-            send_trigger('oddball_slow_uhigh')
-        elif trial == 'oddball' and salience == '-' and utility == '-':
-            send_trigger('oddball_slow_ulow')
-    if block == 'practice_block':
-        if trial == 'standard' and salience == '+' and utility == '+':
-            send_trigger('pract_standard_shigh_uhigh')
-        elif trial == 'standard'and salience == '+' and utility == '-':
-            send_trigger('pract_standard_shigh_ulow')    
-        elif trial == 'standard' and salience == '-' and utility == '+':
-            send_trigger('pract_standard_slow_uhigh')   
-        elif trial == 'standard' and salience == '-' and utility == '-':
-            send_trigger('pract_standard_slow_ulow') 
-        elif trial == 'oddball' and salience == '+' and utility == '+':
-            send_trigger('practoddball_shigh_uhigh')
-        elif trial == 'oddball' and salience == '+' and utility == '-':
-            send_trigger('practoddball_shigh_ulow')
-        elif trial == 'oddball' and salience == '-' and utility == '+':
-            send_trigger('practoddball_slow_uhigh')
-        elif trial == 'oddball' and salience == '-' and utility == '-':
-            send_trigger('practoddball_slow_ulow')
+    # Condition trigger is written to the port without delay:
+    wait_for_trigger_port()
+    send_trigger_on_flip(trigger_name)
    
-    for frameN in range(number_of_frames):
-        draw_ball(size = size)
-        mywin.flip()
+    frame_deadline = schedule_event('stimulus', duration)
+    frameN = 0
+    while continue_frame_loop(frameN, number_of_frames, frame_deadline):
+        draw_ball(size = ball_size)
+        flip_time = flip_window()
+        # Stimulus onset of the online pupil response:
+        if frameN == 0:
+            register_pupil_trial(flip_time, trigger_name, {'trial': trial, 'salience': salience, 'utility': utility})
+            log_event('stimulus_onset', time = flip_time, trial = trial, condition = trigger_name)
+        frameN += 1
     
     print('presented ball')
     logging.info(' PRESENTED BALL.')
@@ -579,6 +1166,51 @@ def define_ISI_interval():
     ISI = ISI/1000 # ms -> s
     return ISI
 
+# Data quality gate: each trial is scored from the fractions of its ISI with gaze data and with gaze offset.
+# Without repeat_failed_trials no trial is scored, the trial data has no quality columns.
+trial_gate = {'passed': True, 'repetition': False}
+
+def score_trial_quality(handler, fixcross_duration, offset_duration, nodata_duration):
+    if not repeat_failed_trials:
+        return
+    valid_fraction = 1 - nodata_duration/fixcross_duration if fixcross_duration > 0 else 0
+    offset_fraction = offset_duration/fixcross_duration if fixcross_duration > 0 else 0
+    trial_gate['passed'] = bool(valid_fraction >= min_valid_fraction and offset_fraction <= max_offset_fraction)
+    handler.addData('trial_valid_fraction', round(valid_fraction,3))
+    handler.addData('trial_offset_fraction', round(offset_fraction,3))
+    handler.addData('trial_quality_passed', trial_gate['passed'])
+    handler.addData('trial_repetition', trial_gate['repetition'])
+    if not trial_gate['passed']:
+        print('warning: trial failed data quality gate')
+        logging.warning(' TRIAL FAILED DATA QUALITY GATE: VALID ' f'{round(valid_fraction,3)}' ' OFFSET ' f'{round(offset_fraction,3)}')
+
+# Iterate over a trial handler. A failed trial is inserted again at a random position of the remaining trials,
+# thus every condition of the block gets its number of clean trials and the stimulus ratio is kept.
+# Yields the condition and the handler for its data: the trial handler for regular trials, the experiment handler
+# for repetitions (they run between two iterations, trial handler data would overwrite the cell of the last trial).
+# The loop columns of a repetition row (e.g. trials.thisN) still belong to the last regular trial,
+# thus repetitions get the number and condition of the failed trial as repetition_of and repetition_condition:
+def gated_trials(handler):
+    trial_repetitions = TrialRepetitions(trial_repetition_budget)
+    for condition in handler:
+        trial_number = handler.thisN
+        trial_gate['repetition'] = False
+        trial_gate['passed'] = True
+        yield condition, handler
+        while True:
+            if repeat_failed_trials and not trial_gate['passed'] and trial_repetitions.schedule(condition, trial_number, handler.nRemaining):
+                print('trial is repeated later: ' + str(condition) + ', repetitions left: ' + str(trial_repetitions.repetitions_left))
+                logging.info(' TRIAL IS REPEATED LATER: ' f'{condition}' ', REPETITIONS LEFT: ' f'{trial_repetitions.repetitions_left}')
+            due_repetition = trial_repetitions.pop_due(handler.nRemaining)
+            if due_repetition is None:
+                break
+            [condition, trial_number] = due_repetition
+            trial_gate['repetition'] = True
+            trial_gate['passed'] = True
+            exp.addData('repetition_of', trial_number)
+            exp.addData('repetition_condition', condition)
+            yield condition, exp
+
 '''EXPERIMENTAL DESIGN'''
 # The trial handler calls the sequence and displays it randomized.
 # Loop of block is added to experiment handler.
@@ -633,11 +1265,30 @@ standard_practice_trial_counter = 1 # trials in practice blocks
 practice_trial_counter = 1 # trials in practice blocks
 all_responses = list()
 
+# Build stimuli before the first frame loop:
+warm_up_stimulus_cache()
+
+# Session start time for deadline scheduling:
+start_session_schedule()
+# Tracker calls are counted from here on:
+reset_tracker_calls()
+
+# Timer thread for asynchronous trigger pulses:
+start_trigger_pulse_thread()
+start_gaze_polling_thread()
+
 # Send trigger:
 send_trigger('experiment_start')
 
 for phase in phase_handler:
+    # Write trigger log of last block:
+    flush_trigger_log()
+    # Trial data of last block to disk:
+    if trial_writer is not None:
+        trial_writer.sync()
     block_counter += 1
+    # Console output is turned off except for instructions in quiet mode:
+    task_log.set_quiet(quiet_console and not phase.startswith('instruction'))
 
     if phase == 'instruction1':
         text_1 = "Das Experiment beginnt jetzt.\nBitte bleibe still sitzen und\nschaue auf das Kreuz in der Mitte.\n\n Weiter mit der Leertaste."
@@ -725,18 +1376,21 @@ for phase in phase_handler:
         for standard in standards:
             send_trigger('practice_trial')
             ISI = define_ISI_interval()
+            log_event('trial_start', phase = phase, trial = standard, ISI = ISI)
             timestamp = time.time() # epoch
             timestamp_exp = core.getTime() # time since start of experiment
-            timestamp_tracker = tracker.trackerTime()
+            timestamp_tracker = get_tracker_time()
             print('NEW STANDARD TRIAL')
             logging.info(' NEW STANDRAD TRIAL')
             print("ISI: ",ISI)
             logging.info(' ISI: ' f'{ISI}')
-            print("gaze position: ",tracker.getPosition())
-            logging.info(' GAZE POSITION: ' f'{tracker.getPosition()}')
+            gaze_position = get_gaze_position()
+            print("gaze position: ",gaze_position)
+            logging.info(' GAZE POSITION: ' f'{gaze_position}')
             # Reset keyboard clock to get reaction times relative to each trial start.
             kb.clock.reset()
             # Each trial consists of a standard stimulus and a fixcross presentation:
+            reset_frame_timing()
             actual_stimulus_duration = present_ball(duration = stimulus_duration_in_seconds, trial = standard, salience = s, utility = u, block = 'oddball_block')
             send_trigger('ISI')
             [fixcross_duration, offset_duration, pause_duration, nodata_duration, responses_timestamp, responses_rt] = fixcross_gazecontingent(ISI)
@@ -752,6 +1406,12 @@ for phase in phase_handler:
             practice_trials.addData('stimulus_duration', actual_stimulus_duration)
             practice_trials.addData('ISI_expected', ISI)
             practice_trials.addData('ISI_duration', fixcross_duration)
+            add_frame_timing_data(practice_trials)
+            add_schedule_data(practice_trials)
+            add_trigger_flip_data(practice_trials)
+            add_tracker_call_data(practice_trials)
+            add_gaze_quality_data(practice_trials)
+            add_pupil_response_data(practice_trials)
             practice_trials.addData('gaze_offset_duration', offset_duration)
             practice_trials.addData('trial_pause_duration', pause_duration)
             practice_trials.addData('trial_nodata_duration', nodata_duration)
@@ -762,29 +1422,33 @@ for phase in phase_handler:
             practice_trials.addData('timestamp_tracker', timestamp_tracker)
 
             standard_trial_counter += 1
-            exp.nextEntry()
+            next_entry()
 
         # Continuing counting after 3 standard trials...
         oddball_trial_counter = standard_trial_counter
 
-        for trial in trials:
+        for [trial, trial_data] in gated_trials(trials):
             send_trigger('trial')
             ISI = define_ISI_interval() # jittery ISI for each trial separately
+            log_event('trial_start', phase = phase, trial = trial, ISI = ISI)
             timestamp = time.time() # epoch
             timestamp_exp = core.getTime() # time since start of experiment
-            timestamp_tracker = tracker.trackerTime()
+            timestamp_tracker = get_tracker_time()
             print('NEW TRIAL')
             logging.info(' NEW TRIAL')
             print("ISI: ", ISI)
             logging.info(' ISI: ' f'{ISI}')
-            print("gaze position: ", tracker.getPosition())
-            logging.info(' GAZE POSITION: ' f'{tracker.getPosition()}')
+            gaze_position = get_gaze_position()
+            print("gaze position: ",gaze_position)
+            logging.info(' GAZE POSITION: ' f'{gaze_position}')
             # Reset keyboard clock to get reaction times relative to each trial start.
             kb.clock.reset()
             # Stimulus presentation:
+            reset_frame_timing()
             actual_stimulus_duration = present_ball(duration = stimulus_duration_in_seconds, trial = trial, salience = s, utility = u, block = 'oddball_block')
             send_trigger('ISI')
             [fixcross_duration, offset_duration, pause_duration, nodata_duration, responses_timestamp, responses_rt] = fixcross_gazecontingent(ISI)
+            score_trial_quality(trial_data, fixcross_duration, offset_duration, nodata_duration)
 
             # In high utility oddball blocks: Feedback for subject:
             feedback = " "
@@ -820,36 +1484,50 @@ for phase in phase_handler:
             phase_handler.addData('block_counter', block_counter)
             phase_handler.addData('responses_median', responses_median)
             # Information about each trial in an oddball phase:
-            trials.addData('trial', trial)
-            trials.addData('oddball_trial_counter', oddball_trial_counter)
-            trials.addData('stimulus_duration', actual_stimulus_duration)
-            trials.addData('ISI_expected', ISI)
-            trials.addData('ISI_duration',fixcross_duration)
-            trials.addData('gaze_offset_duration', offset_duration)
-            trials.addData('trial_pause_duration', pause_duration)
-            trials.addData('trial_nodata_duration', nodata_duration)
-            trials.addData('responses_timestamp', responses_timestamp)
-            trials.addData('responses_rt', responses_rt)
-            trials.addData('timestamp', timestamp)
-            trials.addData('timestamp_exp', timestamp_exp)
-            trials.addData('timestamp_tracker', timestamp_tracker)
-            trials.addData('feedback', feedback)
+            trial_data.addData('trial', trial)
+            trial_data.addData('oddball_trial_counter', oddball_trial_counter)
+            trial_data.addData('stimulus_duration', actual_stimulus_duration)
+            trial_data.addData('ISI_expected', ISI)
+            trial_data.addData('ISI_duration',fixcross_duration)
+            add_frame_timing_data(trial_data)
+            add_schedule_data(trial_data)
+            add_trigger_flip_data(trial_data)
+            add_tracker_call_data(trial_data)
+            add_gaze_quality_data(trial_data)
+            add_pupil_response_data(trial_data)
+            trial_data.addData('gaze_offset_duration', offset_duration)
+            trial_data.addData('trial_pause_duration', pause_duration)
+            trial_data.addData('trial_nodata_duration', nodata_duration)
+            trial_data.addData('responses_timestamp', responses_timestamp)
+            trial_data.addData('responses_rt', responses_rt)
+            trial_data.addData('timestamp', timestamp)
+            trial_data.addData('timestamp_exp', timestamp_exp)
+            trial_data.addData('timestamp_tracker', timestamp_tracker)
+            trial_data.addData('feedback', feedback)
             
             oddball_trial_counter += 1
-            exp.nextEntry()
+            next_entry()
 
     if phase == 'baseline':
         send_trigger('baseline')
+        print_pupil_summary()
         print('START OF BASELINE PHASE')
         logging.info(' START OF BASELINE PHASE.')
         timestamp = time.time() # epoch
         timestamp_exp = core.getTime() # time since start of experiment
         # Present baseline:
+        reset_frame_timing()
         [stimulus_duration, offset_duration, pause_duration, nodata_duration, responses_timestamp, responses_rt] = fixcross_gazecontingent(baseline_duration)
         # Save data about baseline phase in .csv file:
         phase_handler.addData('phase', phase)
         phase_handler.addData('block_counter', block_counter)
         phase_handler.addData('stimulus_duration', stimulus_duration)
+        add_frame_timing_data(phase_handler)
+        add_schedule_data(phase_handler)
+        add_trigger_flip_data(phase_handler)
+        add_tracker_call_data(phase_handler)
+        add_gaze_quality_data(phase_handler)
+        add_pupil_response_data(phase_handler)
         phase_handler.addData('gaze_offset_duration', offset_duration)
         phase_handler.addData('trial_pause_duration', pause_duration)
         phase_handler.addData('trial_nodata_duration', nodata_duration)
@@ -859,7 +1537,7 @@ for phase in phase_handler:
         phase_handler.addData('timestamp_exp', timestamp_exp)
 
         baseline_trial_counter += 1
-        exp.nextEntry()
+        next_entry()
 
     if phase.startswith('practoddball_'):
         practice_parameters = phase.split('_')[1]
@@ -901,18 +1579,21 @@ for phase in phase_handler:
         for standard in standards:
             send_trigger('practice_trial')
             ISI = define_ISI_interval()
+            log_event('trial_start', phase = phase, trial = standard, ISI = ISI)
             timestamp = time.time() # epoch
             timestamp_exp = core.getTime() # time since start of experiment
-            timestamp_tracker = tracker.trackerTime()
+            timestamp_tracker = get_tracker_time()
             print('NEW STANDARD TRIAL')
             logging.info(' NEW STANDRAD TRIAL')
             print("ISI: ",ISI)
             logging.info(' ISI: ' f'{ISI}')
-            print("gaze position: ",tracker.getPosition())
-            logging.info(' GAZE POSITION: ' f'{tracker.getPosition()}')
+            gaze_position = get_gaze_position()
+            print("gaze position: ",gaze_position)
+            logging.info(' GAZE POSITION: ' f'{gaze_position}')
             # Reset keyboard clock to get reaction times relative to each trial start.
             kb.clock.reset()
             # In each trial, the stimulus (standard or oddball) and the fixcross ist presented:
+            reset_frame_timing()
             actual_stimulus_duration = present_ball(duration = stimulus_duration_in_seconds, trial = standard, salience = s, utility = u, block = 'practice_block')
             send_trigger('ISI')
             [fixcross_duration, offset_duration, pause_duration, nodata_duration, responses_timestamp, responses_rt] = fixcross_gazecontingent(ISI)
@@ -927,6 +1608,12 @@ for phase in phase_handler:
             practice_trials.addData('stimulus_duration', actual_stimulus_duration)
             practice_trials.addData('ISI_expected', ISI)
             practice_trials.addData('ISI_duration', fixcross_duration)
+            add_frame_timing_data(practice_trials)
+            add_schedule_data(practice_trials)
+            add_trigger_flip_data(practice_trials)
+            add_tracker_call_data(practice_trials)
+            add_gaze_quality_data(practice_trials)
+            add_pupil_response_data(practice_trials)
             practice_trials.addData('gaze_offset_duration', offset_duration)
             practice_trials.addData('trial_pause_duration', pause_duration)
             practice_trials.addData('trial_nodata_duration', nodata_duration)
@@ -937,25 +1624,28 @@ for phase in phase_handler:
             practice_trials.addData('timestamp_tracker', timestamp_tracker)
 
             standard_practice_trial_counter += 1
-            exp.nextEntry()
+            next_entry()
         # Continuing counting after 3 standard trials... 
         practice_trial_counter = standard_practice_trial_counter
 
         for practice_trial in practice_trials:
             send_trigger('practice_trial')
             ISI = define_ISI_interval()
+            log_event('trial_start', phase = phase, trial = practice_trial, ISI = ISI)
             timestamp = time.time() # epoch
             timestamp_exp = core.getTime() # time since start of experiment
-            timestamp_tracker = tracker.trackerTime()
+            timestamp_tracker = get_tracker_time()
             print('NEW PRACTICE TRIAL')
             logging.info(' NEW PRACTICE TRIAL')
             print("ISI: ",ISI)
             logging.info(' ISI: ' f'{ISI}')
-            print("gaze position: ",tracker.getPosition())
-            logging.info(' GAZE POSITION: ' f'{tracker.getPosition()}')
+            gaze_position = get_gaze_position()
+            print("gaze position: ",gaze_position)
+            logging.info(' GAZE POSITION: ' f'{gaze_position}')
             # Reset keyboard clock to get reaction times relative to each trial start.
             kb.clock.reset()
             # In each trial, the stimulus (standard or oddball) and the fixcross ist presented:
+            reset_frame_timing()
             actual_stimulus_duration = present_ball(duration = stimulus_duration_in_seconds, trial = practice_trial, salience = s, utility = u, block = 'practice_block')
             send_trigger('ISI')
             [fixcross_duration, offset_duration, pause_duration, nodata_duration, responses_timestamp, responses_rt] = fixcross_gazecontingent(ISI)
@@ -973,6 +1663,12 @@ for phase in phase_handler:
             practice_trials.addData('stimulus_duration', actual_stimulus_duration)
             practice_trials.addData('ISI_expected', ISI)
             practice_trials.addData('ISI_duration', fixcross_duration)
+            add_frame_timing_data(practice_trials)
+            add_schedule_data(practice_trials)
+            add_trigger_flip_data(practice_trials)
+            add_tracker_call_data(practice_trials)
+            add_gaze_quality_data(practice_trials)
+            add_pupil_response_data(practice_trials)
             practice_trials.addData('gaze_offset_duration', offset_duration)
             practice_trials.addData('trial_pause_duration', pause_duration)
             practice_trials.addData('trial_nodata_duration', nodata_duration)
@@ -983,7 +1679,7 @@ for phase in phase_handler:
             practice_trials.addData('timestamp_tracker', timestamp_tracker) 
 
             practice_trial_counter += 1
-            exp.nextEntry() 
+            next_entry() 
 
         # Saving space bar presses in a variable:
         for correct_response in correct_responses:
@@ -1007,11 +1703,18 @@ for phase in phase_handler:
                 timestamp_exp = core.getTime() # time since start of experiment
                 # Present baseline
                 send_trigger('baseline')
+                reset_frame_timing()
                 [stimulus_duration, offset_duration, pause_duration, nodata_duration, responses_timestamp, responses_rt] = fixcross_gazecontingent(baseline_duration)
                 # Global data is saved to output file:
                 phase_handler.addData('phase', phase)
                 phase_handler.addData('block_counter', block_counter)
                 phase_handler.addData('stimulus_duration', stimulus_duration)
+                add_frame_timing_data(phase_handler)
+                add_schedule_data(phase_handler)
+                add_trigger_flip_data(phase_handler)
+                add_tracker_call_data(phase_handler)
+                add_gaze_quality_data(phase_handler)
+                add_pupil_response_data(phase_handler)
                 phase_handler.addData('gaze_offset_duration', offset_duration)
                 phase_handler.addData('trial_pause_duration', pause_duration)
                 phase_handler.addData('trial_nodata_duration', nodata_duration)
@@ -1020,19 +1723,26 @@ for phase in phase_handler:
                 phase_handler.addData('timestamp', timestamp)
                 phase_handler.addData('timestamp_exp', timestamp_exp)
                 baseline_trial_counter += 1
-                exp.nextEntry()
+                next_entry()
 
             if baseline_trial == 'baseline_whiteslide':
                 timestamp = time.time() # epoch
                 timestamp_exp = core.getTime() # time since start of experiment
                 # Present baseline with white background:
                 send_trigger('baseline_whiteslide')
+                reset_frame_timing()
                 [stimulus_duration, offset_duration, pause_duration, nodata_duration, responses_timestamp, responses_rt] = fixcross_gazecontingent(
                     baseline_duration, background_color = white_slide)
                 # Global data is saved to output file:
                 phase_handler.addData('phase', phase)
                 phase_handler.addData('block_counter', block_counter)
                 phase_handler.addData('stimulus_duration', stimulus_duration)
+                add_frame_timing_data(phase_handler)
+                add_schedule_data(phase_handler)
+                add_trigger_flip_data(phase_handler)
+                add_tracker_call_data(phase_handler)
+                add_gaze_quality_data(phase_handler)
+                add_pupil_response_data(phase_handler)
                 phase_handler.addData('gaze_offset_duration', offset_duration)
                 phase_handler.addData('trial_pause_duration', pause_duration)
                 phase_handler.addData('trial_nodata_duration', nodata_duration)
@@ -1040,13 +1750,14 @@ for phase in phase_handler:
                 phase_handler.addData('trial', baseline_trial)
                 phase_handler.addData('timestamp', timestamp)
                 phase_handler.addData('timestamp_exp', timestamp_exp)
-                exp.nextEntry()
+                next_entry()
             
             if baseline_trial == 'baseline_blackslide':
                 timestamp = time.time() # epoch
                 timestamp_exp = core.getTime() # time since start of experiment
                 # Present baseline with black background:
                 send_trigger('baseline_blackslide')
+                reset_frame_timing()
                 [stimulus_duration, offset_duration, pause_duration, nodata_duration, responses_timestamp, responses_rt] = fixcross_gazecontingent(
                     baseline_duration, background_color = black_slide, cross_color = 'grey')
 
@@ -1054,6 +1765,12 @@ for phase in phase_handler:
                 phase_handler.addData('phase', phase)
                 phase_handler.addData('block_counter', block_counter)
                 phase_handler.addData('stimulus_duration', stimulus_duration)
+                add_frame_timing_data(phase_handler)
+                add_schedule_data(phase_handler)
+                add_trigger_flip_data(phase_handler)
+                add_tracker_call_data(phase_handler)
+                add_gaze_quality_data(phase_handler)
+                add_pupil_response_data(phase_handler)
                 phase_handler.addData('gaze_offset_duration', offset_duration)
                 phase_handler.addData('trial_pause_duration', pause_duration)
                 phase_handler.addData('trial_nodata_duration', nodata_duration)
@@ -1061,7 +1778,7 @@ for phase in phase_handler:
                 phase_handler.addData('trial', baseline_trial)
                 phase_handler.addData('timestamp', timestamp)
                 phase_handler.addData('timestamp_exp', timestamp_exp)
-                exp.nextEntry()
+                next_entry()
 
     if phase == 'reward_feedback':
         reward_money = len(rewarded_responses)*0.10
@@ -1076,12 +1793,26 @@ for phase in phase_handler:
 '''WRAP UP AND CLOSE'''
 # Send trigger that experiment has ended:
 send_trigger('experiment_end')
+wait_for_trigger_pulses()
+flush_trigger_log()
+if not testmode:
+    port.close()
 print(' EXPERIMENT ENDED')
 logging.info('EXPERIMENT ENDED.')
+# Stop gaze polling thread and save its latency histogram:
+stop_gaze_polling_thread()
+# Close in-process gaze acquisition and HDF5 file:
+if gaze_stream is not None:
+    gaze_stream.close()
+# Close crash-safe trial data:
+if trial_writer is not None:
+    trial_writer.close()
 # Close reading from eyetracker:
 tracker.setRecordingState(False) 
 # Close iohub instance:
 io.quit() 
 # Close window:
 mywin.close()
+# Write all queued log records:
+task_log.stop()
 core.quit()
\ No newline at end of file